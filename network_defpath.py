@@ -6,9 +6,9 @@
 # Copyright (c) 2018, The University of Melbourne, Australia
 #
 import os
-import sys,subprocess
+import sys,subprocess,time,json
 import networkx
-import network_manager, topo_discovery, sdcon_config
+import network_manager, network_programmer, network_reconciler, topo_discovery, sdcon_config
 from sdcon_config import SDCNodeIdType
 
 # < Default path principles >
@@ -39,32 +39,103 @@ TABLE_ID_BASE = 0 # for basic rules. e.g. in_port=8 actions=outport(9)
 #   of the new rule. It will be installed on top of the other rules. 
 ENABLE_SELF_LEARN = False
 
+# Prints the ports and hosts of each switch while the rules are generated.
+PRINT_DEBUG = False
+
 def get_up_down_ports(topo, switch_id):
-    type = SDCNodeIdType.get_type(switch_id)
+    type = topo.get_node_type(switch_id)
     upports=set()
     downports=set()
     for port in topo.get_all_ports(switch_id):
         other_id = topo.get_connected_node_via_port(switch_id, port)
         
-        print "Debug: (%s,type=%s) port=%s, other=%s"%(switch_id,str(type),str(port),str(other_id))
+        if PRINT_DEBUG:
+            print "Debug: (%s,type=%s) port=%s, other=%s"%(switch_id,str(type),str(port),str(other_id))
         
-        if other_id == None or SDCNodeIdType.get_type(other_id) < type:
+        if other_id == None or topo.get_node_type(other_id) < type:
             downports.add(port)
-        elif SDCNodeIdType.get_type(other_id) > type:
+        elif topo.get_node_type(other_id) > type:
             upports.add(port)
     return (sorted(list(upports)), sorted(list(downports)))
 
 def get_up_down_connected(topo, switch_id):
-    type = SDCNodeIdType.get_type(switch_id)
+    type = topo.get_node_type(switch_id)
     up_connected = set()
     down_connected = set()
     for other_id in topo.get_all_connected(switch_id):
-        if SDCNodeIdType.get_type(other_id) > type:
+        if topo.get_node_type(other_id) > type:
             up_connected.add(other_id)
-        elif SDCNodeIdType.get_type(other_id) < type:
+        elif topo.get_node_type(other_id) < type:
             down_connected.add(other_id)
     return (list(up_connected), list(down_connected))
 
+#####################################################
+# Host hierarchy index
+#####################################################
+class SDCHostHierarchy:
+    # Hosts below / above each node of the fat-tree, computed once per topology and
+    # shared by all default path routines. Each set is computed on its first query
+    # from the sets of the neighbour nodes, and kept (as a frozenset) for later queries.
+    def __init__(self, topo):
+        self.topo = topo
+        self.version = topo.version
+        self.up_down_connected = {} # dict[node] = (up_nodes, down_nodes)
+        self.up_down_ports = {}     # dict[switch] = (upports, downports)
+        self.sub_hosts = {}         # dict[node] = hosts under the node
+        self.super_hosts = {}       # dict[node] = hosts reachable via upper nodes, not under the node
+        self.reachable_hosts = {}   # dict[(switch, port)] = hosts reachable via the port
+    
+    def get_up_down_connected(self, node_id):
+        if node_id not in self.up_down_connected:
+            self.up_down_connected[node_id] = get_up_down_connected(self.topo, node_id)
+        return self.up_down_connected[node_id]
+    
+    def get_up_down_ports(self, switch_id):
+        if switch_id not in self.up_down_ports:
+            self.up_down_ports[switch_id] = get_up_down_ports(self.topo, switch_id)
+        return self.up_down_ports[switch_id]
+    
+    def get_sub_hosts(self, node_id):
+        if node_id not in self.sub_hosts:
+            up_nodes, down_nodes = self.get_up_down_connected(node_id)
+            connected_hosts = set()
+            for down_n in down_nodes:
+                if SDCNodeIdType.is_host(down_n):
+                    connected_hosts.add(down_n)
+                else:
+                    connected_hosts.update(self.get_sub_hosts(down_n))
+            self.sub_hosts[node_id] = frozenset(connected_hosts)
+        return self.sub_hosts[node_id]
+    
+    def get_super_hosts(self, node_id):
+        # = {All sub hosts and super hosts of upper nodes} - {my sub}
+        if node_id not in self.super_hosts:
+            up_nodes, down_nodes = self.get_up_down_connected(node_id)
+            connected_hosts = set()
+            for upnode in up_nodes:
+                if SDCNodeIdType.is_host(upnode):
+                    connected_hosts.add(upnode)
+                else:
+                    connected_hosts.update(self.get_sub_hosts(upnode))
+                    connected_hosts.update(self.get_super_hosts(upnode))
+            connected_hosts.difference_update(self.get_sub_hosts(node_id))
+            self.super_hosts[node_id] = frozenset(connected_hosts)
+        return self.super_hosts[node_id]
+    
+    def get_reachable_hosts(self, switch_id, port):
+        if (switch_id, port) not in self.reachable_hosts:
+            other_id = self.topo.get_connected_node_via_port(switch_id, port)
+            connected_hosts = set(self.get_sub_hosts(other_id)) # lower layer hosts of the other_id
+            connected_hosts.update(self.get_super_hosts(other_id)) # connectable hosts of the other_id
+            connected_hosts.difference_update(self.get_sub_hosts(switch_id)) # Remove my sub-hosts
+            self.reachable_hosts[(switch_id, port)] = frozenset(connected_hosts)
+        return self.reachable_hosts[(switch_id, port)]
+
+def get_hierarchy(topo):
+    if topo.hierarchy_index == None or topo.hierarchy_index.version != topo.version:
+        topo.hierarchy_index = SDCHostHierarchy(topo)
+    return topo.hierarchy_index
+
 def get_default_path_port_pair(all_inports, all_outports):
     in_out = {}
     all_inports.sort()
@@ -80,56 +151,32 @@ def get_default_path_port_pair(all_inports, all_outports):
 
 def get_sub_hosts(topo, switch_id):
     # Find all connected hosts under this switch (downstream only)
-    up_nodes, down_nodes = get_up_down_connected(topo, switch_id)
-    connected_hosts = set()
-    for down_n in down_nodes:
-        if SDCNodeIdType.is_host(down_n):
-            connected_hosts.add(down_n)
-        else:
-            sub_hosts = get_sub_hosts(topo, down_n)
-            connected_hosts.update(sub_hosts)
-    return list(connected_hosts)
+    return list(get_hierarchy(topo).get_sub_hosts(switch_id))
 
 def get_super_hosts(topo, switch_id):
     # Find all connected hosts of my upper switches (for up-stream.) Not including my sub-host
-    up_nodes, down_nodes = get_up_down_connected(topo, switch_id)
-    connected_hosts = set()
-    my_sub = get_sub_hosts(topo, switch_id)
-    for upnode in up_nodes:
-        if SDCNodeIdType.is_host(upnode):
-            connected_hosts.add(upnode)
-        else:
-            # Result = {All sub nodes of upper layer} - {my sub}
-            up_sub = get_sub_hosts(topo, upnode)
-            connected_hosts.update(up_sub)
-            connected_hosts.difference_update( my_sub )
-            
-            super_hosts = get_super_hosts(topo, upnode)
-            connected_hosts.update(super_hosts)
-    
-    return list(connected_hosts)
+    return list(get_hierarchy(topo).get_super_hosts(switch_id))
 
 def get_reachable_host_via_port(topo, switch_id, port):
     # Find all rechable hosts from this switch via the port.
-    connected_hosts = set()
-    
-    other_id = topo.get_connected_node_via_port(switch_id, port)
-    
-    connected_hosts.update(get_sub_hosts(topo, other_id)) # lower layer hosts of the other_id
-    connected_hosts.update(get_super_hosts(topo, other_id)) # connectable hosts of the other_id
-    connected_hosts.difference_update(get_sub_hosts(topo, switch_id)) # Remove my sub-hosts
-    
-    return connected_hosts
+    return set(get_hierarchy(topo).get_reachable_hosts(switch_id, port))
+
+# Pushes a flow to the switch, or only appends it to 'rules' (as a network_manager.FlowRule) if a list is given (dry-run).
+def __add_flow(rules, switch, action_outport, priority, **kwargs):
+    if rules != None:
+        rules.append(network_manager.FlowRule.make(switch, action_outport, priority, **kwargs))
+    else:
+        network_manager.add_flow(switch, action_outport, priority, **kwargs)
 
 # A wrapper function of add_flow_path(). It creates two flows.
 def add_flow_path(switch, action_outport, priority, action_table=None,\
     match_inport=None, match_src_mac=None, match_dst_mac=None, match_is_arp=False,\
-    table_id=0):
+    table_id=0, rules=None):
     # Create the intended flow and forward to ARP table.
     if match_dst_mac:
         action_table = TABLE_ID_PREPROCESS
     
-    network_manager.add_flow(switch, action_outport, priority, action_table=action_table, \
+    __add_flow(rules, switch, action_outport, priority, action_table=action_table, \
         match_inport=match_inport, match_src_mac=match_src_mac,\
         match_dst_mac=match_dst_mac, match_is_arp=match_is_arp,\
         table_id=table_id, flowname=network_manager.FLOWNAME_DEFAULT)
@@ -142,18 +189,18 @@ def add_flow_path(switch, action_outport, priority, action_table=None,\
         add_rule_goto_table(switch, priority, from_table=0, to_table=1)
     '''
 
-def add_rule_arp(switch):
+def add_rule_arp(switch, rules=None):
     # Force forward to controller as well, for ARP processing and host discovery.
     outport = "CONTROLLER"
-    network_manager.add_flow(switch, outport, network_manager.ODL_FLOW_PRIORITY_DEFAULT_PATH_ARP, \
+    __add_flow(rules, switch, outport, network_manager.ODL_FLOW_PRIORITY_DEFAULT_PATH_ARP, \
         match_is_arp=True, 
         action_table = TABLE_ID_BASE, flowname=network_manager.FLOWNAME_DEFAULT,\
         table_id = TABLE_ID_PREPROCESS)
 
-def add_rule_goto_table(switch_id, priority, from_table, to_table):
+def add_rule_goto_table(switch_id, priority, from_table, to_table, rules=None):
     if from_table == to_table:
         return
-    network_manager.add_flow(switch_id, [], priority, action_table = to_table, table_id = from_table,
+    __add_flow(rules, switch_id, [], priority, action_table = to_table, table_id = from_table,
         flowname=network_manager.FLOWNAME_DEFAULT)
 
 
@@ -161,39 +208,41 @@ def add_rule_goto_table(switch_id, priority, from_table, to_table):
 # Path for downward: match - dl_dst, action - downport
 #####################################################
 # Add host rules for directly connected hosts
-def add_path_down_direct_hosts(topo, switch_id):
+def add_path_down_direct_hosts(topo, switch_id, rules=None):
     for node_id in topo.get_all_connected(switch_id):
         if SDCNodeIdType.is_host(node_id):
             outport = topo.get_switch_port_to_dst(switch_id, node_id)
             add_flow_path(switch_id, outport, network_manager.ODL_FLOW_PRIORITY_DEFAULT_PATH_FOR_HOST,\
                 match_dst_mac=node_id, \
-                table_id = TABLE_ID_HOST)
+                table_id = TABLE_ID_HOST, rules=rules)
 
 # Add host rules for indirectly connected hosts
-def add_path_down_indirect_hosts(topo, switch_id):
-    up_nodes, down_nodes = get_up_down_connected(topo, switch_id)
+def add_path_down_indirect_hosts(topo, switch_id, rules=None):
+    hierarchy = get_hierarchy(topo)
+    up_nodes, down_nodes = hierarchy.get_up_down_connected(switch_id)
     for down_switch in down_nodes:
         if SDCNodeIdType.is_host(down_switch):
             continue # rule applies only to switches
         outport = topo.get_switch_port_to_dst(switch_id, down_switch)
-        hosts = get_sub_hosts(topo, down_switch)
+        hosts = hierarchy.get_sub_hosts(down_switch)
         for dst_mac in hosts:
             add_flow_path(switch_id, outport, network_manager.ODL_FLOW_PRIORITY_DEFAULT_PATH_FOR_HOST,\
                 match_dst_mac=dst_mac, \
-                table_id = TABLE_ID_HOST)
+                table_id = TABLE_ID_HOST, rules=rules)
 
 #####################################################
 # Path for upward: match - dl_dst and in_port=downport, action - upport
 #####################################################
-def add_path_up_port_match_known_hosts(topo, switch_id):
-    upports, downports = get_up_down_ports(topo, switch_id)
+def add_path_up_port_match_known_hosts(topo, switch_id, rules=None):
+    hierarchy = get_hierarchy(topo)
+    upports, downports = hierarchy.get_up_down_ports(switch_id)
     if upports == None or len(upports) == 0 or downports == None or len(downports) == 0:
         return
     
     dsts = {}
     # Get all reachable destinations of each up-port
     for upport in upports:
-        dsts[upport] = get_reachable_host_via_port(topo, switch_id, upport)
+        dsts[upport] = hierarchy.get_reachable_hosts(switch_id, upport)
     
     # Find all hosts, in order to find the host that can reach only through a specific port.
     dsts_all = set()
@@ -213,18 +262,19 @@ def add_path_up_port_match_known_hosts(topo, switch_id):
             for dst in up_known_hosts:
                 add_flow_path(switch_id, outport, network_manager.ODL_FLOW_PRIORITY_DEFAULT_PATH,\
                     match_inport=inport, match_dst_mac=dst,\
-                    table_id = TABLE_ID_BASE)
+                    table_id = TABLE_ID_BASE, rules=rules)
                 #print "Debug: (%s) dl_dst=%s in_port=%s >> outport:%s"%(switch_id, str(dst), str(inport), str(outport))
         other_hosts = set(dsts_all)
         if outport:
             other_hosts.difference_update(dsts[outport])
-        print "Debug: (%s) port %s other hosts = %s"%(switch_id, str(port), str(other_hosts))
+        if PRINT_DEBUG:
+            print "Debug: (%s) port %s other hosts = %s"%(switch_id, str(port), str(other_hosts))
         if len(other_hosts) != 0:
             for dst in other_hosts:
                 outport = dst_port[dst]
                 add_flow_path(switch_id, outport, network_manager.ODL_FLOW_PRIORITY_DEFAULT_PATH,\
                     match_inport=inport, match_dst_mac=dst,\
-                    table_id = TABLE_ID_BASE)
+                    table_id = TABLE_ID_BASE, rules=rules)
                 #print "Debug: Extra (%s) dl_dst=%s in_port=%s >> outport:%s"%(switch_id, str(dst), str(inport), str(outport))            
 
 # Add port-base rules from down-port to up-port
@@ -243,27 +293,38 @@ def add_path_up_port_match(topo, switch_id):
 #####################################################
 # Main function
 #####################################################
-def set_default_path_switch(topo, switch_id):
-    add_path_down_direct_hosts(topo, switch_id) # To specific destination (to down ports)
-    add_path_down_indirect_hosts(topo, switch_id)
-    add_path_up_port_match_known_hosts(topo, switch_id)
+def set_default_path_switch(topo, switch_id, rules=None):
+    add_path_down_direct_hosts(topo, switch_id, rules) # To specific destination (to down ports)
+    add_path_down_indirect_hosts(topo, switch_id, rules)
+    add_path_up_port_match_known_hosts(topo, switch_id, rules)
     
     #add_path_up_port_match(topo, switch_id) # For the rest going from down to up level
     #add_path_broadcast_common(topo, switch_id) # To broadcast (everywhere)
     #add_path_flood(topo, switch_id) # Unknown packets from upper to lower : Flood
     #add_rule_self_learn(topo, switch_id) # Self-learn function
-    add_rule_arp(switch_id)
+    add_rule_arp(switch_id, rules)
     
     if TABLE_ID_PREPROCESS < TABLE_ID_HOST:
         add_rule_goto_table(switch_id, network_manager.ODL_FLOW_PRIORITY_DEFAULT_PATH, \
-            from_table=TABLE_ID_PREPROCESS, to_table=TABLE_ID_HOST)
-
-def set_default_paths(topo=None):
+            from_table=TABLE_ID_PREPROCESS, to_table=TABLE_ID_HOST, rules=rules)
+
+# Returns the list of default path rules (network_manager.FlowRule).
+# The rules are pushed in batches per switch table (network_manager.add_flows), and
+# up to 'concurrency' switches are programmed in parallel (see network_programmer).
+# Raises HTTPError after all switches are programmed if any of them failed.
+# With dry_run, the rules are only generated and not pushed to the switches.
+def set_default_paths(topo=None, dry_run=False, concurrency=None):
     if topo == None:
-        topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+        topo = topo_discovery.get_topo()
+    rules = []
     for switch_id in topo.get_all_switches():
-        set_default_path_switch(topo, switch_id)
+        set_default_path_switch(topo, switch_id, rules)
     # add_path_extra_for_controller(topo)
+    if not dry_run:
+        report = network_programmer.program_rules(rules, concurrency)
+        report.print_report()
+        report.raise_for_errors("Setting the default paths")
+    return rules
 
 def del_all_default_paths(topo):
     del_all_rule_self_learn(topo)
@@ -274,22 +335,126 @@ def del_all_default_paths(topo):
 def test_new_function(topo):
     return
 
+#####################################################
+# Offline mode: the default path rule set as data
+#####################################################
+# Returns the complete rule set of the default paths without pushing it:
+#   dict[switch][table_id] = dict[flow_id] = rule (network_manager.FlowRule)
+# Table IDs are strings as in the ODL URLs. If several rules get the same flow ID,
+# the last one is kept as it would overwrite the others on the switch.
+def get_default_rules(topo):
+    rules = set_default_paths(topo, dry_run=True)
+    rule_set = {}
+    for rule in rules:
+        rule_set.setdefault(rule.switch, {}).setdefault(str(rule.table_id), {})[rule.flow_id] = rule
+    return rule_set
+
+def count_rules(rule_set):
+    return sum(len(rule_set[sw][table]) for sw in rule_set for table in rule_set[sw])
+
+# Rules are saved as dicts of network_manager.add_flow() arguments.
+def save_rules(rule_set, file_name):
+    with open(file_name, "w") as f:
+        json.dump(dict( (sw, dict( (table, dict( (flow_id, rule.as_dict()) for flow_id, rule in rules.items() ))
+            for table, rules in rule_set[sw].items() )) for sw in rule_set ), f, indent=1, sort_keys=True)
+
+def load_rules(file_name):
+    with open(file_name) as f:
+        data = json.load(f)
+    return dict( (str(sw), dict( (str(table), dict( (str(flow_id), network_manager.FlowRule.from_dict(rule)) for flow_id, rule in rules.items() ))
+        for table, rules in data[sw].items() )) for sw in data )
+
+DEFAULT_PATH_TABLES = sorted(set([TABLE_ID_PREPROCESS, TABLE_ID_HOST, TABLE_ID_BASE]))
+
+# Compares a rule set with the default path flows installed in ODL (see network_reconciler).
+# Returns network_reconciler.SDCReconcileReport: report.changes[switch][table_id] = (added, modified, deleted)
+def diff_default_rules(rule_set):
+    return network_reconciler.reconcile(rule_set, network_manager.FLOWNAME_DEFAULT, tables=DEFAULT_PATH_TABLES, dry_run=True)
+
+# Installs the default paths by sending only the differences from the installed flows,
+# instead of pushing all rules again (set_default_paths).
+# Raises HTTPError after all switches are reconciled if any of them failed.
+def reconcile_default_paths(topo=None, dry_run=False):
+    if topo == None:
+        topo = topo_discovery.get_topo()
+    report = network_reconciler.reconcile(get_default_rules(topo), network_manager.FLOWNAME_DEFAULT,
+        tables=DEFAULT_PATH_TABLES, switches=topo.get_all_switches(), dry_run=dry_run)
+    report.print_report()
+    report.program_report.raise_for_errors("Reconciling the default paths")
+    return report
+
+def print_rules_summary(rule_set):
+    for sw in sorted(rule_set):
+        print "%s: %s"%(sw, ", ".join("table %s = %d rules"%(table, len(rule_set[sw][table])) for table in sorted(rule_set[sw])))
+    print "Total: %d switches, %d rules"%(len(rule_set), count_rules(rule_set))
+
+def dry_run(snapshot_file, rules_file=None):
+    topo = topo_discovery.load_topo_snapshot(snapshot_file)
+    rule_set = get_default_rules(topo)
+    print_rules_summary(rule_set)
+    if rules_file:
+        save_rules(rule_set, rules_file)
+        print "Rules written in %s"%(rules_file)
+    return rule_set
+
+def print_diff(snapshot_file=None):
+    if snapshot_file:
+        topo = topo_discovery.load_topo_snapshot(snapshot_file)
+    else:
+        topo = topo_discovery.get_topo()
+    report = diff_default_rules(get_default_rules(topo))
+    report.print_report(verbose=True)
+
+def bench_default_paths(topo_snapshot, name, repeat=3):
+    # Times default path rule generation only (no REST calls).
+    elapsed = []
+    for i in range(repeat):
+        topo = topo_discovery.SDCTopo(None, None, None, snapshot=topo_snapshot)
+        start = time.time()
+        rule_set = get_default_rules(topo)
+        elapsed.append(time.time() - start)
+    print "%s: %d hosts, %d switches, %d rules, %.3f sec (best of %d)"%(
+        name, len(topo.get_all_hosts_ip()), len(topo.get_all_switches()), count_rules(rule_set), min(elapsed), repeat)
+
 # Main
 def _print_usage():
     print("Usage:\t python %s set \t- add default paths for CLOUDS-Pi"%(sys.argv[0]))
+    print("      \t python %s sync \t- add, modify, or delete only the default path flows that differ from ODL"%(sys.argv[0]))
     print("      \t python %s del \t- delete all default paths that have been set up with this program"%(sys.argv[0]))
+    print("      \t python %s dry-run <snapshot.json> [rules.json] \t- generate the default paths of a recorded topology without pushing"%(sys.argv[0]))
+    print("      \t python %s diff [snapshot.json] \t- compare the default paths with the flows installed in ODL"%(sys.argv[0]))
+    print("      \t python %s bench [k | snapshot.json ...] \t- benchmark default path generation (default: k=4, 8, 16)"%(sys.argv[0]))
 
 def main():
     if len(sys.argv) < 2:
         _print_usage()
         return
+    if sys.argv[1] == "dry-run" and len(sys.argv) > 2:
+        dry_run(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        return
+    if sys.argv[1] == "bench":
+        import sdcon_mock
+        args = sys.argv[2:]
+        if len(args) == 0:
+            args = ["4", "8", "16"]
+        for arg in args:
+            if arg.isdigit():
+                bench_default_paths(sdcon_mock.generate_fattree_snapshot(int(arg)), "k=%s fat-tree"%(arg))
+            else:
+                bench_default_paths(sdcon_mock.load_snapshot(arg), arg)
+        return
     if ENABLE_SELF_LEARN and os.getuid() != 0:
         print "Self learning mode needs to run with 'root' account! \nPlease change your account, or disable ENABLE_SELF_LEARN in source code."
         return
     
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    if sys.argv[1] == "diff":
+        print_diff(sys.argv[2] if len(sys.argv) > 2 else None)
+        return
+    topo = topo_discovery.get_topo()
     if sys.argv[1] == "set":
         set_default_paths(topo)
+    elif sys.argv[1] == "sync":
+        reconcile_default_paths(topo)
     elif sys.argv[1] == "del":
         del_all_default_paths(topo)
     elif sys.argv[1] == "test":
@@ -299,7 +464,6 @@ def main():
         return
 
 
-
 #####################################################
 # Broadcasting and flooding rules to forward everywhere
 #####################################################
@@ -333,7 +497,8 @@ def add_path_broadcast_core(topo, switch_id):
 
 def add_path_flood(topo, switch_id):
     upports, downports = get_up_down_ports(topo, switch_id)
-    print "Debug: (%s) up/down="%(switch_id), upports, downports
+    if PRINT_DEBUG:
+        print "Debug: (%s) up/down="%(switch_id), upports, downports
     # in = downport, out = upports
     for inport in upports: 
         add_flow_path(switch_id, downports, network_manager.ODL_FLOW_PRIORITY_DEFAULT_PATH,\
@@ -0,0 +1,305 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Congestion-driven dynamic flows.
+# Instead of rerouting every flow in turn at a fixed interval (resource_provisioner.set_dynamic_flows_loop),
+# the controller subscribes to the link utilization samples of network_monitor.SDCLinkMonitor,
+# and reroutes only the flows whose current path crosses a congested link:
+#   - A link becomes congested above DF_THRESHOLD_HIGH of DF_LINK_CAPACITY, and is clear again
+#     only below DF_THRESHOLD_LOW (hysteresis).
+#   - A flow is not rerouted again within DF_FLOW_COOLDOWN seconds.
+#   - A flow moves only to an ECMP path that is less utilized by at least DF_MIN_GAIN.
+# All decisions of a sample are made on the same sample, which is updated with each moved flow,
+# so that several flows do not move to the same path. Paths are changed make-before-break
+# (network_manager.update_path_along_links).
+#
+# A flow is (src_vm_ip, dst_vm_ip, src_compute, dst_compute). Rules match the VM IPs, and sFlow
+# samples of the flow are keyed by the compute IPs ("src_compute,dst_compute"), as in
+# network_manager.create_special_path().
+
+import sys, time
+import network_manager, network_monitor, topo_discovery, sdcon_config
+
+DF_LINK_CAPACITY = 100000000    # bits per sec
+DF_THRESHOLD_HIGH = 0.8         # Ratio of the capacity
+DF_THRESHOLD_LOW = 0.6
+DF_FLOW_COOLDOWN = 30.0         # Seconds
+DF_MIN_GAIN = 0.1               # Ratio of the current path score
+
+class SDCDynamicFlowStats:
+    def __init__(self):
+        self.samples = 0
+        self.congested = 0          # Links that became congested
+        self.candidates = 0         # Flows on a congested link
+        self.reroutes = 0
+        self.skipped_cooldown = 0
+        self.skipped_no_gain = 0
+        self.cpu_time = 0.0         # Seconds of CPU in the controller
+
+    def print_stats(self):
+        print "%d samples, %d links congested, %d flows on congested links: %d rerouted, %d in cooldown, %d without a better path; CPU %.3f sec"%(
+            self.samples, self.congested, self.candidates, self.reroutes, self.skipped_cooldown, self.skipped_no_gain, self.cpu_time)
+
+class SDCDynamicFlowController:
+    def __init__(self, flows, topo_func=None, capacity=None):
+        self.flows = list(flows)
+        self.topo_func = topo_func or topo_discovery.get_topo
+        self.capacity = (capacity or DF_LINK_CAPACITY) / 8.0    # bytes per sec
+        self.current_path = {}      # dict[flow] = path (list of nodes)
+        self.last_reroute = {}      # dict[flow] = sample time of the last reroute
+        self.hot_links = set()      # (switch, port) congested
+        self.stats = SDCDynamicFlowStats()
+
+    def __flow_key(self, flow):
+        return flow[2]+","+flow[3]
+
+    def __find_current_paths(self, topo, sample):
+        # Inferred again on each congested sample from where the sample sees the flows, as a flow may be idle
+        # at first or change its path, except for the flows moved by the controller (known from the reroute).
+        # A flow not seen in the sample keeps its last path, if any.
+        locations = {}  # dict[flow key] = [(switch, inport), ...]
+        for link, flows in sample.flow_bw.items():
+            for key in flows:
+                locations.setdefault(key, []).append(link)
+        for flow in self.flows:
+            if flow not in self.last_reroute and self.__flow_key(flow) in locations:
+                self.current_path[flow] = network_monitor.path_inference.get_path(topo, flow[2], flow[3], locations[self.__flow_key(flow)])
+
+    def __update_hot_links(self, sample):
+        for link, bw in sample.link_bw.items():
+            util = bw / self.capacity
+            if link not in self.hot_links and util > DF_THRESHOLD_HIGH:
+                self.hot_links.add(link)
+                self.stats.congested += 1
+            elif link in self.hot_links and util < DF_THRESHOLD_LOW:
+                self.hot_links.discard(link)
+        for link in list(self.hot_links):
+            if link not in sample.link_bw:
+                self.hot_links.discard(link)
+
+    def __score(self, topo, path, link_bw, exclude):
+        # (max, sum) of the incoming BW along the path, without the flow itself
+        bws = [link_bw.get( (switch, inport), 0.0 ) - exclude.get( (switch, inport), 0.0 )
+            for (inport, switch, outport) in topo.get_switch_port_map(path)]
+        return (max(bws or [0.0]), sum(bws))
+
+    def __move(self, topo, path, new_path, link_bw, flow_bw):
+        # Moves the BW of the flow in the sample from path to new_path.
+        for (inport, switch, outport) in topo.get_switch_port_map(path):
+            link_bw[(switch, inport)] = link_bw.get( (switch, inport), 0.0 ) - flow_bw
+        for (inport, switch, outport) in topo.get_switch_port_map(new_path):
+            link_bw[(switch, inport)] = link_bw.get( (switch, inport), 0.0 ) + flow_bw
+
+    def on_sample(self, sample):
+        start = time.clock()
+        try:
+            self.__on_sample(sample)
+        finally:
+            self.stats.cpu_time += time.clock() - start
+
+    def __on_sample(self, sample):
+        self.stats.samples += 1
+        self.__update_hot_links(sample)
+        if not self.hot_links:
+            return
+        topo = self.topo_func()
+        link_bw = dict(sample.link_bw)
+        self.__find_current_paths(topo, sample)
+        candidates = []
+        for flow in self.flows:
+            path = self.current_path.get(flow)
+            if path and any( (switch, inport) in self.hot_links for (inport, switch, outport) in topo.get_switch_port_map(path) ):
+                candidates.append( (sample.get_flow_bw(self.__flow_key(flow)), flow) )
+        # Largest flows first
+        for flow_bw, flow in sorted(candidates, reverse=True):
+            self.stats.candidates += 1
+            if sample.time - self.last_reroute.get(flow, -DF_FLOW_COOLDOWN) < DF_FLOW_COOLDOWN:
+                self.stats.skipped_cooldown += 1
+                continue
+            path = self.current_path[flow]
+            exclude = dict( ((switch, inport), flow_bw) for (inport, switch, outport) in topo.get_switch_port_map(path) )
+            cur_score = self.__score(topo, path, link_bw, exclude)
+            best_path, best_score = path, cur_score
+            for other in topo.find_all_path(flow[2], flow[3]):
+                score = self.__score(topo, other, link_bw, exclude)
+                if score < best_score:
+                    best_path, best_score = other, score
+            if best_path == path or best_score[0] > cur_score[0] * (1.0 - DF_MIN_GAIN):
+                self.stats.skipped_no_gain += 1
+                continue
+            print "Debug: rerouting %s -> %s: %s => %s"%(flow[0], flow[1],
+                network_manager.path_string_format(path), network_manager.path_string_format(best_path))
+            network_manager.update_path_along_links(topo, best_path, flow[0], flow[1])
+            self.__move(topo, path, best_path, link_bw, flow_bw)
+            self.current_path[flow] = best_path
+            self.last_reroute[flow] = sample.time
+            self.stats.reroutes += 1
+
+    def run(self, monitor=None):
+        # Runs with a link monitor until interrupted.
+        if monitor == None:
+            monitor = network_monitor.SDCLinkMonitor()
+        monitor.subscribe(self.on_sample)
+        monitor.start()
+        try:
+            while True:
+                time.sleep(60)
+                self.stats.print_stats()
+        finally:
+            monitor.stop()
+
+#####################################
+## Benchmark
+#####################################
+def __locate_flow(odl, topo, src_ip, dst_ip):
+    # (switch, inport) of a flow in the mock ODL: special path flows of the pair, or else the first ECMP path.
+    default_next = {}
+    for path in topo.find_all_path(src_ip, dst_ip):
+        for node, next_node in zip(path, path[1:]):
+            default_next.setdefault(node, next_node)
+    dst_mac = topo.host_ip_to_mac[dst_ip]
+    prev, node, hops = topo.host_ip_to_mac[src_ip], topo.get_connected_switch(src_ip), []
+    while node != dst_mac and node != None and len(hops) < 16:
+        hops.append( (node, topo.get_switch_port_to_dst(node, prev)) )
+        next_node = default_next.get(node)
+        for fl in odl.get_flows("openflow:"+node, "0"):
+            rule = network_manager.parse_flow(node, fl)
+            if rule.flowname == network_manager.FLOWNAME_SPECIAL and (rule.match_src_ip, rule.match_dst_ip) == (src_ip, dst_ip):
+                next_node = topo.get_connected_node_via_port(node, rule.action_outport[0])
+        prev, node = node, next_node
+    return hops
+
+def __serve_mocks(snapshot, rates, conn):
+    # Runs a mock ODL and a mock sFlow-RT in a child process, so that their CPU is not counted.
+    import sdcon_mock
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    odl = sdcon_mock.MockODLServer(snapshot)
+    sflow = sdcon_mock.MockSFlowServer(lambda src_ip, dst_ip: __locate_flow(odl, topo, src_ip, dst_ip))
+    for src_ip, dst_ip, rate in rates:
+        sflow.set_rate(src_ip, dst_ip, rate)
+    odl.start()
+    sflow.start()
+    conn.send( (odl.url, sflow.url) )
+    conn.recv()
+    odl.stop()
+    sflow.stop()
+
+def bench_dynamic_flows(k=4, duration=300, num_flows=8):
+    # Simulated 'duration' seconds of dynamic flows on a k-ary fat-tree with two large flows on the same
+    # path and small flows: the round-robin loop (a reroute every 60 / num_flows sec)
+    # vs. the controller (a sample every LINK_MONITOR_INTERVAL sec).
+    import multiprocessing, sdcon_mock, sdcon_rest, network_flow_registry
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    large = DF_LINK_CAPACITY / 8.0 * 0.55
+    rates = [(sdcon_mock.fattree_host_ip(0, 0, 0), sdcon_mock.fattree_host_ip(k-1, 0, 0), large),
+        (sdcon_mock.fattree_host_ip(0, 0, 1), sdcon_mock.fattree_host_ip(k-1, 0, 1), large)]
+    for i in range(num_flows - len(rates)):
+        pod = i % k
+        rates.append( (sdcon_mock.fattree_host_ip(pod, 1, 0), sdcon_mock.fattree_host_ip((pod+1) % k, 1, i % (k/2)), large/12) )
+    flows = [(src_ip, dst_ip, src_ip, dst_ip) for src_ip, dst_ip, rate in rates]
+    print "k=%d fat-tree, %d flows (2 x %.0f Mbps on the same path), %d simulated sec"%(k, len(flows), large*8/1e6, duration)
+
+    url, sflow_url = sdcon_config.ODL_CONTROLLER_URL, sdcon_config.SFLOW_COLLECTOR_URL
+    registry = network_flow_registry.get_registry()
+    results = []
+    for name in ("round-robin loop", "congestion-driven"):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=__serve_mocks, args=(snapshot, rates, child_conn))
+        child.start()
+        sdcon_config.ODL_CONTROLLER_URL, sdcon_config.SFLOW_COLLECTOR_URL = parent_conn.recv()
+        network_flow_registry.set_registry(network_flow_registry.SDCFlowRegistry())
+        network_flow_registry.get_registry().synced = True    # The mock starts without flows
+        try:
+            with sdcon_mock.quiet():
+                network_monitor.start_monitor()
+                sdcon_rest.reset_stats()
+                start = time.clock()
+                if name == "round-robin loop":
+                    interval = 60.0 / len(flows)    # resource_provisioner.DYNAMIC_FLOW_INTERVAL
+                    for i in range(int(duration / interval)):
+                        network_manager.create_special_path(*flows[i % len(flows)][2:] + flows[i % len(flows)][:2])
+                    stats = None
+                else:
+                    controller = SDCDynamicFlowController(flows, topo_func=lambda: topo)
+                    for i in range(int(duration / network_monitor.LINK_MONITOR_INTERVAL)):
+                        sample = network_monitor.get_link_sample()
+                        sample.time = i * network_monitor.LINK_MONITOR_INTERVAL
+                        controller.on_sample(sample)
+                    stats = controller.stats
+                cpu_time = time.clock() - start
+                rest_stats = sdcon_rest.get_stats()
+        finally:
+            sdcon_config.ODL_CONTROLLER_URL, sdcon_config.SFLOW_COLLECTOR_URL = url, sflow_url
+            network_flow_registry.set_registry(registry)
+            parent_conn.send("stop")
+            child.join()
+        flow_mods = sum(s[0] for (method, endpoint), s in rest_stats.items() if method in ("PUT", "PATCH", "DELETE") and "restconf" in endpoint)
+        sflow_calls = sum(s[0] for (method, endpoint), s in rest_stats.items() if method == "GET" and "restconf" not in endpoint)
+        results.append( (name, cpu_time, flow_mods, sflow_calls, stats) )
+    for name, cpu_time, flow_mods, sflow_calls, stats in results:
+        print "  %-18s: controller CPU %6.3f sec, %4d flow-mod requests, %4d sFlow requests"%(name, cpu_time, flow_mods, sflow_calls)
+        if stats:
+            print "  %-18s  "%(""),
+            stats.print_stats()
+
+def test_current_paths(k=4):
+    # A flow idle in the first congested samples, then seen on one ECMP path and later on another:
+    # its path follows the samples. The congested link carries no flow, so nothing is rerouted.
+    import sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    src_ip, dst_ip = sdcon_mock.fattree_host_ip(0, 0, 0), sdcon_mock.fattree_host_ip(k-1, 0, 0)
+    flow = (src_ip, dst_ip, src_ip, dst_ip)
+    paths = topo.find_all_path(src_ip, dst_ip)
+    hot_switch = topo.get_connected_switch(sdcon_mock.fattree_host_ip(1, 0, 0))
+    hot_port = topo.get_switch_port_to_dst(hot_switch, topo.get_host_mac(sdcon_mock.fattree_host_ip(1, 0, 0)))
+    def sample(path, t):
+        switch_port_flow_bw = {hot_switch: [(str(hot_port), [("x,y", DF_LINK_CAPACITY / 8.0)])]}
+        for (inport, switch, outport) in (topo.get_switch_port_map(path) if path else []):
+            switch_port_flow_bw.setdefault(switch, []).append( (str(inport), [(src_ip+","+dst_ip, 1000.0)]) )
+        return network_monitor.SDCLinkSample(switch_port_flow_bw, t)
+    controller = SDCDynamicFlowController([flow], topo_func=lambda: topo)
+    errors = []
+    with sdcon_mock.quiet():
+        # (path seen in the sample, expected current path): an idle flow keeps its last path
+        for i, (path, expected) in enumerate([(None, None), (paths[-1], paths[-1]), (None, paths[-1]), (paths[0], paths[0])]):
+            controller.on_sample(sample(path, i))
+            if controller.current_path.get(flow) != expected:
+                errors.append("sample %d: path %s instead of %s"%(i, controller.current_path.get(flow), expected))
+    if controller.stats.reroutes:
+        errors.append("%d flows rerouted"%(controller.stats.reroutes))
+    print "k=%d fat-tree, a flow idle, then on the last and the first of %d ECMP paths"%(k, len(paths))
+    for error in errors:
+        print "  FAILED: "+error
+    return len(errors) == 0
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s bench [k] \t- compare the round-robin loop with the congestion-driven controller on mock ODL and sFlow-RT (default: k=4)"%(sys.argv[0]))
+    print("      \t python %s test-paths [k] \t- current paths of the flows follow the congested samples (default: k=4)"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "bench":
+        bench_dynamic_flows(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    elif sys.argv[1] == "test-paths":
+        ok = test_current_paths(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+        print "\nCurrent paths: %s"%("OK" if ok else "FAILED")
+        if not ok:
+            sys.exit(1)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Registry of the flow rules installed by SDCon, kept in the process.
+# network_manager records every flow it pushes or deletes, so that questions such as
+# "which rules touch this host pair / this switch port" are answered from memory instead of
+# reading the switch tables back from ODL. A rule is a network_manager.FlowRule
+# (in the JSON snapshot, a dict of network_manager.add_flow() arguments).
+#
+# Each rule is kept by (switch, table_id, flow_id), and indexed by:
+#     match     : (switch, table_id, src_ip, dst_ip, dst_mac, inport)
+#     host pair : (src_ip, dst_ip)
+#     port      : (switch, port), for the inport and the outports
+#     flow-name, priority
+#
+# Set FLOW_REGISTRY_FILE to keep a JSON snapshot of the registry: it is loaded when the registry
+# is created (warm start) and written when the process exits or after each verification.
+# The registry is trusted for deletions (is_synced()) only after a verification against ODL, as flows
+# may be left from an earlier run or changed since the snapshot. The entry points call start_registry(),
+# which verifies it at startup and then periodically.
+
+import sys, os, json, time, threading, atexit, functools, tempfile
+from collections import defaultdict
+import network_manager, network_programmer, topo_discovery, sdcon_config
+
+FLOW_REGISTRY_FILE = None           # e.g. "sdcon_flows.json". None: no snapshot.
+FLOW_REGISTRY_VERIFY_INTERVAL = 300 # Seconds between periodic verifications
+# Flows found in ODL with these names are SDCon's (network_manager.FLOWNAME_*)
+FLOW_REGISTRY_FLOWNAMES = ("sdc-default-path", "sdc-special-path", "sdc-queue-path")
+
+def get_port_number(port):
+    return str(port).split(":")[-1] if port else None   # openflow:40960020:1 -> 1
+
+def get_rule_key(rule):
+    # (switch, table_id, flow_id) of a rule, as the flow is stored in ODL
+    return (rule.switch, str(rule.table_id), rule.flow_id)
+
+def get_match_key(switch, table_id=0, src_ip=None, dst_ip=None, dst_mac=None, inport=None):
+    return (str(switch), str(table_id), src_ip or None, dst_ip or None, dst_mac.lower() if dst_mac else None, get_port_number(inport))
+
+def get_rule_ports(rule):
+    ports = set(rule.action_outport)
+    if rule.match_inport:
+        ports.add(rule.match_inport)
+    return ports
+
+class SDCRegistryReport:
+    def __init__(self):
+        self.missing = []       # (switch, table_id, flow_id) registered but not installed
+        self.modified = []      # (switch, table_id, flow_id) installed with a different content
+        self.unknown = []       # (switch, table_id, flow_id) installed SDCon flows not registered
+        self.tables = 0         # switch tables read
+        self.failed_switches = []
+
+    def is_ok(self):
+        return not (self.missing or self.modified or self.unknown or self.failed_switches)
+
+    def print_report(self, verbose=False):
+        print "Verified %d switch tables: %d missing, %d modified, %d unknown flows, %d failed switches"%(
+            self.tables, len(self.missing), len(self.modified), len(self.unknown), len(self.failed_switches))
+        if verbose:
+            for kind, keys in (("-", self.missing), ("*", self.modified), ("+", self.unknown)):
+                for key in keys:
+                    print "  %s %s table %s: %s"%((kind,) + key)
+
+class SDCFlowRegistry:
+    def __init__(self, file_name=None):
+        self.file_name = file_name
+        self.lock = threading.RLock()
+        self.rules = {}                         # dict[(switch, table_id, flow_id)] = rule
+        self.by_match = defaultdict(set)        # dict[match key] = set of rule keys
+        self.by_ip_pair = defaultdict(set)      # dict[(src_ip, dst_ip)] = set of rule keys
+        self.by_port = defaultdict(set)         # dict[(switch, port)] = set of rule keys
+        self.by_name = defaultdict(set)         # dict[flow-name] = set of rule keys
+        self.by_priority = defaultdict(set)     # dict[priority] = set of rule keys
+        self.synced = False
+        self.changed = False
+        self.verifier = None
+        if file_name:
+            if os.path.exists(file_name):
+                self.load(file_name)
+            atexit.register(self.save_if_changed)
+
+    def __index(self, key, rule):
+        return ((self.by_match, get_match_key(rule.switch, rule.table_id, rule.match_src_ip, rule.match_dst_ip,
+                rule.match_dst_mac, rule.match_inport)),
+            (self.by_ip_pair, (rule.match_src_ip, rule.match_dst_ip)),
+            (self.by_name, rule.flowname),
+            (self.by_priority, rule.priority)) + \
+            tuple((self.by_port, (key[0], port)) for port in get_rule_ports(rule))
+
+    def __add(self, rule):
+        key = get_rule_key(rule)
+        self.__remove(key)
+        self.rules[key] = rule
+        for index, index_key in self.__index(key, rule):
+            index[index_key].add(key)
+
+    def __remove(self, key):
+        rule = self.rules.pop(key, None)
+        if rule == None:
+            return
+        for index, index_key in self.__index(key, rule):
+            index[index_key].discard(key)
+            if not index[index_key]:
+                del index[index_key]
+
+    #####################################
+    ## Updates (called by network_manager)
+    #####################################
+    def register(self, rules):
+        # A rule with the flow ID of a registered rule replaces it, as the flow on the switch.
+        with self.lock:
+            for rule in rules:
+                self.__add(network_manager.FlowRule.from_dict(rule))
+            self.changed = True
+
+    def unregister(self, switch, table_id, flow_ids):
+        with self.lock:
+            for flow_id in flow_ids:
+                self.__remove( (str(switch), str(table_id), str(flow_id)) )
+            self.changed = True
+
+    def clear(self):
+        with self.lock:
+            for key in self.rules.keys():
+                self.__remove(key)
+            self.changed = True
+
+    #####################################
+    ## Queries
+    #####################################
+    def is_synced(self):
+        return self.synced
+
+    def __len__(self):
+        return len(self.rules)
+
+    def get_rule(self, switch, table_id, flow_id):
+        return self.rules.get( (str(switch), str(table_id), str(flow_id)) )
+
+    def lookup(self, switch, table_id=0, src_ip=None, dst_ip=None, dst_mac=None, inport=None):
+        # Rule keys with exactly this match (there can be several priorities or outports).
+        key = get_match_key(switch, table_id, src_ip, dst_ip, dst_mac, inport)
+        with self.lock:
+            return sorted(self.by_match.get(key, ()))
+
+    def find_host_pair(self, src_ip, dst_ip):
+        with self.lock:
+            return sorted(self.by_ip_pair.get( (src_ip, dst_ip), () ))
+
+    def find_switch_port(self, switch, port):
+        with self.lock:
+            return sorted(self.by_port.get( (str(switch), get_port_number(port)), () ))
+
+    def find(self, flowname=None, src_ip=None, dst_ip=None, priority=None, table_id=None, switches=None):
+        # Rule keys matching all given conditions, as network_manager.SDCFlowTableView.find().
+        with self.lock:
+            keys = None
+            for cond, index in ((flowname, self.by_name), ((src_ip, dst_ip) if src_ip and dst_ip else None, self.by_ip_pair),
+                    (int(priority) if priority != None else None, self.by_priority)):
+                if cond != None:
+                    keys = set(index.get(cond, ())) if keys == None else keys & index.get(cond, set())
+            if keys == None:
+                keys = self.rules.keys()
+            if table_id != None:
+                keys = [key for key in keys if key[1] == str(table_id)]
+            if switches != None:
+                switches = set(str(sw) for sw in switches)
+                keys = [key for key in keys if key[0] in switches]
+            return sorted(keys)
+
+    #####################################
+    ## Snapshot
+    #####################################
+    def save(self, file_name=None):
+        file_name = file_name or self.file_name
+        with self.lock:
+            data = {"time": time.time(), "synced": self.synced, "rules": [self.rules[key].as_dict() for key in sorted(self.rules)]}
+            self.changed = False
+        with open(file_name + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.rename(file_name + ".tmp", file_name)
+
+    def save_if_changed(self):
+        if self.file_name and self.changed:
+            self.save()
+
+    def load(self, file_name=None):
+        file_name = file_name or self.file_name
+        with open(file_name) as f:
+            data = json.load(f)
+        with self.lock:
+            self.clear()
+            self.register(data["rules"])
+            self.synced = False     # Until verified: the switches may have changed since the snapshot
+            self.changed = False
+        print "Flow registry: %d rules loaded from %s"%(len(self.rules), file_name)
+
+    #####################################
+    ## Verification against ODL
+    #####################################
+    def __verify_switch(self, switch, tables):
+        return dict( (table_id, network_manager.get_flows(switch, table_id)) for table_id in tables )
+
+    # Compares the registry with the flows installed in ODL. All tables with registered rules are read,
+    # plus 'tables' of all 'switches'. If repair is set, the registry is updated to what is installed,
+    # and it is marked synced if all switches were read.
+    # Returns SDCRegistryReport.
+    def verify(self, switches=(), tables=(0,), repair=False, concurrency=None):
+        with self.lock:
+            switch_tables = defaultdict(set)
+            for switch, table_id, flow_id in self.rules:
+                switch_tables[switch].add(table_id)
+        for switch in switches:
+            switch_tables[str(switch)].update(str(t) for t in tables)
+        jobs = dict( (sw, functools.partial(self.__verify_switch, sw, sorted(t))) for sw, t in switch_tables.items() )
+        program_report = network_programmer.program_switches(jobs, concurrency)
+
+        report = SDCRegistryReport()
+        report.failed_switches = program_report.get_failed_switches()
+        with self.lock:
+            for switch, table_flows in program_report.results.items():
+                if table_flows == None:
+                    continue
+                for table_id, flows in table_flows.items():
+                    report.tables += 1
+                    installed = dict( (str(fl['id']), fl) for fl in flows if fl.get('flow-name') in FLOW_REGISTRY_FLOWNAMES )
+                    registered = set(flow_id for sw, t, flow_id in self.rules if sw == switch and t == table_id)
+                    for flow_id in sorted(registered - set(installed)):
+                        report.missing.append( (switch, table_id, flow_id) )
+                    for flow_id in sorted(set(installed) - registered):
+                        report.unknown.append( (switch, table_id, flow_id) )
+                    for flow_id in sorted(registered & set(installed)):
+                        if self.rules[(switch, table_id, flow_id)] != network_manager.parse_flow(switch, installed[flow_id]):
+                            report.modified.append( (switch, table_id, flow_id) )
+                    if repair:
+                        adopted = (set(installed) - registered) | set(key[2] for key in report.modified if key[:2] == (switch, table_id))
+                        self.unregister(switch, table_id, registered - set(installed))
+                        self.register([network_manager.parse_flow(switch, installed[flow_id]) for flow_id in adopted])
+            if repair and not report.failed_switches and switches:
+                self.synced = True
+        return report
+
+    def __verify_loop(self, topo_func, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                report = self.verify(topo_func().get_all_switches(), repair=True)
+                if not report.is_ok():
+                    report.print_report()
+                self.save_if_changed()
+            except Exception as e:
+                print "Error: flow registry verification failed:", e
+
+    def start_verifier(self, interval=None, topo_func=None):
+        # Verifies and repairs the registry every 'interval' sec in a background thread.
+        if self.verifier != None:
+            return
+        self.verifier = threading.Thread(target=self.__verify_loop,
+            args=(topo_func or topo_discovery.get_topo, interval or FLOW_REGISTRY_VERIFY_INTERVAL))
+        self.verifier.daemon = True
+        self.verifier.start()
+
+__registry = None
+__registry_lock = threading.Lock()
+
+# Returns the process-wide registry, loaded from FLOW_REGISTRY_FILE if it exists.
+def get_registry():
+    global __registry
+    with __registry_lock:
+        if __registry == None:
+            __registry = SDCFlowRegistry(FLOW_REGISTRY_FILE)
+        return __registry
+
+def set_registry(registry):
+    global __registry
+    with __registry_lock:
+        __registry = registry
+
+# Verifies and repairs the process-wide registry against all switches, so that it is trusted from the
+# start (after a warm start or not), then keeps verifying it in the background. Called by the entry points.
+# Returns SDCRegistryReport of the startup verification.
+def start_registry(topo_func=None, interval=None):
+    registry = get_registry()
+    topo_func = topo_func or topo_discovery.get_topo
+    report = registry.verify(topo_func().get_all_switches(), repair=True)
+    if not report.is_ok():
+        report.print_report()
+    registry.save_if_changed()
+    registry.start_verifier(interval, topo_func)
+    return report
+
+#####################################
+## Benchmark
+#####################################
+def bench_registry(k=4, latency=0.002, num_queries=200):
+    # "Which rules touch this host pair?" answered from the registry vs. reading the tables from a mock ODL.
+    import random, sdcon_mock, network_defpath
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    rule_set = network_defpath.get_default_rules(topo)
+    hosts = topo.get_all_hosts_ip()
+    random.seed(0)
+    pairs = [tuple(random.sample(hosts, 2)) for i in range(num_queries)]
+
+    url = sdcon_config.ODL_CONTROLLER_URL
+    registry = get_registry()
+    server = sdcon_mock.MockODLServer(snapshot, latency=latency)
+    server.start()
+    sdcon_config.ODL_CONTROLLER_URL = server.url
+    set_registry(SDCFlowRegistry())
+    try:
+        with sdcon_mock.quiet():
+            network_manager.add_flows([rule for sw in rule_set for t in rule_set[sw] for rule in rule_set[sw][t].values()])
+            for i, (src_ip, dst_ip) in enumerate(pairs):
+                network_manager.add_flow(topo.get_connected_switch(src_ip), "1", network_manager.ODL_FLOW_PRIORITY_SPECIAL_PATH,
+                    match_src_ip=src_ip, match_dst_ip=dst_ip, flowname=network_manager.FLOWNAME_SPECIAL)
+            start = time.time()
+            found_registry = [get_registry().find_host_pair(src_ip, dst_ip) for src_ip, dst_ip in pairs]
+            registry_time = (time.time() - start) / num_queries
+
+            server.reset_counters()
+            start = time.time()
+            found_view = []
+            for src_ip, dst_ip in pairs[:max(num_queries/10, 1)]:
+                view = network_manager.SDCFlowTableView(topo.get_all_switches(), 0)
+                found_view.append(view.find(src_ip=src_ip, dst_ip=dst_ip))
+            scan_time = (time.time() - start) / len(found_view)
+            num_gets = server.get_request_count("GET") / len(found_view)
+            verify_report = get_registry().verify(topo.get_all_switches(), tables=network_defpath.DEFAULT_PATH_TABLES)
+
+            # Warm start from a snapshot, with a flow added after it: trusted only once verified
+            file_name = tempfile.mktemp(suffix=".json")
+            get_registry().save(file_name)
+            network_manager.add_flow(topo.get_connected_switch(pairs[0][0]), "2", network_manager.ODL_FLOW_PRIORITY_SPECIAL_PATH,
+                match_src_ip=pairs[0][0], match_dst_ip=pairs[0][1], flowname=network_manager.FLOWNAME_SPECIAL)
+            warm = SDCFlowRegistry(file_name)
+            synced_on_load = warm.is_synced()
+            set_registry(warm)
+            start_report = start_registry(lambda: topo, interval=3600)
+            os.remove(file_name)
+            warm_ok = not synced_on_load and warm.is_synced() and len(start_report.unknown) == 1
+    finally:
+        sdcon_config.ODL_CONTROLLER_URL = url
+        set_registry(registry)
+        server.stop()
+    same = all([(key[0], key[2]) for key in a] == b for a, b in zip(found_registry, found_view))
+    print "k=%d fat-tree: %d registered rules, %d host pair queries, mock ODL latency %.1f ms"%(
+        k, network_defpath.count_rules(rule_set) + num_queries, num_queries, latency*1000)
+    print "  table scan : %10.3f ms per query (%d GETs)"%(scan_time*1000, num_gets)
+    print "  registry   : %10.3f ms per query, same answers: %s"%(registry_time*1000, same)
+    verify_report.print_report()
+    print "  warm start : synced when loaded: %s, after the startup verification: %s (%d unknown flows adopted): %s"%(
+        synced_on_load, warm.is_synced(), len(start_report.unknown), "OK" if warm_ok else "FAILED")
+    return warm_ok
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s verify <registry_file> \t- verify the registry snapshot against ODL and repair it"%(sys.argv[0]))
+    print("      \t python %s dump <registry_file> \t- print the rules in a registry snapshot"%(sys.argv[0]))
+    print("      \t python %s bench [k] \t- host pair queries from the registry vs. table scans on a mock ODL (default: k=4)"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "verify" and len(sys.argv) > 2:
+        registry = SDCFlowRegistry(sys.argv[2])
+        report = registry.verify(topo_discovery.get_topo().get_all_switches(), repair=True)
+        report.print_report(verbose=True)
+        registry.save()
+    elif sys.argv[1] == "dump" and len(sys.argv) > 2:
+        registry = SDCFlowRegistry()
+        registry.load(sys.argv[2])
+        for key in sorted(registry.rules):
+            print "%s table %s: %s"%(key[0], key[1], key[2])
+    elif sys.argv[1] == "bench":
+        if not bench_registry(int(sys.argv[2]) if len(sys.argv) > 2 else 4):
+            sys.exit(1)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    # Run in the module that network_manager imports, so that both use the same registry.
+    import network_flow_registry
+    network_flow_registry.main()
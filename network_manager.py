@@ -20,9 +20,10 @@
 import requests
 from requests.auth import HTTPBasicAuth
 import json
-import sys
+import sys, time, functools
+from collections import OrderedDict, defaultdict, namedtuple
 import networkx
-import network_monitor, topo_discovery, network_defpath
+import network_monitor, network_programmer, network_flow_registry, network_payload, topo_discovery, network_defpath, sdcon_config, sdcon_rest
 
 ODL_FLOW_PRIORITY_DEFAULT_PATH = 5
 ODL_FLOW_PRIORITY_DEFAULT_PATH_ARP      = ODL_FLOW_PRIORITY_DEFAULT_PATH+3
@@ -37,87 +38,31 @@ FLOWNAME_DEFAULT        = "sdc-default-path"
 FLOWNAME_SPECIAL        = "sdc-special-path"
 FLOWNAME_SPECIAL_QUEUE  = "sdc-queue-path"
 
+# Special paths are changed make-before-break (update_path_along_links). Set False to overwrite
+# the rules in the path order as before (add_path_along_links).
+PATH_UPDATE_MAKE_BEFORE_BREAK = True
+
+# Bulk installation (add_flows): flows of a switch table are pushed in yang-patch requests
+# of up to FLOW_BATCH_SIZE flows. Disable it for controllers without yang-patch support.
+ENABLE_FLOW_BATCH = True
+FLOW_BATCH_SIZE = 1000
+
 ## Raw REST API call to ODL
+# Flow XML, built by network_payload (cached for the rules pushed before).
 def generate_xml_flow_rule(flow_id, action_outport, priority, action_queue=None, action_table=None,
     match_inport=None, match_src_ip=None, match_dst_ip=None, 
     match_src_mac=None, match_dst_mac=None, match_is_arp=False,
     table_id=0, flowname='Default'):
-    xml = '''<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"no\"?>
-        <flow xmlns=\"urn:opendaylight:flow:inventory\">
-            <priority>'''+str(priority)+'''</priority>
-            <flow-name>'''+str(flowname)+'''</flow-name>
-            <match>'''
-    if match_src_ip or match_dst_ip or match_src_mac or match_dst_mac or match_is_arp:
-        xml +='<ethernet-match>'
-    if match_src_ip or match_dst_ip:
-        xml +='<ethernet-type><type>2048</type></ethernet-type>'
-    elif match_is_arp:
-        xml +='<ethernet-type><type>2054</type></ethernet-type>'
-    if match_src_mac:
-        xml +='<ethernet-source><address>'+ str(match_src_mac)+'</address></ethernet-source>'
-    if match_dst_mac:
-        xml +='<ethernet-destination><address>'+ str(match_dst_mac)+'</address></ethernet-destination>'        
-    if match_src_ip or match_dst_ip or match_src_mac or match_dst_mac or match_is_arp:
-        xml +='</ethernet-match>'
-            
-    if match_inport:
-        xml +='<in-port>'+ str(match_inport)+'</in-port>'
-    if match_src_ip:
-        xml +='<ipv4-source>' + str(match_src_ip)+'/32</ipv4-source>'
-    if match_dst_ip:
-        xml +='<ipv4-destination>' + str(match_dst_ip)+'/32</ipv4-destination>'
-    action_order = 0
-    xml += '''
-            </match>
-            <id>'''+str(flow_id)+'''</id>
-            <table_id>'''+str(table_id)+'''</table_id>
-            <instructions>'''
-    if action_queue or action_outport:
-        xml +='''<instruction><order>0</order>
-                <apply-actions>'''
-    if action_queue:
-        xml += '''
-                    <action><order>'''+str(action_order)+'''</order>
-                        <set-queue-action>
-                        <queue-id>''' + str(action_queue) +'''</queue-id>
-                        </set-queue-action>
-                    </action>'''
-        action_order += 1
-    if action_outport:
-        if type(action_outport) != list:
-            action_outport = [action_outport]
-        for outport in action_outport:
-            xml += '''
-                    <action><order>'''+str(action_order)+'''</order>
-                        <output-action>
-                        <output-node-connector>''' + str(outport) +'''</output-node-connector>
-                        <max-length>65535</max-length>
-                        </output-action>
-                    </action>'''
-            action_order += 1
-    
-    if action_queue or action_outport:
-        xml +='''</apply-actions>
-                </instruction>'''
-
-    if action_table:
-        xml += '''
-                <instruction>
-                    <order>1</order>
-                    <go-to-table>
-                        <table_id>'''+str(action_table)+'''</table_id>
-                    </go-to-table>
-                </instruction>'''        
-    xml +='''</instructions>
-        </flow>'''
-        #print(xmlSrcToDst)
-    return xml
+    return network_payload.flow_xml(flow_id, action_outport, priority, action_queue=action_queue, action_table=action_table,
+        match_inport=match_inport, match_src_ip=match_src_ip, match_dst_ip=match_dst_ip,
+        match_src_mac=match_src_mac, match_dst_mac=match_dst_mac, match_is_arp=match_is_arp,
+        table_id=table_id, flowname=flowname)
 
 
 def push_flow_raw(base_url, id, pw, openflow_node, table_id, flow_id, xml):
     url = base_url + '/restconf/config/opendaylight-inventory:nodes/node/openflow:' \
         + openflow_node+'/table/' + table_id + '/flow/' + flow_id
-    response = requests.put(url, data=xml, auth=HTTPBasicAuth(id, pw), \
+    response = sdcon_rest.put(url, data=xml, auth=HTTPBasicAuth(id, pw), \
         headers={"Accept": "application/json", "Content-Type" : "application/xml"})
     if response.status_code != 200 and response.status_code != 201:
         print url
@@ -125,10 +70,36 @@ def push_flow_raw(base_url, id, pw, openflow_node, table_id, flow_id, xml):
         print response.json()
         response.raise_for_status()
 
+# Sends a yang-patch of a switch table. edits = [(operation, flow_id, flow xml or None), ...]
+# Returns False if ODL refused the patch (nothing is applied then, as a patch is one transaction).
+def patch_flows_raw(base_url, id, pw, openflow_node, table_id, edits):
+    url = base_url + '/restconf/config/opendaylight-inventory:nodes/node/openflow:' \
+        + openflow_node+'/table/' + table_id
+    xml = network_payload.flows_patch_xml('sdc-'+openflow_node+'-'+table_id, edits)
+    try:
+        response = sdcon_rest.patch(url, data=xml, auth=HTTPBasicAuth(id, pw), \
+            headers={"Accept": "application/yang.patch-status+json", "Content-Type" : "application/yang.patch+xml"})
+    except requests.exceptions.RequestException as e:
+        print "Cannot patch flows in batch...", openflow_node, table_id, e
+        return False
+    if response.status_code != 200 and response.status_code != 204:
+        print "Cannot patch flows in batch...", openflow_node, table_id, response.status_code
+        return False
+    return True
+
+# Pushes many flows of a switch table in one yang-patch request. flows = [(flow_id, xml), ...]
+def push_flows_raw(base_url, id, pw, openflow_node, table_id, flows):
+    return patch_flows_raw(base_url, id, pw, openflow_node, table_id, [("replace", flow_id, xml) for flow_id, xml in flows])
+
+# Deletes many flows of a switch table in one yang-patch request.
+def del_flows_raw(base_url, id, pw, openflow_node, table_id, flow_ids):
+    print "Deleting %d flows from %s table %s."%(len(flow_ids), openflow_node, table_id)
+    return patch_flows_raw(base_url, id, pw, openflow_node, table_id, [("delete", flow_id, None) for flow_id in flow_ids])
+
 def get_flows_raw(baseUrl, id, pw, openflow_node, table_id):
     # Debug: ODL_CONTROLLER_URL/restconf/config/opendaylight-inventory:nodes/node/openflow:40960000/table/0
     url = baseUrl + '/restconf/config/opendaylight-inventory:nodes/node/openflow:' + openflow_node+'/table/' + str(table_id)
-    response = requests.get(url, auth=HTTPBasicAuth(id, pw), \
+    response = sdcon_rest.get(url, auth=HTTPBasicAuth(id, pw), \
         headers={"Accept": "application/json"})
     if response.status_code != 200:
         print response.json()
@@ -140,7 +111,7 @@ def del_flow_raw(baseUrl, id, pw, openflow_node, table_id, flow_id):
     print "Deleting flow %s from %s."%(flow_id, openflow_node)
     
     url = baseUrl + '/restconf/config/opendaylight-inventory:nodes/node/openflow:' + openflow_node+'/table/' + str(table_id) + '/flow/' + str(flow_id)
-    response = requests.delete(url, auth=HTTPBasicAuth(id, pw),  headers={"Accept": "application/json"})
+    response = sdcon_rest.delete(url, auth=HTTPBasicAuth(id, pw),  headers={"Accept": "application/json"})
     if response.status_code != 200:
         print response.json()
         response.raise_for_status()
@@ -148,7 +119,7 @@ def del_flow_raw(baseUrl, id, pw, openflow_node, table_id, flow_id):
 def get_all_nodes_raw(baseUrl, id, pw,):
     # Debug:  "ODL_CONTROLLER_URL/restconf/operational/opendaylight-inventory:nodes/
     url = baseUrl + '/restconf/operational/opendaylight-inventory:nodes/'
-    response = requests.get(url, auth=HTTPBasicAuth(id, pw), \
+    response = sdcon_rest.get(url, auth=HTTPBasicAuth(id, pw), \
         headers={"Accept": "application/json"})
     if response.status_code != 200:
         print response.json()
@@ -183,25 +154,225 @@ def __generate_flow_id(outport, dst_mac=None, inport=None, src_ip=None, dst_ip=N
     flow_id = flow_id.replace("/", DELIM)
     return flow_id
 
+# Flow ID that add_flow() uses for a rule, e.g. get_flow_id(**rule) for a dict of add_flow() arguments.
+# A rule can give its flow ID, to modify an installed flow in place.
+def get_flow_id(action_outport, match_inport=None, match_src_ip=None, match_dst_ip=None, \
+    match_dst_mac=None, action_table=None, flow_id=None, **kwargs):
+    if flow_id:
+        return flow_id
+    return __generate_flow_id(action_outport, dst_mac=match_dst_mac, \
+        inport=match_inport, src_ip=match_src_ip, dst_ip=match_dst_ip, \
+        action_table=action_table)
+
+# A flow rule as a value: immutable and hashable, with its values in the form ODL keeps them
+# (what generate_xml_flow_rule() writes and a flow table read returns), so that a generated rule and
+# the same rule read back from ODL are equal. Rules can be put in sets and used as dict keys, e.g. the
+# flows to add and to delete are the differences of the sets of desired and installed rules.
+#     rule = FlowRule.make(switch, "2", ODL_FLOW_PRIORITY_SPECIAL_PATH, match_src_ip=src_ip, match_dst_ip=dst_ip)
+#     rule == FlowRule.from_odl(switch, rule.to_odl())
+# Ports are port numbers (openflow:40960020:1 -> 1), MACs are in lowercase, action_outport is a tuple
+# and empty values are None. The flow ID is set when the rule is made, as add_flow() gives it.
+class FlowRule(namedtuple("FlowRule", ["switch", "table_id", "flow_id", "priority", "flowname",
+        "match_inport", "match_src_ip", "match_dst_ip", "match_src_mac", "match_dst_mac", "match_is_arp",
+        "action_outport", "action_queue", "action_table"])):
+    __slots__ = ()
+
+    # Same arguments as add_flow().
+    @classmethod
+    def make(cls, switch, action_outport, priority, action_queue=None, action_table=None,\
+        match_inport=None, match_src_ip=None, match_dst_ip=None, \
+        match_src_mac=None, match_dst_mac=None, match_is_arp=False,\
+        table_id=0, flowname='Default', flow_id=None):
+        def value(v):
+            return str(v) if v else None    # Empty values are not written to the flow
+        def port(v):
+            return str(v).split(":")[-1] if v else None    # openflow:40960020:1 -> 1
+        def mac(v):
+            return str(v).lower() if v else None
+        if type(action_outport) not in (list, tuple):
+            action_outport = [action_outport] if action_outport else []
+        action_outport = tuple(port(p) for p in action_outport)
+        match_inport, match_src_ip, match_dst_ip = port(match_inport), value(match_src_ip), value(match_dst_ip)
+        match_dst_mac, action_table = mac(match_dst_mac), value(action_table)
+        flow_id = get_flow_id(list(action_outport), match_inport=match_inport, match_src_ip=match_src_ip,
+            match_dst_ip=match_dst_ip, match_dst_mac=match_dst_mac, action_table=action_table, flow_id=flow_id)
+        return cls(str(switch), int(table_id), str(flow_id), int(priority), str(flowname),
+            match_inport, match_src_ip, match_dst_ip, mac(match_src_mac), match_dst_mac,
+            bool(match_is_arp) and not (match_src_ip or match_dst_ip),
+            action_outport, value(action_queue), action_table)
+
+    # A rule given as a dict of add_flow() arguments (e.g. loaded from JSON), or a FlowRule.
+    @classmethod
+    def from_dict(cls, rule):
+        if not isinstance(rule, dict):
+            return rule     # Not isinstance(rule, cls): the module may also be loaded as __main__
+        return cls.make(**dict( (str(k), v) for k, v in rule.items() ))
+
+    # Converts a flow read from ODL (JSON of a flow table) into a rule.
+    @classmethod
+    def from_odl(cls, switch, flow):
+        match = flow.get('match', {})
+        eth_match = match.get('ethernet-match', {})
+        eth_type = eth_match.get('ethernet-type', {}).get('type')
+        outports, queue, goto_table = [], None, None
+        for inst in sorted(flow.get('instructions', {}).get('instruction', []), key=lambda x: x.get('order', 0)):
+            for action in sorted(inst.get('apply-actions', {}).get('action', []), key=lambda x: x.get('order', 0)):
+                if 'output-action' in action:
+                    outports.append(action['output-action']['output-node-connector'])
+                elif 'set-queue-action' in action:
+                    queue = action['set-queue-action']['queue-id']
+            if 'go-to-table' in inst:
+                goto_table = inst['go-to-table']['table_id']
+        def ip(addr):
+            return addr.split('/')[0] if addr else None
+        return cls.make(switch, outports, flow.get('priority', 0), action_queue=queue, action_table=goto_table,
+            match_inport=match.get('in-port'),
+            match_src_ip=ip(match.get('ipv4-source')), match_dst_ip=ip(match.get('ipv4-destination')),
+            match_src_mac=eth_match.get('ethernet-source', {}).get('address'),
+            match_dst_mac=eth_match.get('ethernet-destination', {}).get('address'),
+            match_is_arp=(eth_type == 2054),
+            table_id=flow.get('table_id', 0), flowname=flow.get('flow-name', 'Default'), flow_id=flow['id'])
+
+    # The flow as ODL returns it in a flow table (JSON), i.e. how the XML of to_xml() is stored.
+    def to_odl(self):
+        match = OrderedDict()
+        is_ip = self.match_src_ip or self.match_dst_ip
+        if is_ip or self.match_src_mac or self.match_dst_mac or self.match_is_arp:
+            eth_match = match['ethernet-match'] = OrderedDict()
+            if is_ip or self.match_is_arp:
+                eth_match['ethernet-type'] = {'type': 2048 if is_ip else 2054}
+            if self.match_src_mac:
+                eth_match['ethernet-source'] = {'address': self.match_src_mac}
+            if self.match_dst_mac:
+                eth_match['ethernet-destination'] = {'address': self.match_dst_mac}
+        if self.match_inport:
+            match['in-port'] = self.match_inport
+        if self.match_src_ip:
+            match['ipv4-source'] = self.match_src_ip + '/32'
+        if self.match_dst_ip:
+            match['ipv4-destination'] = self.match_dst_ip + '/32'
+        instructions = []
+        actions = []
+        if self.action_queue:
+            actions.append({'order': 0, 'set-queue-action': {'queue-id': int(self.action_queue)}})
+        for outport in self.action_outport:
+            actions.append({'order': len(actions), 'output-action': {'output-node-connector': outport, 'max-length': 65535}})
+        if actions:
+            instructions.append({'order': 0, 'apply-actions': {'action': actions}})
+        if self.action_table:
+            instructions.append({'order': 1, 'go-to-table': {'table_id': int(self.action_table)}})
+        return OrderedDict([('id', self.flow_id), ('priority', self.priority), ('flow-name', self.flowname),
+            ('match', match), ('table_id', self.table_id), ('instructions', {'instruction': instructions})])
+
+    def to_xml(self):
+        return network_payload.flow_xml(self.flow_id, self.action_outport, self.priority,
+            action_queue=self.action_queue, action_table=self.action_table, match_inport=self.match_inport,
+            match_src_ip=self.match_src_ip, match_dst_ip=self.match_dst_ip,
+            match_src_mac=self.match_src_mac, match_dst_mac=self.match_dst_mac,
+            match_is_arp=self.match_is_arp, table_id=self.table_id, flowname=self.flowname)
+
+    # add_flow() arguments, e.g. to save the rule in JSON.
+    def as_dict(self):
+        rule = dict(self._asdict())
+        rule["action_outport"] = list(self.action_outport)
+        return rule
+
+    # The content of the rule without its switch and flow ID.
+    def get_key(self):
+        return (self.table_id,) + self[3:]
+
+# Returns (table_id, flow_id, xml) of a flow to push.
+def generate_flow(switch, action_outport, priority, action_queue=None, action_table=None,\
+    match_inport=None, match_src_ip=None, match_dst_ip=None, \
+    match_src_mac=None, match_dst_mac=None, match_is_arp=False,\
+    table_id=0, flowname='Default', flow_id=None):
+    rule = FlowRule.make(switch, action_outport, priority,
+        action_queue=action_queue, action_table=action_table, match_inport=match_inport,
+        match_src_ip=match_src_ip, match_dst_ip=match_dst_ip,
+        match_src_mac=match_src_mac, match_dst_mac=match_dst_mac,
+        match_is_arp=match_is_arp, table_id=table_id, flowname=flowname, flow_id=flow_id)
+    return str(rule.table_id), rule.flow_id, rule.to_xml()
+
 def add_flow(switch, action_outport, priority, action_queue=None, action_table=None,\
     match_inport=None, match_src_ip=None, match_dst_ip=None, \
     match_src_mac=None, match_dst_mac=None, match_is_arp=False,\
-    table_id=0, flowname='Default'):
-    
-    flow_id = __generate_flow_id(action_outport, dst_mac=match_dst_mac, \
-        inport=match_inport, src_ip=match_src_ip, dst_ip=match_dst_ip, \
-        action_table=action_table)
-    
-    print "Adding flow to %s prio %d match(inport:%s, src_ip:%s, dst_ip:%s, src_mac:%s, dst_mac:%s) -> action=outport(%s,%s,%s)" \
-        % (switch, priority, match_inport, match_src_ip, match_dst_ip, match_src_mac, match_dst_mac, str(action_outport),action_queue, str(action_table)) 
-    xml = generate_xml_flow_rule(flow_id, action_outport, priority, 
+    table_id=0, flowname='Default', flow_id=None):
+    push_flow(FlowRule.make(switch, action_outport, priority,
         action_queue=action_queue, action_table=action_table, match_inport=match_inport,
-        match_src_ip=match_src_ip, match_dst_ip=match_dst_ip, 
+        match_src_ip=match_src_ip, match_dst_ip=match_dst_ip,
         match_src_mac=match_src_mac, match_dst_mac=match_dst_mac,
-        match_is_arp=match_is_arp, table_id=table_id, flowname=flowname)
-    push_flow_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, 
-        switch, str(table_id), str(flow_id), xml)
+        match_is_arp=match_is_arp, table_id=table_id, flowname=flowname, flow_id=flow_id))
 
+# Installs a flow rule (FlowRule) with one PUT.
+def push_flow(rule):
+    print "Adding flow to %s prio %d match(inport:%s, src_ip:%s, dst_ip:%s, src_mac:%s, dst_mac:%s) -> action=outport(%s,%s,%s)" \
+        % (rule.switch, rule.priority, rule.match_inport, rule.match_src_ip, rule.match_dst_ip, rule.match_src_mac, rule.match_dst_mac,
+        ",".join(rule.action_outport), rule.action_queue, str(rule.action_table))
+    push_flow_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, 
+        rule.switch, str(rule.table_id), rule.flow_id, rule.to_xml())
+    network_flow_registry.get_registry().register([rule])
+
+# Installs many flows: rules is a list of FlowRules (or dicts of add_flow() arguments).
+# Flows are grouped by switch and table, and each group is pushed with one request
+# (at most FLOW_BATCH_SIZE flows). A group falls back to one PUT per flow if the batch fails.
+# Returns the number of (batch requests, flows pushed one by one).
+def add_flows(rules):
+    groups = OrderedDict()    # dict[(switch, table_id)] = OrderedDict[flow_id] = (xml, rule)
+    for rule in rules:
+        rule = FlowRule.from_dict(rule)
+        group = groups.setdefault((rule.switch, str(rule.table_id)), OrderedDict())
+        group.pop(rule.flow_id, None)    # The last rule of the same flow ID wins, as with add_flow()
+        group[rule.flow_id] = (rule.to_xml(), rule)
+    
+    num_batches, num_single = 0, 0
+    for (switch, table_id), group in groups.items():
+        flows = group.items()
+        for i in range(0, len(flows), FLOW_BATCH_SIZE):
+            batch = flows[i:i+FLOW_BATCH_SIZE]
+            if ENABLE_FLOW_BATCH and push_flows_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW,
+                    switch, table_id, [(flow_id, xml) for flow_id, (xml, rule) in batch]):
+                num_batches += 1
+            else:
+                print "Pushing %d flows one by one to %s table %s"%(len(batch), switch, table_id)
+                for flow_id, (xml, rule) in batch:
+                    push_flow_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, 
+                        switch, table_id, flow_id, xml)
+                    num_single += 1
+            network_flow_registry.get_registry().register([rule for flow_id, (xml, rule) in batch])
+    print "Added %d flows to %d switch tables: %d batch requests, %d single requests"%(
+        sum(len(g) for g in groups.values()), len(groups), num_batches, num_single)
+    return num_batches, num_single
+
+# Deletes flows of a switch table in batches, or one by one if a batch fails.
+# Returns the number of (batch requests, flows deleted one by one).
+def del_flows(switch, table_id, flow_ids):
+    num_batches, num_single = 0, 0
+    flow_ids = list(flow_ids)
+    for i in range(0, len(flow_ids), FLOW_BATCH_SIZE):
+        batch = flow_ids[i:i+FLOW_BATCH_SIZE]
+        if ENABLE_FLOW_BATCH and del_flows_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW,
+                switch, str(table_id), batch):
+            num_batches += 1
+        else:
+            for flow_id in batch:
+                try:
+                    del_flow_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, table_id, flow_id)
+                except requests.exceptions.HTTPError as e:
+                    # Already deleted, e.g. by a batch that ODL applied before the request failed.
+                    if e.response == None or e.response.status_code != 404:
+                        raise
+                num_single += 1
+        network_flow_registry.get_registry().unregister(switch, table_id, batch)
+    return num_batches, num_single
+
+# Converts a flow read from ODL (JSON) into a rule (FlowRule).
+def parse_flow(switch, flow):
+    return FlowRule.from_odl(switch, flow)
+
+# Returns the content of a rule (FlowRule or dict of add_flow() arguments) as ODL keeps it,
+# so that a rule and a flow read back from ODL can be compared.
+def get_flow_key(rule):
+    return FlowRule.from_dict(rule).get_key()
 
 def get_flows(sw, table_id):
     data = get_flows_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, sw, table_id)
@@ -213,32 +384,110 @@ def get_flows(sw, table_id):
                 break
     return flows
 
+# Flows of a table in many switches, read from ODL once (in parallel) and indexed by
+# flow-name, (src_ip, dst_ip) and priority. Deleting flows through the view keeps the indexes in sync.
+#     view = SDCFlowTableView(topo.get_all_switches(), table_id=0)
+#     view.delete(view.find(flowname=FLOWNAME_SPECIAL_QUEUE, src_ip=src_ip, dst_ip=dst_ip))
+class SDCFlowTableView:
+    def __init__(self, switches, table_id="0", concurrency=None):
+        self.table_id = str(table_id)
+        self.flows = {}                         # dict[(switch, flow_id)] = flow
+        self.by_name = defaultdict(set)         # dict[flow-name] = set of (switch, flow_id)
+        self.by_ip_pair = defaultdict(set)      # dict[(src_ip, dst_ip)] = set of (switch, flow_id)
+        self.by_priority = defaultdict(set)     # dict[priority] = set of (switch, flow_id)
+        self.concurrency = concurrency
+        self.load(switches)
+    
+    def load(self, switches):
+        jobs = dict( (sw, functools.partial(get_flows, sw, self.table_id)) for sw in switches )
+        report = network_programmer.program_switches(jobs, self.concurrency)
+        for sw, flows in report.results.items():
+            for fl in flows or []:
+                self.__add(sw, fl)
+    
+    def __ip_pair(self, fl):
+        match = fl.get('match', {})
+        if 'ipv4-source' in match and 'ipv4-destination' in match:
+            return (match['ipv4-source'].split('/')[0], match['ipv4-destination'].split('/')[0])
+        return None
+    
+    def __add(self, sw, fl):
+        key = (sw, fl['id'])
+        self.flows[key] = fl
+        self.by_name[fl.get('flow-name')].add(key)
+        self.by_priority[fl.get('priority')].add(key)
+        ip_pair = self.__ip_pair(fl)
+        if ip_pair:
+            self.by_ip_pair[ip_pair].add(key)
+    
+    def __remove(self, key):
+        fl = self.flows.pop(key)
+        self.by_name[fl.get('flow-name')].discard(key)
+        self.by_priority[fl.get('priority')].discard(key)
+        ip_pair = self.__ip_pair(fl)
+        if ip_pair:
+            self.by_ip_pair[ip_pair].discard(key)
+    
+    def get_flow(self, switch, flow_id):
+        return self.flows.get( (switch, flow_id) )
+    
+    # Returns a sorted list of (switch, flow_id) matching all given conditions.
+    def find(self, flowname=None, src_ip=None, dst_ip=None, priority=None, switch=None):
+        keys = None
+        for cond, index in ((flowname, self.by_name), ((src_ip, dst_ip) if src_ip and dst_ip else None, self.by_ip_pair),
+                (priority, self.by_priority)):
+            if cond != None:
+                keys = index.get(cond, set()) if keys == None else keys & index.get(cond, set())
+        if keys == None:
+            keys = self.flows.keys()
+        if switch != None:
+            keys = [key for key in keys if key[0] == switch]
+        return sorted(keys)
+    
+    # Deletes flows given as (switch, flow_id): one batch per switch, switches in parallel.
+    # Returns network_programmer.SDCProgramReport.
+    def delete(self, keys):
+        switch_flows = defaultdict(list)
+        for sw, flow_id in set(keys):
+            switch_flows[sw].append(flow_id)
+        jobs = dict( (sw, functools.partial(del_flows, sw, self.table_id, sorted(flow_ids))) for sw, flow_ids in switch_flows.items() )
+        report = network_programmer.program_switches(jobs, self.concurrency)
+        for sw, flow_ids in switch_flows.items():
+            if sw not in report.switch_error:
+                for flow_id in flow_ids:
+                    self.__remove( (sw, flow_id) )
+        return report
+
+# Deletes flows given as (switch, table_id, flow_id), e.g. from the flow registry:
+# one batch per switch table, switches in parallel. Returns network_programmer.SDCProgramReport.
+def del_registered_flows(keys, concurrency=None):
+    switch_flows = defaultdict(lambda: defaultdict(list))  # dict[switch][table_id] = list of flow_id
+    for sw, table_id, flow_id in set(keys):
+        switch_flows[sw][table_id].append(flow_id)
+    def del_switch_flows(sw):
+        for table_id in sorted(switch_flows[sw]):
+            del_flows(sw, table_id, sorted(switch_flows[sw][table_id]))
+    jobs = dict( (sw, functools.partial(del_switch_flows, sw)) for sw in switch_flows )
+    return network_programmer.program_switches(jobs, concurrency)
+
+# Deletes the flows of a table matching the conditions (see SDCFlowTableView.find()).
+# If the flow registry is in sync with ODL, no table is read.
+def __del_all_flows_match(topo, table_id, **conditions):
+    registry = network_flow_registry.get_registry()
+    if registry.is_synced():
+        del_registered_flows(registry.find(table_id=table_id, switches=topo.get_all_switches(), **conditions))
+        return
+    view = SDCFlowTableView(topo.get_all_switches(), table_id)
+    view.delete(view.find(**conditions))
+
 def del_all_flows_match_name(topo, flowname, table_id="0"):
-    all_switches = topo.get_all_switches()
-    for sw in all_switches:
-        flows = get_flows(sw, table_id)
-        for fl in flows:
-            if flowname == fl['flow-name']:
-                del_flow_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, sw, table_id, fl['id'])
+    __del_all_flows_match(topo, table_id, flowname=flowname)
 
 def del_all_flows_match_src_dst_ip(topo, src_ip, dst_ip, table_id="0"):
-    all_switches = topo.get_all_switches()
-    for sw in all_switches:
-        flows = get_flows(sw, table_id)
-        for fl in flows:
-            try:
-                if src_ip in fl['match']['ipv4-source'] and dst_ip in fl['match']['ipv4-destination']:
-                    del_flow_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, sw, table_id, fl['id'])
-            except KeyError:
-                continue
+    __del_all_flows_match(topo, table_id, src_ip=src_ip, dst_ip=dst_ip)
 
 def del_all_flows_match_priority(topo, table_id, priority):
-    all_switches = topo.get_all_switches()
-    for sw in all_switches:
-        flows = get_flows(sw, table_id)
-        for fl in flows:
-            if priority == fl['priority']:
-                del_flow_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, sw, table_id, fl['id'])
+    __del_all_flows_match(topo, table_id, priority=priority)
 
 ## Path management
 
@@ -251,14 +500,9 @@ def get_low_utilization_path(topo, src_host, dst_host):
     for path in all_paths:
         print(path)    # Each path is a list of switch IDs, e.g., [40960023, 40960012, 40960000, 40960010, 40960021]
     
-    # Select a path
-    path_bw=[]
-    for path in all_paths:
-        bw = network_monitor.get_bw_usage_along_links(topo, path, exclude_src_ip=src_host, exclude_dst_ip=dst_host)
-        path_bw.append(bw)
-    
-    low_path = path_bw.index(min(path_bw))
-    selected_path = all_paths[low_path]
+    # Select a path: BW of all ports from one sFlow dump
+    matrix = network_monitor.get_utilization_matrix(topo)
+    selected_path = matrix.get_low_utilization_path(all_paths, exclude_key=src_host+","+dst_host)
     print("Debug: selected path for %s --> %s = %s"%(src_host, dst_host, selected_path))
     return selected_path
 
@@ -290,42 +534,89 @@ def add_path_along_links(topo, path, src_host, dst_host):
     for (inport, this_node, outport) in topo.get_switch_port_map(path):
         add_flow(this_node, outport, ODL_FLOW_PRIORITY_SPECIAL_PATH, match_src_ip= src_host, match_dst_ip=dst_host, flowname = FLOWNAME_SPECIAL)
 
+# Returns the installed special path flows of a host pair as (switch, table_id, flow_id),
+# from the flow registry if it is in sync with ODL, or else from the flow tables.
+def __find_special_path_flows(topo, src_ip, dst_ip):
+    registry = network_flow_registry.get_registry()
+    if registry.is_synced():
+        return registry.find(flowname=FLOWNAME_SPECIAL, src_ip=src_ip, dst_ip=dst_ip, table_id=0)
+    view = SDCFlowTableView(topo.get_all_switches(), table_id=0)
+    return [(sw, "0", flow_id) for sw, flow_id in view.find(flowname=FLOWNAME_SPECIAL, src_ip=src_ip, dst_ip=dst_ip)]
+
+# Moves the special path of a host pair to a new path, make-before-break:
+#  1. The rules of the new path are pushed from the egress switch back to the ingress one, so that
+#     a switch sends packets to the new path only after the rest of it is installed downstream.
+#     The rule of the ingress switch, which moves the traffic to the new path, is pushed last.
+#  2. On a switch of both paths, the installed flow is modified in place (same flow ID), as a
+#     second flow of the same match and priority would be a duplicate on the switch.
+#  3. Then the old rules not used any more are deleted.
+# Note that ODL programs the switches asynchronously after each request returns.
+# Limitation: a switch of the new path with duplicates (flows of the same match under several flow
+# IDs, left by older versions) cannot be modified in place, as deleting any of the IDs removes the
+# flow of the match from the switch. All its flows are deleted right before its new rule is added,
+# so that packets through it are dropped for the time of one request.
+def update_path_along_links(topo, path, src_host, dst_host):
+    old_flows = defaultdict(list)    # dict[switch] = list of (switch, table_id, flow_id)
+    for key in __find_special_path_flows(topo, src_host, dst_host):
+        old_flows[key[0]].append(key)
+    port_map = topo.get_switch_port_map(path)
+    for (inport, this_node, outport) in reversed(port_map):
+        flow_id = old_flows[this_node][0][2] if old_flows[this_node] else None
+        if len(old_flows[this_node]) > 1:
+            print "Deleting %d duplicated special path flows for %s -> %s at %s"%(len(old_flows[this_node]), src_host, dst_host, this_node)
+            del_registered_flows(old_flows[this_node])
+        add_flow(this_node, outport, ODL_FLOW_PRIORITY_SPECIAL_PATH, match_src_ip= src_host, match_dst_ip=dst_host, flowname = FLOWNAME_SPECIAL, flow_id=flow_id)
+    
+    new_switches = set(this_node for (inport, this_node, outport) in port_map)
+    stale = [key for switch, keys in old_flows.items() if switch not in new_switches for key in keys]
+    if stale:
+        print "Deleting %d old special path flows for %s -> %s"%(len(stale), src_host, dst_host)
+        del_registered_flows(stale)
+
 def add_path_along_low_utilization(topo, src_host, dst_host, src_vm_ip=None, dst_vm_ip=None):
     if src_vm_ip == None:
         src_vm_ip = src_host
     if dst_vm_ip == None:
         dst_vm_ip = dst_host        
     selected_path = get_low_utilization_path(topo, src_host, dst_host)
-    add_path_along_links(topo, selected_path, src_vm_ip, dst_vm_ip)
+    if PATH_UPDATE_MAKE_BEFORE_BREAK:
+        update_path_along_links(topo, selected_path, src_vm_ip, dst_vm_ip)
+    else:
+        add_path_along_links(topo, selected_path, src_vm_ip, dst_vm_ip)
 
 def create_special_path(src_ip, dst_ip, src_vm_ip=None, dst_vm_ip=None):
     # To set a rule for vm traffic, give the compute nodes IP at src_ip/dst_ip,
     #  and provide VM IPs as src_vm_ip/dst_vm_ip.
     # If xxx_vm_ip is set, we use them as a flow matching rule.
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    topo = topo_discovery.get_topo()
     add_path_along_low_utilization(topo, src_ip,dst_ip, src_vm_ip, dst_vm_ip)
     
 def delete_special_path(src_ip, dst_ip):
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    topo = topo_discovery.get_topo()
     del_all_flows_match_src_dst_ip(topo, src_ip, dst_ip)
 
 def clear_all_paths():
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
-    del_all_flows_match_name(topo, FLOWNAME_SPECIAL, table_id = 0)
-    del_all_flows_match_name(topo, FLOWNAME_SPECIAL_QUEUE, table_id = 0)
+    topo = topo_discovery.get_topo()
+    registry = network_flow_registry.get_registry()
+    if registry.is_synced():
+        del_registered_flows(registry.find(flowname=FLOWNAME_SPECIAL, table_id=0) + registry.find(flowname=FLOWNAME_SPECIAL_QUEUE, table_id=0))
+    else:
+        view = SDCFlowTableView(topo.get_all_switches(), table_id = 0)
+        view.delete(view.find(flowname=FLOWNAME_SPECIAL) + view.find(flowname=FLOWNAME_SPECIAL_QUEUE))
     network_defpath.del_all_default_paths(topo)
     
 def path_string_format(path):
     return " -> ".join( [str(p) for p in path] )
 
 def print_all_paths(src_ip, dst_ip):
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    topo = topo_discovery.get_topo()
     
     print "\nCurrently utilizing path for %s -> %s" %(src_ip, dst_ip)
-    print path_string_format(network_monitor.monitor_get_current_path(topo, src_ip, dst_ip))
+    current_path = network_monitor.monitor_get_current_path(topo, src_ip, dst_ip)
+    print path_string_format(current_path)
     
     print "\nPort-switch mappings of the path:"
-    print path_string_format(network_monitor.monitor_get_current_path_port_map(topo, src_ip,dst_ip))
+    print path_string_format(topo.get_switch_port_map(current_path))
     
     all_path = topo.find_all_path_port_map(src_ip, dst_ip)
     print "\nAll paths %s -> %s: (in_port, switch, out_port)" %(src_ip, dst_ip)
@@ -335,7 +626,7 @@ def print_all_paths(src_ip, dst_ip):
 def test_set_path():
     print "\nTesting..."
     
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    topo = topo_discovery.get_topo()
     print "\nAll hosts..."
     topo.print_all_hosts()
     print "\nAll links..."
@@ -359,6 +650,193 @@ def test_set_path():
     print "\nDefault path for %s -> %s :"%(src_ip, dst_ip)
     print get_default_path(topo, src_ip, dst_ip)
 
+def bench_add_flows(k=4, latency=0.002):
+    # Rules per second of per-flow PUTs (add_flow) vs. batches (add_flows), for the default
+    # paths of a k-ary fat-tree pushed to a mock ODL answering each request after 'latency' seconds.
+    import sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    rules = network_defpath.set_default_paths(topo, dry_run=True)
+    print "k=%d fat-tree: %d switches, %d rules, mock ODL latency %.1f ms"%(k, len(topo.get_all_switches()), len(rules), latency*1000)
+    
+    url = sdcon_config.ODL_CONTROLLER_URL
+    global ENABLE_FLOW_BATCH
+    enable_batch = ENABLE_FLOW_BATCH
+    for name, batch in (("per-flow PUT", False), ("batch", True)):
+        server = sdcon_mock.MockODLServer(snapshot, latency=latency)
+        server.start()
+        sdcon_config.ODL_CONTROLLER_URL = server.url
+        ENABLE_FLOW_BATCH = batch
+        try:
+            with sdcon_mock.quiet():
+                start = time.time()
+                if batch:
+                    add_flows(rules)
+                else:
+                    for rule in rules:
+                        push_flow(rule)
+                elapsed = time.time() - start
+        finally:
+            sdcon_config.ODL_CONTROLLER_URL = url
+            ENABLE_FLOW_BATCH = enable_batch
+            server.stop()
+        print "  %-12s: %6d requests, %7.3f sec, %8.0f rules/sec, %d flows installed"%(
+            name, server.get_request_count(), elapsed, len(rules)/elapsed, server.get_flow_count())
+
+# Follows the special path flows of a host pair in a mock ODL from the ingress switch.
+# Of flows with the same match, the last written one is used, as the switch overwrites it.
+# write_seq: dict[(switch, flow_id)] = order of the last write.
+# Returns the switches on the way to the destination host, or None if packets would leave
+# the special path (no rule) or loop.
+def __get_special_path_rules(server, switch, src_ip, dst_ip):
+    rules = [parse_flow(switch, fl) for fl in server.get_flows("openflow:"+switch, "0")]
+    return [r for r in rules if r.flowname == FLOWNAME_SPECIAL and r.match_src_ip == src_ip and r.match_dst_ip == dst_ip]
+
+def __trace_special_path(server, topo, src_ip, dst_ip, write_seq, delete_seq):
+    # Follows the special path rules in the mock, as a switch would apply them. A switch keeps one
+    # flow per match, thus deleting any flow ID of the match removes it until it is pushed again.
+    dst_mac = topo.host_ip_to_mac[dst_ip]
+    node, visited = topo.get_connected_switch(src_ip), []
+    while node != dst_mac:
+        if node == None or node in visited:
+            return None
+        visited.append(node)
+        rules = [r for r in __get_special_path_rules(server, node, src_ip, dst_ip) if write_seq.get( (node, r.flow_id), -1 ) > delete_seq.get(node, -2)]
+        if len(rules) == 0:
+            return None
+        rule = max(rules, key=lambda r: write_seq.get( (node, r.flow_id), -1 ))
+        node = topo.get_connected_node_via_port(node, rule.action_outport[0])
+    return visited
+
+def __run_path_update(snapshot, topo, old_path, new_path, src_ip, dst_ip, update, duplicated_switch=None):
+    # Moves the special path from old_path to new_path on a mock ODL with the function update.
+    # With duplicated_switch, a second flow of the same rule is added there before the update.
+    # Returns (list of (method, switch) of the writes, list of the traced path after each write, mock server).
+    import re, sdcon_mock
+    url = sdcon_config.ODL_CONTROLLER_URL
+    registry = network_flow_registry.get_registry()
+    server = sdcon_mock.MockODLServer(snapshot)
+    server.start()
+    sdcon_config.ODL_CONTROLLER_URL = server.url
+    network_flow_registry.set_registry(network_flow_registry.SDCFlowRegistry())
+    network_flow_registry.get_registry().synced = True    # The mock starts without flows
+    writes, states, write_seq, delete_seq = [], [], {}, {}
+    def check_after(method, handle):
+        def handle_and_trace(path, *args):
+            switch = re.search("openflow:([0-9]+)", path).group(1)
+            before = set(r.flow_id for r in __get_special_path_rules(server, switch, src_ip, dst_ip))
+            result = handle(path, *args)
+            if before - set(r.flow_id for r in __get_special_path_rules(server, switch, src_ip, dst_ip)):
+                delete_seq[switch] = len(writes)
+            if method == "PUT":
+                write_seq[(switch, path.split("/")[-1])] = len(writes)
+            writes.append( (method, switch) )
+            states.append(__trace_special_path(server, topo, src_ip, dst_ip, write_seq, delete_seq))
+            return result
+        return handle_and_trace
+    try:
+        with sdcon_mock.quiet():
+            update(topo, old_path, src_ip, dst_ip)
+            if duplicated_switch != None:
+                outport = dict( (sw, outport) for (inport, sw, outport) in topo.get_switch_port_map(old_path) )[duplicated_switch]
+                add_flow(duplicated_switch, outport, ODL_FLOW_PRIORITY_SPECIAL_PATH, match_src_ip=src_ip, match_dst_ip=dst_ip, flowname=FLOWNAME_SPECIAL,
+                    flow_id="legacy")    # Same rule under another flow ID
+            for method in ("PUT", "PATCH", "DELETE"):
+                name = "handle_"+method.lower()
+                setattr(server, name, check_after(method, getattr(server, name)))
+            update(topo, new_path, src_ip, dst_ip)
+    finally:
+        sdcon_config.ODL_CONTROLLER_URL = url
+        network_flow_registry.set_registry(registry)
+        server.stop()
+    return writes, states, server
+
+def test_path_update(k=4):
+    # Moves the special path of a host pair between ECMP paths on a mock ODL, and checks that
+    # with make-before-break the rules are written from the egress switch to the ingress one,
+    # the old rules are deleted after the ingress rule, and packets follow either the old or
+    # the new path after every single write. With duplicated flows on a switch of both paths,
+    # packets may leave the path only between their deletion and the new rule of the switch.
+    import sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    src_ip, dst_ip = sdcon_mock.fattree_host_ip(0, 0, 0), sdcon_mock.fattree_host_ip(k-1, 0, 0)
+    paths = topo.find_all_path(src_ip, dst_ip)
+    # Disjoint in the middle, sharing the aggregation switch with another outport, and the same
+    # with a duplicated flow on that aggregation switch
+    cases = [(paths[0], paths[-1], None), (paths[0], paths[1], None), (paths[0], paths[1], paths[0][2])]
+    ok = True
+    for old_path, new_path, duplicated_switch in cases:
+        old_switches, new_switches = list(old_path[1:-1]), list(new_path[1:-1])
+        print "\n%s -> %s: %s => %s%s"%(src_ip, dst_ip, path_string_format(old_switches), path_string_format(new_switches),
+            ", duplicated flows at %s"%(duplicated_switch) if duplicated_switch else "")
+        for name, update in (("in path order", add_path_along_links), ("make-before-break", update_path_along_links)):
+            writes, states, server = __run_path_update(snapshot, topo, old_path, new_path, src_ip, dst_ip, update, duplicated_switch)
+            broken = len([st for st in states if st == None])
+            stale = len([fl for sw in set(old_switches + new_switches) for fl in server.get_flows("openflow:"+sw, "0")
+                if fl.get("flow-name") == FLOWNAME_SPECIAL]) - len(new_switches)
+            print "  %-18s: %s"%(name, ", ".join("%s %s"%w for w in writes))
+            print "  %-18s  %d writes, %d with packets leaving the path, %d stale flows"%("", len(writes), broken, stale)
+            if update != update_path_along_links:
+                continue
+            puts = [sw for method, sw in writes if method == "PUT"]
+            last_put = max(i for i, (method, sw) in enumerate(writes) if method == "PUT")
+            # Before the ingress rule, only the duplicates of a switch are deleted, right before its new rule.
+            early_deletes = [i for i, (method, sw) in enumerate(writes[:last_put]) if method != "PUT"]
+            duplicate_windows = [i for i in early_deletes if writes[i][1] == duplicated_switch and writes[i+1] == ("PUT", duplicated_switch)]
+            checks = [
+                ("rules written from egress to ingress", puts == list(reversed(new_switches))),
+                ("old rules deleted after the ingress rule", early_deletes == duplicate_windows),
+                ("packets on the old or the new path after each write", all(st in (old_switches, new_switches) or i in duplicate_windows
+                    for i, st in enumerate(states))),
+                ("packets on the new path at the end", states[-1] == new_switches),
+                ("no stale flows", stale == 0)]
+            for check, result in checks:
+                print "    %-55s %s"%(check, "OK" if result else "FAILED")
+                ok = ok and result
+    print "\nMake-before-break path update:", "OK" if ok else "FAILED"
+    return ok
+
+def test_flow_rules(k=4):
+    # FlowRules of the default paths, special paths and queue flows: equal to themselves converted to
+    # ODL's JSON and back, and to the flows read back from a mock ODL after pushing their XML.
+    import sdcon_mock, network_manager_qos
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    rules = network_defpath.set_default_paths(topo, dry_run=True)
+    src_ip, dst_ip = sdcon_mock.fattree_host_ip(0, 0, 0), sdcon_mock.fattree_host_ip(k-1, 0, 0)
+    for (inport, switch, outport) in topo.get_switch_port_map(topo.find_all_path(src_ip, dst_ip)[0]):
+        rules.append(FlowRule.make(switch, outport, ODL_FLOW_PRIORITY_SPECIAL_PATH, match_src_ip=src_ip, match_dst_ip=dst_ip, flowname=FLOWNAME_SPECIAL))
+        rules.append(network_manager_qos.queue_flow_rule(switch, outport, 10, src_ip, dst_ip))
+    rule = rules[0]
+    same = FlowRule.make(**dict(rule.as_dict(), flow_id=None, priority=str(rule.priority),
+        action_outport=["openflow:%s:%s"%(rule.switch, p) for p in rule.action_outport]))
+    
+    results = [
+        ("rules of the same values are equal and hashed alike", same == rule and len(set([same, rule])) == 1),
+        ("dict of add_flow() arguments and back", all(FlowRule.from_dict(r.as_dict()) == r for r in rules)),
+        ("ODL JSON and back", all(FlowRule.from_odl(r.switch, r.to_odl()) == r for r in rules))]
+    url = sdcon_config.ODL_CONTROLLER_URL
+    registry = network_flow_registry.get_registry()
+    server = sdcon_mock.MockODLServer(snapshot)
+    server.start()
+    sdcon_config.ODL_CONTROLLER_URL = server.url
+    network_flow_registry.set_registry(network_flow_registry.SDCFlowRegistry())
+    try:
+        with sdcon_mock.quiet():
+            add_flows(rules)
+            installed = set(parse_flow(sw, fl) for sw in topo.get_all_switches() for t in ("0", "1") for fl in get_flows(sw, t))
+    finally:
+        sdcon_config.ODL_CONTROLLER_URL = url
+        network_flow_registry.set_registry(registry)
+        server.stop()
+    # A rule overwrites the earlier one of the same flow ID, e.g. the queue flow of a special path.
+    expected = dict( ((r.switch, r.table_id, r.flow_id), r) for r in rules )
+    results.append( ("pushed to a mock ODL and read back (%d flows)"%(len(installed)), installed == set(expected.values())) )
+    for name, ok in results:
+        print "  %-55s %s"%(name, "OK" if ok else "FAILED")
+    return all(ok for name, ok in results)
+
 ## Todo:
 # Update queue (a qos setting for multiple queues..
 
@@ -369,15 +847,32 @@ def _print_usage():
     print("      \t python %s del-path <src_IP> <dst_IP>\t- delete the special path for <src> to <dst> and back to default path"%(sys.argv[0]))
     print("      \t python %s get-path <src_IP> <dst_IP>\t- prints all paths between two hosts"%(sys.argv[0]))
     print("      \t python %s clear \t- clear all paths set up by SDCon"%(sys.argv[0]))
+    print("      \t python %s bench-flows [k] \t- benchmark per-flow vs. batch flow installation on a mock ODL (default: k=4)"%(sys.argv[0]))
+    print("      \t python %s test-mbb [k] \t- test the make-before-break path update on a mock ODL (default: k=4)"%(sys.argv[0]))
+    print("      \t python %s test-rules [k] \t- test FlowRule conversions to/from ODL on a mock ODL (default: k=4)"%(sys.argv[0]))
 
 # Main
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-flows":
+        bench_add_flows(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "test-mbb":
+        if not test_path_update(int(sys.argv[2]) if len(sys.argv) > 2 else 4):
+            sys.exit(1)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "test-rules":
+        ok = test_flow_rules(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+        print "\nFlow rules: %s"%("OK" if ok else "FAILED")
+        if not ok:
+            sys.exit(1)
+        return
     network_monitor.start_monitor()
     
     if len(sys.argv) < 2:
         _print_usage()
         return
     
+    network_flow_registry.start_registry() # Trust the registry only once verified against the switches
     if sys.argv[1] == "test-path":
         test_set_path()
     elif sys.argv[1] == "set-path":
@@ -5,23 +5,156 @@
 #
 # Copyright (c) 2018, The University of Melbourne, Australia
 #
-import sys
+import sys, time, functools, heapq
 import requests
 from time import sleep
 from requests.auth import HTTPBasicAuth
 from collections import defaultdict
-import network_manager, topo_discovery, sdcon_config
+import network_manager, network_programmer, network_payload, topo_discovery, sdcon_config, sdcon_rest
 
 NETWORK_MAX_BW_RATE=95000000 # bits per sec. 95Mbps
 DEFAULT_MIN_BW_RATIO = 0.1  
 
+# ODL applies OVSDB changes asynchronously. Before using a QoS entry (or deleting what it refers to),
+# the operational datastore is polled until the change is seen: first after OPER_POLL_INITIAL sec,
+# then doubling up to OPER_POLL_MAX sec between polls, for at most OPER_READY_DEADLINE sec.
+OPER_POLL_INITIAL = 0.01
+OPER_POLL_MAX = 1.0
+OPER_READY_DEADLINE = 10.0
+# Old pacing for comparison: sleep 0.3 sec after every write and poll every second.
+QOS_FIXED_PACING = False
+
+# Queue numbers are given per (switch, port), from QUEUE_NO_FIRST. Queue 0 is the default queue of a port,
+# and OVS linux-htb accepts queue numbers below 0xf000, so at most QUEUE_NO_LIMIT - QUEUE_NO_FIRST per port.
+QUEUE_NO_FIRST = 10
+QUEUE_NO_LIMIT = 0xf000
+QUEUES_PER_PORT = QUEUE_NO_LIMIT - QUEUE_NO_FIRST
+
+# Committed min-rate of the reservations per (switch, outport), so that the min-rates of the queues
+# in a port never add up to more than the capacity (HTB does not honor them otherwise).
+# A path of n switches is checked in O(n).
+class SDCReservationLedger:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.reserved = {} # dict[(switch, outport)] = committed min-rate, bits per sec
+        self.pair_links = {} # dict[(src,dst)] = (list of (switch, outport), min-rate)
+        self.ingress = {} # dict[(switch, inport)] = committed min-rate from the source hosts into their edge switch
+        self.pair_ingress = {} # dict[(src,dst)] = (switch, inport) of the first link of the path
+    
+    def get_links(self, topo, path):
+        return [(switch, outport) for (inport, switch, outport) in topo.get_switch_port_map(path)]
+    
+    def get_ingress(self, topo, path):
+        inport, switch, outport = topo.get_switch_port_map(path)[0]
+        return (switch, inport)
+    
+    def get_reserved(self, switch, outport):
+        return self.reserved.get( (switch, outport), 0 )
+    
+    def __get_used(self, links, pair):
+        # Committed min-rate of each link, without the reservation of the pair (to be replaced)
+        own_links, own_bw = self.pair_links.get(pair, ([], 0))
+        return [self.reserved.get(link, 0) - (own_bw if link in own_links else 0) for link in links]
+    
+    def get_headroom(self, links, pair=None):
+        return self.capacity - max(self.__get_used(links, pair) or [0])
+    
+    def can_admit(self, links, bw, pair=None):
+        return all(used + bw <= self.capacity for used in self.__get_used(links, pair))
+    
+    # Among the ECMP paths, the path with the most headroom that can admit bw (the first one in a tie).
+    # Returns None if no path can admit it.
+    def find_path(self, topo, src_ip, dst_ip, bw, pair=None):
+        best, best_used = None, None
+        for path in topo.find_all_path(src_ip, dst_ip):
+            used = self.__get_used(self.get_links(topo, path), pair)
+            if any(u + bw > self.capacity for u in used):
+                continue
+            score = (max(used or [0]), sum(used))
+            if best_used == None or score < best_used:
+                best, best_used = path, score
+        return best
+    
+    def get_host_headroom(self, topo, host_ip):
+        # Headroom of the link from the host to its edge switch, i.e. for the traffic the host sends.
+        # Raises KeyError for a host not in the topology.
+        switch = topo.get_connected_switch(host_ip)
+        return self.capacity - self.ingress.get( (switch, topo.get_switch_port_to_dst(switch, topo.get_host_mac(host_ip))), 0 )
+    
+    def reserve(self, pair, links, bw, ingress=None):
+        self.release(pair)
+        for link in links:
+            self.reserved[link] = self.reserved.get(link, 0) + bw
+        self.pair_links[pair] = (list(links), bw)
+        if ingress:
+            self.ingress[ingress] = self.ingress.get(ingress, 0) + bw
+            self.pair_ingress[pair] = ingress
+    
+    def release(self, pair):
+        if pair not in self.pair_links:
+            return
+        links, bw = self.pair_links.pop(pair)
+        for link in links:
+            self.reserved[link] -= bw
+            if self.reserved[link] <= 0:
+                del self.reserved[link]
+        ingress = self.pair_ingress.pop(pair, None)
+        if ingress:
+            self.ingress[ingress] -= bw
+            if self.ingress[ingress] <= 0:
+                del self.ingress[ingress]
+
+# Queue numbers of each (switch, port). A released number is given again before any new one,
+# always the lowest free number first: the numbers of a port stay below QUEUE_NO_FIRST plus the most
+# queues it had at once, and the same sequence of changes always gives the same numbers.
+class SDCQueueAllocator:
+    def __init__(self, max_queues=None):
+        self.max_queues = min(max_queues or QUEUES_PER_PORT, QUEUE_NO_LIMIT - QUEUE_NO_FIRST)
+        self.next_no = {} # dict[(switch, port)] = lowest number never given
+        self.free = {} # dict[(switch, port)] = heap of released numbers below next_no
+        self.used = {} # dict[(switch, port)] = number of queues given
+    
+    def get_count(self, switch, port):
+        return self.used.get( (switch, port), 0 )
+    
+    def is_full(self, switch, port):
+        return self.get_count(switch, port) >= self.max_queues
+    
+    # Returns None if the port has max_queues queues.
+    def allocate(self, switch, port):
+        key = (switch, port)
+        if self.is_full(switch, port):
+            return None
+        if self.free.get(key):
+            no = heapq.heappop(self.free[key])
+        else:
+            no = self.next_no.get(key, QUEUE_NO_FIRST)
+            self.next_no[key] = no + 1
+        self.used[key] = self.get_count(switch, port) + 1
+        return no
+    
+    def release(self, switch, port, no):
+        key = (switch, port)
+        self.used[key] -= 1
+        if self.used[key] == 0:
+            # All numbers of the port are free: start again from QUEUE_NO_FIRST
+            del self.used[key]
+            self.next_no.pop(key, None)
+            self.free.pop(key, None)
+        else:
+            heapq.heappush(self.free.setdefault(key, []), no)
+
 class SDCQueues:
-    def __init__(self, toal_rate):
+    def __init__(self, toal_rate, max_queues=None):
+        self.max_queues = max_queues # Queues per port, QUEUES_PER_PORT by default
         self.min_bw={}
         self.max_bw={}
         self.fixed_path={}
         self.toal_rate = toal_rate
         self.__init_qos_config()
+        # What was pushed to the switches, to push only the changes in apply_changes()
+        self.installed_queues = {} # dict[(switch, port)] = dict[queue no] = (min-rate, max-rate)
+        self.installed_flows = set() # set of network_manager.FlowRule
     
     def add_qos_bw(self, src_ip, dst_ip, min_bw_bps, max_bw_bps, path=None):
         self.min_bw[(src_ip, dst_ip)] = min_bw_bps
@@ -41,35 +174,71 @@ class SDCQueues:
     
     def __init_qos_config(self):
         self.switch_q = defaultdict(list) # dict[switch] = List of (outport, src_ip, dst_ip, bw)
-        self.switch_qindex = defaultdict(dict) # dict[switch][(src,dst)] = index of queue in switch_q
+        self.switch_qno = defaultdict(dict) # dict[switch][(src,dst)] = queue number in the outport of the pair
+        self.allocator = SDCQueueAllocator(self.max_queues) # Numbers are not changed once given.
         self.switch_qcfg = {} # dict[switch][port] = list of queue_cfg
-        self.switch_port_fl = {} # dict[switch][port] = list of [(src,dst), ..]
+        self.switch_port_fl = {} # dict[switch][port] = list of [(src,dst), ..], in the order of switch_qcfg
+        self.pair_links = {} # dict[(src,dst)] = list of (switch, outport) having a queue of the pair
+        self.ledger = SDCReservationLedger(self.toal_rate)
+    
+    def __can_allocate(self, links, pair):
+        # A link already having a queue of the pair keeps its number
+        own_links = self.pair_links.get(pair, [])
+        return all(link in own_links or not self.allocator.is_full(*link) for link in links)
     
-    def __build_queue_along_path(self, topo, path, src_ip, dst_ip):
+    def __add_queue_along_path(self, topo, path, src_ip, dst_ip, queue_nos=None):
+        # queue_nos: dict[(switch, outport)] = queue number to keep for the pair (the used ones are popped)
+        queue_nos = queue_nos or {}
+        pair = (src_ip, dst_ip)
+        links = []
         for (inport, switch, outport) in topo.get_switch_port_map(path):
-            self.switch_qindex[switch][(src_ip, dst_ip)] = len(self.switch_q[switch])
+            no = queue_nos.pop( (switch, outport), None )
+            if no == None:
+                no = self.allocator.allocate(switch, outport)
+            self.switch_qno[switch][pair] = no
             self.switch_q[switch].append( (outport, src_ip, dst_ip) )
+            self.switch_qcfg.setdefault(switch, defaultdict(list))[outport].append({
+                "no": no,
+                "min-rate":self.get_qos_minbw(src_ip, dst_ip), 
+                "max-rate":self.get_qos_maxbw(src_ip, dst_ip)} )
+            self.switch_port_fl.setdefault(switch, defaultdict(list))[outport].append(pair)
+            links.append( (switch, outport) )
+        self.pair_links[pair] = links
+        self.ledger.reserve(pair, links, self.get_qos_minbw(src_ip, dst_ip), self.ledger.get_ingress(topo, path))
+        # Numbers kept for the links no longer on the path
+        for (switch, outport), no in queue_nos.items():
+            self.allocator.release(switch, outport, no)
     
-    def __build_queue_config(self):
-        self.switch_qcfg = {}
-        self.switch_port_fl = {}
-        for switch in self.switch_q:
-            port_queue_cfg = defaultdict(list)
-            port_fl = defaultdict(list)
-            # Add queue configs to each port
-            for (outport, src_ip, dst_ip) in self.switch_q[switch]:
-                port_queue_cfg[outport].append({
-                    "no": self.get_queue_no(switch, src_ip, dst_ip),
-                    "min-rate":self.get_qos_minbw(src_ip, dst_ip), 
-                    "max-rate":self.get_qos_maxbw(src_ip, dst_ip)} )
-                port_fl[outport].append( (src_ip, dst_ip) )
-            self.switch_qcfg[switch] = port_queue_cfg
-            self.switch_port_fl[switch] = port_fl
+    def __remove_queue_along_path(self, src_ip, dst_ip, release=True):
+        # Returns dict[(switch, outport)] = queue number that the pair had.
+        # With release=False, the numbers are kept for __add_queue_along_path().
+        pair = (src_ip, dst_ip)
+        queue_nos = {}
+        self.ledger.release(pair)
+        for (switch, outport) in self.pair_links.pop(pair, []):
+            queue_nos[(switch, outport)] = self.switch_qno[switch].pop(pair)
+            if release:
+                self.allocator.release(switch, outport, queue_nos[(switch, outport)])
+            self.switch_q[switch].remove( (outport, src_ip, dst_ip) )
+            i = self.switch_port_fl[switch][outport].index(pair)
+            del self.switch_port_fl[switch][outport][i]
+            del self.switch_qcfg[switch][outport][i]
+            if len(self.switch_port_fl[switch][outport]) == 0:
+                del self.switch_port_fl[switch][outport]
+                del self.switch_qcfg[switch][outport]
+            if len(self.switch_qcfg[switch]) == 0:
+                del self.switch_port_fl[switch]
+                del self.switch_qcfg[switch]
+        return queue_nos
     
+    # Rebuilds the queues of all pairs. As in add_reservation(), a pair gets no queues if its min-rate
+    # cannot be admitted on the path, or a port of the path has no queue number left.
+    # Returns the list of (src_ip, dst_ip) not admitted.
     def build_qos_config(self, topo, func_get_path = None):
         if func_get_path == None:
             func_get_path = network_manager.get_default_path
         self.__init_qos_config()
+        rejected = []
         for (src_ip, dst_ip) in self.min_bw:
             print "Debug: finding a path for %s->%s"%(src_ip, dst_ip)
             # Get a path to install the qos queue
@@ -77,14 +246,121 @@ class SDCQueues:
                 path = self.fixed_path[(src_ip, dst_ip)]
             else:
                 path = func_get_path(topo, src_ip, dst_ip)
+            links = self.ledger.get_links(topo, path)
+            if not self.ledger.can_admit(links, self.get_qos_minbw(src_ip, dst_ip), (src_ip, dst_ip)):
+                print "Error: cannot admit %s->%s (min-rate %.1f Mbps): not enough bandwidth on the path"%(src_ip, dst_ip, self.get_qos_minbw(src_ip, dst_ip)/1e6)
+                rejected.append( (src_ip, dst_ip) )
+                continue
+            if not self.__can_allocate(links, (src_ip, dst_ip)):
+                print "Error: no queue number left for %s->%s (%d queues per port)"%(src_ip, dst_ip, self.allocator.max_queues)
+                rejected.append( (src_ip, dst_ip) )
+                continue
             print "Build queue settings (%s->%s) for path:%s"%(src_ip, dst_ip, path)
-            self.__build_queue_along_path(topo, path, src_ip, dst_ip)
-        # After all pairs are added, build
-        self.__build_queue_config()
+            self.__add_queue_along_path(topo, path, src_ip, dst_ip)
+        return rejected
+    
+    # Adds (or updates) one reservation without rebuilding the others: only the queues of the
+    # (switch, port)s on its path are changed, and the queue numbers of the other pairs are kept.
+    # An updated pair keeps its queue number in the switches still on its path.
+    # Without a path (or func_get_path), the ECMP path with the most headroom in the ledger is taken.
+    # Returns False, without any change, if the min-rate cannot be admitted on the path,
+    # or a port of the path has no queue number left.
+    # The changes are pushed to the switches by apply_changes().
+    def add_reservation(self, topo, src_ip, dst_ip, min_bw_bps, max_bw_bps, path=None, func_get_path=None):
+        pair = (src_ip, dst_ip)
+        fixed_path = path
+        if not path and pair in self.fixed_path and self.fixed_path[pair]:
+            path = self.fixed_path[pair]
+        if not path and func_get_path:
+            path = func_get_path(topo, src_ip, dst_ip)
+        if path:
+            admitted = self.ledger.can_admit(self.ledger.get_links(topo, path), min_bw_bps, pair)
+        else:
+            path = self.ledger.find_path(topo, src_ip, dst_ip, min_bw_bps, pair)
+            admitted = path != None
+        if not admitted:
+            print "Error: cannot admit %s->%s (min-rate %.1f Mbps): not enough bandwidth on the path"%(src_ip, dst_ip, min_bw_bps/1e6)
+            return False
+        if not self.__can_allocate(self.ledger.get_links(topo, path), pair):
+            print "Error: no queue number left for %s->%s (%d queues per port)"%(src_ip, dst_ip, self.allocator.max_queues)
+            return False
+        queue_nos = self.__remove_queue_along_path(src_ip, dst_ip, release=False)
+        self.add_qos_bw(src_ip, dst_ip, min_bw_bps, max_bw_bps, fixed_path)
+        self.__add_queue_along_path(topo, path, src_ip, dst_ip, queue_nos)
+        return True
+    
+    def remove_reservation(self, src_ip, dst_ip):
+        self.__remove_queue_along_path(src_ip, dst_ip)
+        self.min_bw.pop((src_ip, dst_ip), None)
+        self.max_bw.pop((src_ip, dst_ip), None)
+        self.fixed_path.pop((src_ip, dst_ip), None)
+    
+    def has_reservation(self, src_ip, dst_ip):
+        return (src_ip, dst_ip) in self.pair_links
+    
+    # Reserves in the ledger the queues installed by earlier runs, read from the queue flows of the
+    # switches and the min-rate of their queues in OVSDB, so that the admission and the free bandwidth
+    # of the hosts (get_host_free_bw) count them. Pairs already known to this process are kept as they are.
+    # Only the ledger is changed: the queues are replaced when the pair is added again.
+    # Returns the number of pairs reserved.
+    def seed_ledger(self, topo):
+        view = network_manager.SDCFlowTableView(topo.get_all_switches(), table_id=0)
+        min_rates = {} # dict[switch] = dict[queue id] = min-rate
+        pair_links = defaultdict(dict) # dict[(src,dst)] = dict[(switch, outport)] = min-rate
+        for (switch, flow_id) in view.find(flowname=network_manager.FLOWNAME_SPECIAL_QUEUE):
+            rule = network_manager.FlowRule.from_odl(switch, view.get_flow(switch, flow_id))
+            pair = (rule.match_src_ip, rule.match_dst_ip)
+            if pair in self.ledger.pair_links or not rule.action_outport or rule.action_queue == None:
+                continue
+            if switch not in min_rates:
+                min_rates[switch] = get_queue_min_rates_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch)
+            outport = rule.action_outport[0]
+            pair_links[pair][(switch, outport)] = min_rates[switch].get(port_queue_id(outport, rule.action_queue), 0)
+        for pair, link_rates in sorted(pair_links.items()):
+            bw = max(link_rates.values())
+            if bw <= 0:
+                continue
+            # The ingress of the pair is known from its path: the ECMP path having exactly its links
+            ingress = None
+            try:
+                for path in topo.find_all_path(pair[0], pair[1]):
+                    links = self.ledger.get_links(topo, path)
+                    if set((sw, str(port)) for sw, port in links) == set(link_rates):
+                        ingress = self.ledger.get_ingress(topo, path)
+                        link_rates = dict( (link, bw) for link in links )
+                        break
+            except KeyError:
+                pass # Host no longer in the topology: only its links are reserved
+            self.ledger.reserve(pair, sorted(link_rates), bw, ingress)
+        return len(pair_links)
+    
+    def __get_pair_cfg(self, pair):
+        switch, port = self.pair_links[pair][0]
+        return self.switch_qcfg[switch][port][self.switch_port_fl[switch][port].index(pair)]
+    
+    # Pairs given by add_qos_bw() without their queues yet, or whose queues have other rates.
+    def get_pending_pairs(self):
+        pending = []
+        for pair in self.min_bw:
+            if self.pair_links.get(pair):
+                cfg = self.__get_pair_cfg(pair)
+                if (cfg["min-rate"], cfg["max-rate"]) == (self.min_bw[pair], self.max_bw[pair]):
+                    continue
+            pending.append(pair)
+        return pending
+    
+    # Drops the rates given by add_qos_bw() that were not admitted: the pair keeps its current queues, or is removed.
+    def discard_pending(self, src_ip, dst_ip):
+        pair = (src_ip, dst_ip)
+        if self.pair_links.get(pair):
+            cfg = self.__get_pair_cfg(pair)
+            self.min_bw[pair], self.max_bw[pair] = cfg["min-rate"], cfg["max-rate"]
+        elif pair not in self.pair_links:
+            self.remove_reservation(src_ip, dst_ip)
     
     def get_queue_no(self, switch, src_ip, dst_ip):
-        if (src_ip, dst_ip) in self.switch_qindex[switch]:
-            return self.switch_qindex[switch][(src_ip, dst_ip)]+10
+        if (src_ip, dst_ip) in self.switch_qno[switch]:
+            return self.switch_qno[switch][(src_ip, dst_ip)]
         
         print "get_queue_no: no queue.", switch, src_ip, dst_ip
         return None
@@ -104,107 +380,229 @@ class SDCQueues:
     def add_flow_rule(self, switch, port, src_ip, dst_ip):
         add_flow_enqueue(switch, port, self.get_queue_no(switch, src_ip, dst_ip),  src_ip, dst_ip)
     
+    def install_queue_flow(self, switch):
+        print "Installing flows for switch: "+str(switch)
+        set_queue(switch, self.switch_qcfg[switch], self.toal_rate)
+        self.install_flow(switch)
+    
+    def install_flow(self, switch):
+        for port in self.get_switch_ports(switch):
+            for (src_ip, dst_ip) in self.switch_port_fl[switch][port]:
+                self.add_flow_rule(switch, port, src_ip, dst_ip)
+    
     # This function creates QoS and Queues in OVSDB, and adds flow rules in forwarding table.
-    # 1. 
-    def install_all_queue_flow(self):
-        for switch in self.get_switches():
-            print "Installing flows for switch: "+str(switch)
-            set_queue(switch, self.switch_qcfg[switch], self.toal_rate)
-            for port in self.get_switch_ports(switch):
-                for (src_ip, dst_ip) in self.switch_port_fl[switch][port]:
-                    self.add_flow_rule(switch, port, src_ip, dst_ip)
+    # 1. QoS and queues are pushed to all switches, and their readiness is verified together.
+    # 2. Ports are bound to the QoS entries, and the bindings are verified together.
+    # 3. Flows to the queues are added.
+    # Switches are programmed in parallel (up to 'concurrency') in each step, and a failed
+    # switch is skipped in the next steps. Returns network_programmer.SDCProgramReport.
+    def install_all_queue_flow(self, concurrency=None):
+        switches = self.get_switches()
+        report = network_programmer.program_switches(
+            dict( (sw, functools.partial(push_queue, sw, self.switch_qcfg[sw], self.toal_rate)) for sw in switches ), concurrency)
+        switches = [sw for sw in switches if sw not in report.switch_error]
+        wait_oper_qos([(sw, port) for sw in switches for port in self.get_switch_ports(sw)])
+        report.merge(network_programmer.program_switches(
+            dict( (sw, functools.partial(bind_all_port_qos, sw, self.get_switch_ports(sw))) for sw in switches ), concurrency))
+        switches = [sw for sw in switches if sw not in report.switch_error]
+        wait_oper_bind_port_qos([(sw, port) for sw in switches for port in self.get_switch_ports(sw)])
+        report.merge(network_programmer.program_switches(
+            dict( (sw, functools.partial(self.install_flow, sw)) for sw in switches ), concurrency))
+        self.__set_installed([sw for sw in switches if sw not in report.switch_error])
+        report.print_report()
+        return report
+    
+    def __get_port_queues(self, switch, port):
+        return dict( (cfg["no"], (cfg["min-rate"], cfg["max-rate"])) for cfg in self.switch_qcfg[switch][port] )
+    
+    def __get_queue_flows(self, switch):
+        flows = set()
+        for port in self.get_switch_ports(switch):
+            for (src_ip, dst_ip) in self.switch_port_fl[switch][port]:
+                flows.add( queue_flow_rule(switch, port, self.get_queue_no(switch, src_ip, dst_ip), src_ip, dst_ip) )
+        return flows
+    
+    def __set_installed(self, switches):
+        # Records the current config of the switches as installed.
+        switches = set(switches)
+        for (switch, port) in self.installed_queues.keys():
+            if switch in switches:
+                del self.installed_queues[(switch, port)]
+        self.installed_flows = set(fl for fl in self.installed_flows if fl.switch not in switches)
+        for switch in switches:
+            if switch in self.switch_qcfg:
+                for port in self.get_switch_ports(switch):
+                    self.installed_queues[(switch, port)] = self.__get_port_queues(switch, port)
+                self.installed_flows |= self.__get_queue_flows(switch)
     
+    def __push_port_changes(self, switch, ports):
+        # Pushes the queues that are new or changed in the ports, and the QoS entries of the ports.
+        for port in ports:
+            installed = self.installed_queues.get( (switch, port), {} )
+            if not installed:
+                push_queue_entry(switch, port_queue_id(port), self.toal_rate, self.toal_rate*DEFAULT_MIN_BW_RATIO)
+            for no, (min_rate, max_rate) in sorted(self.__get_port_queues(switch, port).items()):
+                if installed.get(no) != (min_rate, max_rate):
+                    push_queue_entry(switch, port_queue_id(port, no), max_rate, min_rate)
+            push_qos_entry(switch, port, self.get_queue_cfg(switch, port), self.toal_rate)
+    
+    # Pushes only what changed since the last install_all_queue_flow() or apply_changes(),
+    # after add_reservation() and remove_reservation():
+    # 1. New and changed queues and the QoS entries of their ports. A switch without any installed
+    #    queue gets its whole node in one request, as install_all_queue_flow().
+    # 2. New ports are bound to their QoS entries.
+    # 3. Flows of removed pairs are deleted by their flow IDs, then flows of added pairs are added in batches.
+    #    A flow replaced by one of the same flow ID (a pair moved to another queue) is overwritten in place.
+    # 4. Removed queues are deleted once the operational QoS entries no longer list them, and ports without
+    #    any queue are unbound and their QoS entries deleted. A switch whose queues are not deleted is
+    #    reported as failed, and its changes are pushed again by the next call.
+    # Queues, bindings and flows of the unchanged (switch, port)s are not sent again.
+    # Returns network_programmer.SDCProgramReport.
+    def apply_changes(self, concurrency=None):
+        ports = set( (sw, port) for sw in self.get_switches() for port in self.get_switch_ports(sw) )
+        changed = [sp for sp in ports if self.__get_port_queues(*sp) != self.installed_queues.get(sp)]
+        new_ports = [sp for sp in changed if sp not in self.installed_queues]
+        emptied = [sp for sp in self.installed_queues if sp not in ports]
+        installed_switches = set(sw for sw, port in self.installed_queues)
+        switch_ports = defaultdict(list)
+        for (sw, port) in changed:
+            switch_ports[sw].append(port)
+        jobs = {}
+        for sw, sw_ports in switch_ports.items():
+            if sw not in installed_switches:
+                jobs[sw] = functools.partial(push_queue, sw, self.switch_qcfg[sw], self.toal_rate)
+            else:
+                jobs[sw] = functools.partial(self.__push_port_changes, sw, sw_ports)
+        report = network_programmer.program_switches(jobs, concurrency)
+        ok = lambda sw: sw not in report.switch_error
+        wait_oper_qos([(sw, port) for (sw, port) in changed if ok(sw)])
+        switch_ports = defaultdict(list)
+        for (sw, port) in new_ports:
+            if ok(sw):
+                switch_ports[sw].append(port)
+        report.merge(network_programmer.program_switches(
+            dict( (sw, functools.partial(bind_all_port_qos, sw, sw_ports)) for sw, sw_ports in switch_ports.items() ), concurrency))
+        wait_oper_bind_port_qos([(sw, port) for (sw, port) in new_ports if ok(sw)])
+        
+        # Flows: the removed first, as a flow of the same match on another port would be a duplicate
+        flows = set()
+        for sw in self.get_switches():
+            flows |= self.__get_queue_flows(sw)
+        removed_flows = [fl for fl in self.installed_flows - flows if ok(fl.switch)]
+        added_flows = [fl for fl in flows - self.installed_flows if ok(fl.switch)]
+        replaced = set( (fl.switch, fl.flow_id) for fl in added_flows )
+        stale = [(fl.switch, str(fl.table_id), fl.flow_id) for fl in removed_flows if (fl.switch, fl.flow_id) not in replaced]
+        if stale:
+            report.merge(network_manager.del_registered_flows(stale, concurrency))
+        switch_flows = defaultdict(list)
+        for fl in added_flows:
+            switch_flows[fl.switch].append(fl)
+        report.merge(network_programmer.program_switches(
+            dict( (sw, functools.partial(network_manager.add_flows, sw_flows)) for sw, sw_flows in switch_flows.items() ), concurrency))
+        
+        # Queues no longer used, once the QoS entries of their ports do not list them any more
+        removed_queues = {}
+        for (sw, port) in changed:
+            if ok(sw) and (sw, port) in self.installed_queues:
+                removed = set(self.installed_queues[(sw, port)]) - set(self.__get_port_queues(sw, port))
+                if removed:
+                    removed_queues[(sw, port)] = removed
+        wait_oper_qos_unlisted(removed_queues)
+        switch_queue_ids = defaultdict(list)
+        for (sw, port), removed in sorted(removed_queues.items()):
+            switch_queue_ids[sw] += [port_queue_id(port, no) for no in sorted(removed)]
+        if emptied:
+            for (sw, port) in emptied:
+                unbind_port_qos(sw, port, port_to_qosid(port))
+            wait_oper_bind_port_qos(emptied, present=False)
+            for (sw, port) in emptied:
+                del_qos_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, sw, port_to_qosid(port))
+            wait_oper_ready([oper_qos_path(sw, port_to_qosid(port)) for (sw, port) in emptied], present=False)
+            for (sw, port) in sorted(emptied):
+                switch_queue_ids[sw] += [port_queue_id(port, no) for no in sorted(self.installed_queues[(sw, port)])] + [port_queue_id(port)]
+        report.merge(network_programmer.program_switches(
+            dict( (sw, functools.partial(delete_switch_queues, sw, queue_ids)) for sw, queue_ids in switch_queue_ids.items() ), concurrency))
+        
+        self.__set_installed([sw for sw in set(sw for sw, port in changed + emptied) | set(fl.switch for fl in removed_flows + added_flows) if ok(sw)])
+        report.print_report()
+        return report
+    
+    # Deletes the flows, port bindings, QoS entries, and queues in this order.
+    # Each step is done for all switches, then its removal is verified together.
     def delete_all_queue_flow(self):
+        # Flow tables of all switches are read once for all pairs.
+        view = network_manager.SDCFlowTableView(self.get_switches(), table_id=0)
+        keys = []
         for switch in self.get_switches():
-            print "Deleting flows for switch: "+str(switch)
             for port in self.get_switch_ports(switch):
                 for (src_ip, dst_ip) in self.switch_port_fl[switch][port]:
-                    del_flow_enqueue(switch, src_ip, dst_ip)
-                delete_queue_with_cfg(switch, port, self.get_queue_cfg(switch, port))
+                    keys += view.find(flowname=network_manager.FLOWNAME_SPECIAL_QUEUE, src_ip=src_ip, dst_ip=dst_ip, switch=switch)
+        print "Deleting %d queue flows from %d switches"%(len(keys), len(self.get_switches()))
+        view.delete(keys)
+        switch_ports = []
+        for switch in self.get_switches():
+            for port in self.get_switch_ports(switch):
+                unbind_port_qos(switch, port, port_to_qosid(port))
+                switch_ports.append( (switch, port) )
+        wait_oper_bind_port_qos(switch_ports, present=False)
+        for switch, port in switch_ports:
+            del_qos_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, port_to_qosid(port))
+        wait_oper_ready([oper_qos_path(switch, port_to_qosid(port)) for switch, port in switch_ports], present=False)
+        for switch, port in switch_ports:
+            delete_queues(switch, port, [cfg["no"] for cfg in self.get_queue_cfg(switch, port)])
+        self.installed_queues = {}
+        self.installed_flows = set()
 
-def __generate_json_set_queue_qos_entries(switch, port, queue_cfg_list, total_rate):
-    qos_id = port_to_qosid(port)
-    jdata = '''
-                {   "qos-id": "'''+str(qos_id)+'''",
-                    "qos-other-config": [
-                        {   "other-config-key": "max-rate",
-                            "other-config-value": "'''+str(total_rate)+'''"}],
-                    "qos-type": "ovsdb:qos-type-linux-htb",
-                    "queue-list": [
-                        {   "queue-number": "0",
-                            "queue-ref": "/network-topology:network-topology/''' \
-                            +'''network-topology:topology[network-topology:topology-id='ovsdb:1']/network-topology:node[network-topology:node-id=\'ovsdb:'''\
-                            +str(switch)+'''\']/ovsdb:queues[ovsdb:queue-id='QUEUE-DEF-'''+str(port)+'''\']"
-                        }'''
-    for cfg in queue_cfg_list:
-        jdata += '''         ,{  "queue-number": "'''+str(cfg["no"])+'''",
-                            "queue-ref": "/network-topology:network-topology/''' \
-                            +'''network-topology:topology[network-topology:topology-id='ovsdb:1']/network-topology:node[network-topology:node-id=\'ovsdb:'''\
-                            +str(switch)+ '''\']/ovsdb:queues[ovsdb:queue-id=\'QUEUE-'''\
-                            +str(cfg["no"])+'''\']"}'''
-    jdata +='''          ]}'''
-    return jdata
-
-def __generate_json_set_queue_queues(queue_id, max_rate, min_rate):    
-    jdata ='''    {   "queue-id": "'''+queue_id+'''",
-                        "queues-other-config": [
-                            {   "queue-other-config-key": "max-rate",
-                                "queue-other-config-value": "'''+str(max_rate)+'''"},
-                            {   "queue-other-config-key": "min-rate",
-                                "queue-other-config-value": "'''+str(min_rate)+'''"}]
-                    }'''
-    return jdata
+def __qos_entry_queues(port, queue_cfg_list):
+    # (queue number, queue id) of the default queue and the queues of the port
+    return [(0, port_queue_id(port))] + [(cfg["no"], port_queue_id(port, cfg["no"])) for cfg in sorted(queue_cfg_list, key=lambda cfg: cfg["no"])]
 
 def __generate_json_set_queue(switch, port_queue_cfg_list, total_rate, default_min_rate, default_max_rate):
     # queue_cfg_list is list of queue configurations, which must have q-no, min-rate, max-rate.
     # queue_cfg_list = [ {"no":20,"min-rate":2000000, "max-rate":90000000}, ...]
     # This will be put into: .../restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:{{ovs-node}}
-    switch_ip = sdcon_config.switch_dpid_to_ip(switch)
-    
-    jdata = '''{
-        "network-topology:node": [
-            {   "node-id": 'ovsdb:'''+str(switch)+'''',
-                "connection-info": {
-                    "ovsdb:remote-port": "6640",
-                    "ovsdb:remote-ip": "'''+switch_ip+'''"
-                  },
-                "ovsdb:qos-entries": ['''
-    jdata_add=[]
-    for port, queue_cfg_list in port_queue_cfg_list.items():
-        jdata_add.append( __generate_json_set_queue_qos_entries(switch, port, queue_cfg_list, total_rate) )
-    jdata += ",".join(jdata_add)
-    jdata +='''                    ],'''
-    jdata +='''            "ovsdb:queues": ['''
-    jdata_add=[]
-    for port, queue_cfg_list in port_queue_cfg_list.items():
+    qos_entries, queues = [], []
+    for port, queue_cfg_list in sorted(port_queue_cfg_list.items()):
+        qos_entries.append( (port_to_qosid(port), total_rate, __qos_entry_queues(port, queue_cfg_list)) )
         #For default port.
-        jdata_add.append(__generate_json_set_queue_queues("QUEUE-DEF-"+str(port), default_max_rate, default_min_rate))
-        for cfg in queue_cfg_list:
-            jdata_add.append(__generate_json_set_queue_queues("QUEUE-"+str(cfg["no"]), cfg['max-rate'], cfg['min-rate']))
-    jdata += ",".join(jdata_add)
-    jdata += ''' ] } ]}'''
-    return jdata
+        queues.append( (port_queue_id(port), default_max_rate, default_min_rate) )
+        for cfg in sorted(queue_cfg_list, key=lambda cfg: cfg["no"]):
+            queues.append( (port_queue_id(port, cfg["no"]), cfg['max-rate'], cfg['min-rate']) )
+    return network_payload.qos_node_json(switch, sdcon_config.switch_dpid_to_ip(switch), qos_entries, queues)
+
+def __generate_json_set_qos_entry(switch, port, queue_cfg_list, total_rate):
+    # This will be put into: .../node/ovsdb:{{ovs-node}}/ovsdb:qos-entries/{{qos-id}}
+    return network_payload.qos_entry_json(switch, port_to_qosid(port), total_rate, __qos_entry_queues(port, queue_cfg_list))
+
+def __generate_json_set_queue_entry(queue_id, max_rate, min_rate):
+    # This will be put into: .../node/ovsdb:{{ovs-node}}/ovsdb:queues/{{queue-id}}
+    return network_payload.queue_json(queue_id, max_rate, min_rate)
 
 def __generate_json_bind_port_qos(switch, port, qos_id):
-    ifname = sdcon_config.port_to_ifname(switch, port)
-    jdata ='''
-    {"network-topology:termination-point": [
-            {   "ovsdb:name": "'''+str(ifname)+'''",
-                "tp-id": "'''+str(ifname)+'''",
-                "ovsdb:qos-entry": [{
-                        "qos-key": 1,
-                        "qos-ref": "/network-topology:network-topology/network-topology:topology[network-topology'''\
-                        +''':topology-id='ovsdb:1']/network-topology:node[network-topology:node-id=\'ovsdb:'''\
-                        +str(switch)+'''\']/ovsdb:qos-entries[ovsdb:qos-id=\''''+str(qos_id)+'''\']"
-                    }] } ]}'''
-    return jdata
+    return network_payload.bind_port_qos_json(switch, sdcon_config.port_to_ifname(switch, port), qos_id)
+
+def __pace():
+    if QOS_FIXED_PACING:
+        sleep(0.3)
 
 def push_qos_queue_raw(base_url, id, pw, switch, json_data):
     print "Creating QoS and Queues in switch:"+switch
     url = base_url + '/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)
-    response = requests.put(url, data=json_data, auth=HTTPBasicAuth(id, pw), \
+    response = sdcon_rest.put(url, data=json_data, auth=HTTPBasicAuth(id, pw), \
         headers={"Accept":"application/json", "Content-Type":"application/json"})
-    sleep(0.3)
+    __pace()
+    if response.status_code != 200 and response.status_code != 201:
+        print url
+        print json_data
+        response.raise_for_status()
+
+def push_node_entry_raw(base_url, id, pw, switch, entry_path, json_data):
+    # entry_path: "ovsdb:qos-entries/<qos-id>" or "ovsdb:queues/<queue-id>"
+    print "Setting %s in switch:%s"%(entry_path, switch)
+    url = base_url + '/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'/'+entry_path
+    response = sdcon_rest.put(url, data=json_data, auth=HTTPBasicAuth(id, pw), \
+        headers={"Accept":"application/json", "Content-Type":"application/json"})
+    __pace()
     if response.status_code != 200 and response.status_code != 201:
         print url
         print json_data
@@ -213,26 +611,52 @@ def push_qos_queue_raw(base_url, id, pw, switch, json_data):
 def del_qos_raw(base_url, id, pw, switch, qos_id):
     print "Deleting QoS entry %s at %s"%(qos_id, switch)
     url = base_url + '/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'/ovsdb:qos-entries/'+str(qos_id)
-    response = requests.delete(url, auth=HTTPBasicAuth(id, pw),  headers={"Accept": "application/json"})
-    sleep(0.3)
+    response = sdcon_rest.delete(url, auth=HTTPBasicAuth(id, pw),  headers={"Accept": "application/json"})
+    __pace()
     if response.status_code != 200:
         print "Error: cannot delete QoS %s at %s!"%(qos_id, switch)
         print url
 
-def del_queue_raw(base_url, id, pw, switch, queue_no):
-    print "Deleting Queue no %s at %s..."%(queue_no, switch)
-    url = base_url + '/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'/ovsdb:queues/QUEUE-'+str(queue_no)
-    response = requests.delete(url, auth=HTTPBasicAuth(id, pw),  headers={"Accept": "application/json"})
-    sleep(0.3)
+def del_queue_raw(base_url, id, pw, switch, queue_id):
+    print "Deleting Queue %s at %s..."%(queue_id, switch)
+    url = base_url + '/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'/ovsdb:queues/'+str(queue_id)
+    response = sdcon_rest.delete(url, auth=HTTPBasicAuth(id, pw),  headers={"Accept": "application/json"})
+    __pace()
     if response.status_code != 200:
-        print "Error: cannot delete Queue %s at %s!"%(queue_no, switch)
+        print "Error: cannot delete Queue %s at %s!"%(queue_id, switch)
         print url
+        return False
+    return True
+
+# Returns the IDs of the queues in the config datastore of a switch (OVSDB node).
+def get_queue_ids_raw(base_url, id, pw, switch):
+    url = base_url + '/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)
+    response = sdcon_rest.get(url, auth=HTTPBasicAuth(id, pw), headers={"Accept": "application/json"})
+    if response.status_code == 404:
+        return []
+    response.raise_for_status()
+    return [queue["queue-id"] for node in response.json().get("node", []) for queue in node.get("ovsdb:queues", [])]
+
+# Returns the min-rate of the queues in the config datastore of a switch: dict[queue id] = bits per sec.
+def get_queue_min_rates_raw(base_url, id, pw, switch):
+    url = base_url + '/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)
+    response = sdcon_rest.get(url, auth=HTTPBasicAuth(id, pw), headers={"Accept": "application/json"})
+    if response.status_code == 404:
+        return {}
+    response.raise_for_status()
+    min_rates = {}
+    for node in response.json().get("node", []):
+        for queue in node.get("ovsdb:queues", []):
+            for cfg in queue.get("queues-other-config", []):
+                if cfg.get("queue-other-config-key") == "min-rate":
+                    min_rates[queue["queue-id"]] = int(float(cfg["queue-other-config-value"]))
+    return min_rates
 
 def push_bind_port_qos_raw(base_url, id, pw, switch, ifname, json_data):
     url = base_url + '/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'%2Fbridge%2Fovsbr0/termination-point/'+str(ifname)
-    response = requests.put(url, data=json_data, auth=HTTPBasicAuth(id, pw), \
+    response = sdcon_rest.put(url, data=json_data, auth=HTTPBasicAuth(id, pw), \
         headers={"Accept":"application/json", "Content-Type":"application/json"})
-    sleep(0.3)
+    __pace()
     if response.status_code != 200 and response.status_code != 201:
         print url
         print json_data
@@ -241,42 +665,91 @@ def push_bind_port_qos_raw(base_url, id, pw, switch, ifname, json_data):
 def del_bind_port_qos_raw(base_url, id, pw, switch, ifname, qos_id):
     print "Deleting port binding %s-%s at %s"%(ifname, qos_id, switch)
     url = base_url +'/restconf/config/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'%2Fbridge%2Fovsbr0/termination-point/'+str(ifname)+'/qos-entry/'+"1"
-    response = requests.delete(url, auth=HTTPBasicAuth(id, pw),  headers={"Accept": "application/json"})
-    sleep(0.3)
+    response = sdcon_rest.delete(url, auth=HTTPBasicAuth(id, pw),  headers={"Accept": "application/json"})
+    __pace()
     if response.status_code != 200:
         print "Error: cannot delete QoS %s attached at %s-%s!"%(qos_id, ifname, switch)
         print url
 
-def verify_oper_qos_raw(base_url, id, pw, switch, qos_id):
-    url = base_url + '/restconf/operational/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'/ovsdb:qos-entries/'+str(qos_id)
-    for i in range(5):
-        response = requests.get(url, auth=HTTPBasicAuth(id, pw), \
-            headers={"Accept": "application/json"})
-        if response.status_code == 200:
+def oper_qos_path(switch, qos_id):
+    return '/restconf/operational/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'/ovsdb:qos-entries/'+str(qos_id)
+
+def oper_bind_port_qos_path(switch, ifname):
+    return '/restconf/operational/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'%2Fbridge%2Fovsbr0/termination-point/'+str(ifname)+'/qos-entry/'+"1"
+
+# Polls the operational datastore until all paths exist (or, with present=False, are all removed).
+# ready(path, json data), if given, must also hold for an existing path.
+# All pending paths are checked in each round, with exponential backoff between rounds.
+# Returns dict[path] = json data. Raises HTTPError if paths are still missing at the deadline.
+def wait_oper_ready_raw(base_url, id, pw, paths, present=True, deadline=None, ready=None):
+    if deadline == None:
+        deadline = OPER_READY_DEADLINE
+    if QOS_FIXED_PACING and not present:
+        return {}   # Deletion was only paced by sleep()
+    end = time.time() + deadline
+    delay = OPER_POLL_INITIAL if not QOS_FIXED_PACING else 1.0
+    pending = list(paths)
+    data = {}
+    while True:
+        not_ready = []
+        for path in pending:
+            response = sdcon_rest.get(base_url + path, auth=HTTPBasicAuth(id, pw), \
+                headers={"Accept": "application/json"})
+            if (response.status_code == 200) != present:
+                not_ready.append(path)
+            elif present:
+                data[path] = response.json()
+                if ready != None and not ready(path, data[path]):
+                    not_ready.append(path)
+        pending = not_ready
+        if len(pending) == 0 or time.time() + delay > end:
             break
-        else:
-            print "!!!WARNING!!! verify_oper_qos_raw: %s, %s, retry:%d",(switch, qos_id,i)
-            sleep(1)
-    if i == 4:
-        print "!!!ERROR!!! QoS is not properly set. Exit"
-        response.raise_for_status()
-    return response.json()
+        sleep(delay)
+        if not QOS_FIXED_PACING:
+            delay = min(delay*2, OPER_POLL_MAX)
+    if len(pending) != 0:
+        print "!!!ERROR!!! %d operational entries are not %s after %.1f sec:"%(len(pending), "set" if present else "removed", deadline)
+        for path in pending:
+            print "  "+path
+        if present:
+            raise requests.exceptions.HTTPError("Operational datastore is not ready: "+pending[0])
+    return data
+
+def verify_oper_qos_raw(base_url, id, pw, switch, qos_id):
+    path = oper_qos_path(switch, qos_id)
+    return wait_oper_ready_raw(base_url, id, pw, [path])[path]
 
 def verify_oper_bind_port_qos_raw(base_url, id, pw, switch, ifname):
-    url = base_url + '/restconf/operational/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'%2Fbridge%2Fovsbr0/termination-point/'+str(ifname)
-    for i in range(5):
-        response = requests.get(url, auth=HTTPBasicAuth(id, pw), \
-            headers={"Accept": "application/json"})
-        if response.status_code == 200:
-            break
-        else:
-            print "!!!WARNING!!! verify_oper_bind_port_qos_raw: %s, %s, retry:%d",(switch, ifname,i)
-            sleep(1)
-    if i == 4:
-        print "!!!ERROR!!! Port bind is not properly set. Exit"
-        response.raise_for_status()
-    return response.json()
+    path = oper_bind_port_qos_path(switch, ifname)
+    return wait_oper_ready_raw(base_url, id, pw, [path])[path]
+
+def wait_oper_ready(paths, present=True, ready=None):
+    return wait_oper_ready_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, paths, present, ready=ready)
+
+# switch_ports: list of (switch, port)
+def wait_oper_qos(switch_ports):
+    wait_oper_ready([oper_qos_path(switch, port_to_qosid(port)) for switch, port in switch_ports])
 
+# Queue numbers in the queue-list of an operational QoS entry
+def get_qos_queue_numbers(data):
+    return set(int(queue["queue-number"]) for entry in data.get("ovsdb:qos-entries", []) for queue in entry.get("queue-list", []))
+
+# OVSDB does not delete a queue still referred to by a QoS entry: waits until the operational
+# QoS entries of the ports no longer list the removed queues.
+# switch_port_nos: dict[(switch, port)] = set of queue numbers removed from the QoS entry of the port
+def wait_oper_qos_unlisted(switch_port_nos):
+    paths = dict( (oper_qos_path(switch, port_to_qosid(port)), set(nos)) for (switch, port), nos in switch_port_nos.items() )
+    wait_oper_ready(sorted(paths), ready=lambda path, data: not (get_qos_queue_numbers(data) & paths[path]))
+
+def wait_oper_bind_port_qos(switch_ports, present=True):
+    wait_oper_ready([oper_bind_port_qos_path(switch, sdcon_config.port_to_ifname(switch, port)) for switch, port in switch_ports], present)
+
+# Queue numbers are per port, so the queue IDs in a switch (OVSDB node) include the port.
+# Without a queue number: the default queue of the port.
+def port_queue_id(port_no, queue_no=None):
+    if queue_no == None:
+        return "QUEUE-DEF-"+str(port_no)
+    return "QUEUE-"+str(port_no)+"-"+str(queue_no)
 
 def port_to_qosid(port_no):
     qos_id = "qos_port_"+str(port_no)
@@ -295,29 +768,55 @@ def unbind_port_qos(switch, port, qos_id):
     print "Unbinding port.. %s -- %s at %s"%(ifname, qos_id, switch)
     del_bind_port_qos_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, ifname, qos_id)
 
-def set_queue(switch, port_queue_cfg, total_rate, def_min=None, def_max=None):
+def push_queue(switch, port_queue_cfg, total_rate, def_min=None, def_max=None):
     if def_max == None:
         def_max = total_rate
     if def_min == None:
         def_min = total_rate*DEFAULT_MIN_BW_RATIO # 10%
-    # Set queue
     jdata = __generate_json_set_queue(switch, port_queue_cfg, total_rate, def_min, def_max)
     push_qos_queue_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, jdata)
-    # Bind a port to the queue
-    for port in port_queue_cfg.keys():
-        qos_id = port_to_qosid(port) 
-        verify_oper_qos_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, qos_id)
-        bind_port_qos(switch, port, qos_id)
-        verify_oper_bind_port_qos_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, sdcon_config.port_to_ifname(switch, port))
+
+def push_qos_entry(switch, port, queue_cfg_list, total_rate):
+    jdata = __generate_json_set_qos_entry(switch, port, queue_cfg_list, total_rate)
+    push_node_entry_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, "ovsdb:qos-entries/"+port_to_qosid(port), jdata)
+
+def push_queue_entry(switch, queue_id, max_rate, min_rate):
+    jdata = __generate_json_set_queue_entry(queue_id, max_rate, min_rate)
+    push_node_entry_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, "ovsdb:queues/"+queue_id, jdata)
+
+def bind_all_port_qos(switch, ports):
+    for port in ports:
+        bind_port_qos(switch, port, port_to_qosid(port))
+
+def set_queue(switch, port_queue_cfg, total_rate, def_min=None, def_max=None):
+    # Set queue
+    push_queue(switch, port_queue_cfg, total_rate, def_min, def_max)
+    # Bind ports to the queue, once the QoS entries are created in the switch.
+    switch_ports = [(switch, port) for port in port_queue_cfg.keys()]
+    wait_oper_qos(switch_ports)
+    bind_all_port_qos(switch, port_queue_cfg.keys())
+    wait_oper_bind_port_qos(switch_ports)
 
 def delete_queue(switch, port, queue_nos):
     qos_id = port_to_qosid(port)
     unbind_port_qos(switch, port, qos_id)
-    
+    # The QoS entry and its queues can be deleted after they are not referred any more.
+    wait_oper_bind_port_qos([(switch, port)], present=False)
     del_qos_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, qos_id)
+    wait_oper_ready([oper_qos_path(switch, qos_id)], present=False)
+    delete_queues(switch, port, queue_nos)
+
+def delete_queues(switch, port, queue_nos):
     for no in queue_nos:
-        del_queue_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, no)
-    del_queue_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, "DEF-"+str(port))
+        del_queue_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, port_queue_id(port, no))
+    del_queue_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, port_queue_id(port))
+
+# Deletes queues of a switch by their IDs. Raises HTTPError naming the queues not deleted.
+def delete_switch_queues(switch, queue_ids):
+    failed = [queue_id for queue_id in queue_ids
+        if not del_queue_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, queue_id)]
+    if failed:
+        raise requests.exceptions.HTTPError("Queues not deleted at %s: %s"%(switch, ", ".join(failed)))
 
 def delete_queue_with_cfg(switch, port, queue_cfg_list):
     queue_nos = []
@@ -325,36 +824,39 @@ def delete_queue_with_cfg(switch, port, queue_cfg_list):
         queue_nos.append( cfg["no"] )
     delete_queue(switch, port, queue_nos)
 
-def add_flow_enqueue(switch, port_no, queue_no, src_ip, dst_ip):
-    network_manager.add_flow(switch, str(port_no), network_manager.ODL_FLOW_PRIORITY_SPECIAL_PATH_QUEUE, 
+# Flow rule (network_manager.FlowRule) sending the traffic of a host pair to a queue of the port.
+def queue_flow_rule(switch, port_no, queue_no, src_ip, dst_ip):
+    return network_manager.FlowRule.make(switch, str(port_no), network_manager.ODL_FLOW_PRIORITY_SPECIAL_PATH_QUEUE,
         action_queue=str(queue_no), match_src_ip=src_ip, match_dst_ip=dst_ip, table_id=0, flowname = network_manager.FLOWNAME_SPECIAL_QUEUE)
 
-def del_flow_enqueue(switch, src_ip=None, dst_ip=None):
-    table_id="0"
-    flows = network_manager.get_flows(switch, table_id)
-    for fl in flows:
-        if network_manager.FLOWNAME_SPECIAL_QUEUE == fl['flow-name']:
-            if src_ip and dst_ip and src_ip in fl['match']['ipv4-source'] and dst_ip in fl['match']['ipv4-destination']:
-                try:
-                    network_manager.del_flow_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, table_id, fl['id'])
-                    sleep(0.3)
-                except:
-                    continue
-    sleep(0.3)
+def add_flow_enqueue(switch, port_no, queue_no, src_ip, dst_ip):
+    network_manager.push_flow(queue_flow_rule(switch, port_no, queue_no, src_ip, dst_ip))
+
+def del_flow_enqueue(switch, src_ip=None, dst_ip=None, view=None):
+    # Give a view (network_manager.SDCFlowTableView) to avoid reading the flow table again.
+    if view == None:
+        view = network_manager.SDCFlowTableView([switch], table_id=0)
+    if src_ip and dst_ip:
+        view.delete(view.find(flowname=network_manager.FLOWNAME_SPECIAL_QUEUE, src_ip=src_ip, dst_ip=dst_ip, switch=switch))
+    __pace()
 
 
 def del_all_queue_paths(topo):
     network_manager.del_all_flows_match_name(topo, network_manager.FLOWNAME_SPECIAL_QUEUE)
 
-def del_all_queues(topo, max_queue_no=10):
-    queue_nos = range(0, max_queue_no)
+# Deletes the QoS of all ports, then every queue named QUEUE-* found in the switches: the numbers
+# given by the allocator are not known after a restart, and older runs named queues QUEUE-<no>.
+def del_all_queues(topo):
     for switch, ports in topo.get_all_switches_with_port():
         for port in ports:
-            delete_queue(switch, port, queue_nos)
+            delete_queue(switch, port, [])
+        for queue_id in get_queue_ids_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch):
+            if queue_id.startswith("QUEUE-"):
+                del_queue_raw(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW, switch, queue_id)
     
 
 def all_clear():
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    topo = topo_discovery.get_topo()
     # Clear flows from forwarding tables
     del_all_queue_paths(topo)
     # Clear Queue settings from 
@@ -365,18 +867,43 @@ QOS_QUEUE = SDCQueues(NETWORK_MAX_BW_RATE)
 def add_entry(src_ip, dst_ip, min_bw, max_bw=NETWORK_MAX_BW_RATE):
     QOS_QUEUE.add_qos_bw(src_ip, dst_ip, min_bw, max_bw)
 
+def remove_entry(src_ip, dst_ip):
+    QOS_QUEUE.remove_reservation(src_ip, dst_ip)
+
+# Only the entries added or removed since the last call are pushed to the switches.
+# Each entry takes the ECMP path with the most headroom in the reservation ledger.
+# Returns the list of (src_ip, dst_ip) not admitted: their previous reservation (if any) is kept.
 def apply_qos():
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
-    QOS_QUEUE.build_qos_config(topo)
+    topo = topo_discovery.get_topo()
+    rejected = []
+    for (src_ip, dst_ip) in QOS_QUEUE.get_pending_pairs():
+        print "Build queue settings (%s->%s)"%(src_ip, dst_ip)
+        if not QOS_QUEUE.add_reservation(topo, src_ip, dst_ip, QOS_QUEUE.get_qos_minbw(src_ip, dst_ip), QOS_QUEUE.get_qos_maxbw(src_ip, dst_ip)):
+            QOS_QUEUE.discard_pending(src_ip, dst_ip)
+            rejected.append( (src_ip, dst_ip) )
     print "Queue configs..."
     print QOS_QUEUE.get_qos_config_dump()
-    QOS_QUEUE.install_all_queue_flow()
+    QOS_QUEUE.apply_changes()
+    return rejected
+
+# Min-rate that can still be reserved from the host (compute node IP) to its edge switch.
+# Raises KeyError for a host not in the topology.
+def get_host_free_bw(host_ip, topo=None):
+    if topo == None:
+        topo = topo_discovery.get_topo()
+    return QOS_QUEUE.ledger.get_host_headroom(topo, host_ip)
+
+# Reserves the queues installed by earlier runs in the ledger (see SDCQueues.seed_ledger()).
+def seed_ledger(topo=None):
+    if topo == None:
+        topo = topo_discovery.get_topo()
+    return QOS_QUEUE.seed_ledger(topo)
 
 def delete_qos():
     QOS_QUEUE.delete_all_queue_flow()
 
 def test_queue_manager(is_create):
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    topo = topo_discovery.get_topo()
     
     toal_rate=NETWORK_MAX_BW_RATE
     
@@ -384,7 +911,8 @@ def test_queue_manager(is_create):
     QOS_QUEUE.add_qos_bw("192.168.0.4", "192.168.0.7", 10000000, 20000000)
     QOS_QUEUE.add_qos_bw("192.168.0.4", "192.168.0.8", 50000000, toal_rate)
     
-    QOS_QUEUE.build_qos_config(topo)
+    for (src_ip, dst_ip) in QOS_QUEUE.build_qos_config(topo):
+        print "Warning: bandwidth from %s to %s is not allocated: not enough bandwidth left in the links"%(src_ip, dst_ip)
     print "Queue configs..."
     print QOS_QUEUE.get_qos_config_dump()
     print "Q-no at %s for %s -> %s: %s"%("40960021", "192.168.0.4", "192.168.0.7", str(QOS_QUEUE.get_queue_no("40960021", "192.168.0.4", "192.168.0.7")))
@@ -414,11 +942,315 @@ def test_queue_single(is_create):
         del_flow_enqueue(switch, src_ip, dst_ip)
         delete_queue_with_cfg(switch, port, queue_cfg)
 
+def bench_apply_qos(k=4, latency=0.002, oper_delay=0.05):
+    # End-to-end latency of applying and deleting QoS for host pairs in different pods,
+    # on a mock ODL where OVSDB changes reach the operational datastore after 'oper_delay' sec.
+    import sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    pairs = [(sdcon_mock.fattree_host_ip(0, 0, 0), sdcon_mock.fattree_host_ip(k-1, 0, 0)),
+        (sdcon_mock.fattree_host_ip(0, 0, 1), sdcon_mock.fattree_host_ip(k-1, 1, 0)),
+        (sdcon_mock.fattree_host_ip(1, 0, 0), sdcon_mock.fattree_host_ip(k-2, 0, 1))]
+    print "k=%d fat-tree, %d QoS pairs, mock ODL latency %.1f ms, operational delay %.0f ms"%(k, len(pairs), latency*1000, oper_delay*1000)
+    global QOS_FIXED_PACING
+    fixed_pacing = QOS_FIXED_PACING
+    url = sdcon_config.ODL_CONTROLLER_URL
+    for name, pacing in (("sleep(0.3) + 1 sec polling", True), ("readiness polling", False)):
+        server = sdcon_mock.MockODLServer(snapshot, latency=latency, oper_delay=oper_delay)
+        server.start()
+        sdcon_config.ODL_CONTROLLER_URL = server.url
+        QOS_FIXED_PACING = pacing
+        queues = SDCQueues(NETWORK_MAX_BW_RATE)
+        for src_ip, dst_ip in pairs:
+            queues.add_qos_bw(src_ip, dst_ip, 30000000, NETWORK_MAX_BW_RATE)
+        try:
+            with sdcon_mock.quiet():
+                start = time.time()
+                queues.build_qos_config(topo, lambda topo, src_ip, dst_ip: topo.find_all_path(src_ip, dst_ip)[0])
+                queues.install_all_queue_flow()
+                apply_time = time.time() - start
+                start = time.time()
+                queues.delete_all_queue_flow()
+                delete_time = time.time() - start
+        finally:
+            sdcon_config.ODL_CONTROLLER_URL = url
+            QOS_FIXED_PACING = fixed_pacing
+            server.stop()
+        print "  %-27s: apply %6.3f sec, delete %6.3f sec, %d requests"%(name, apply_time, delete_time, server.get_request_count())
+
+def test_reservation_ledger(k=4, ops=2000, seed=1):
+    # Random workloads of adding, updating and removing reservations (in memory, nothing is pushed),
+    # checked after every operation against a brute force over the queue configs:
+    # the ledger matches the min-rates of the queues, no port is oversubscribed, a reservation is
+    # rejected only if no ECMP path can admit it, and the admitted path has the most headroom.
+    import random, sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    hosts = sorted(topo.get_all_hosts_ip())
+    rnd = random.Random(seed)
+    queues = SDCQueues(NETWORK_MAX_BW_RATE)
+    capacity = queues.toal_rate
+    ledger = queues.ledger
+    errors = defaultdict(int)
+    admitted = rejected = 0
+    check_time, checks = 0.0, 0
+    
+    def port_min_rates():
+        rates = {}
+        for switch in queues.get_switches():
+            for port in queues.get_switch_ports(switch):
+                rates[(switch, port)] = sum(cfg["min-rate"] for cfg in queues.get_queue_cfg(switch, port))
+        return rates
+    
+    with sdcon_mock.quiet():
+        for i in range(ops):
+            pairs = list(queues.pair_links)
+            if pairs and rnd.random() < 0.3:
+                queues.remove_reservation(*rnd.choice(pairs))
+            else:
+                if pairs and rnd.random() < 0.3:
+                    src_ip, dst_ip = rnd.choice(pairs)    # Update
+                else:
+                    src_ip, dst_ip = rnd.sample(hosts, 2)
+                bw = rnd.randint(1, 40) * 1000000
+                rates = port_min_rates()
+                own = dict( (link, queues.get_qos_minbw(src_ip, dst_ip)) for link in queues.pair_links.get( (src_ip, dst_ip), []) )
+                admissible = []
+                for path in topo.find_all_path(src_ip, dst_ip):
+                    used = [rates.get(link, 0) - own.get(link, 0) for link in ledger.get_links(topo, path)]
+                    if all(u + bw <= capacity for u in used):
+                        admissible.append( ((max(used or [0]), sum(used)), path) )
+                start = time.time()
+                ok = ledger.can_admit(ledger.get_links(topo, topo.find_all_path(src_ip, dst_ip)[0]), bw, (src_ip, dst_ip))
+                check_time += time.time() - start
+                checks += 1
+                if ok != any(path == topo.find_all_path(src_ip, dst_ip)[0] for score, path in admissible):
+                    errors["can_admit differs from the brute force"] += 1
+                if queues.add_reservation(topo, src_ip, dst_ip, bw, NETWORK_MAX_BW_RATE):
+                    admitted += 1
+                    best = min(admissible, key=lambda a: a[0]) if admissible else None
+                    links = ledger.get_links(topo, best[1]) if best else None
+                    if best == None or queues.pair_links[(src_ip, dst_ip)] != links:
+                        errors["admitted path is not the one with the most headroom"] += 1
+                else:
+                    rejected += 1
+                    if admissible:
+                        errors["rejected while a path could admit it"] += 1
+            rates = dict( (link, bw) for link, bw in port_min_rates().items() if bw > 0 )
+            if rates != ledger.reserved:
+                errors["ledger differs from the queue min-rates"] += 1
+            if any(bw > capacity for bw in rates.values()):
+                errors["port oversubscribed"] += 1
+            for host_ip in rnd.sample(hosts, 2):
+                sent = sum(queues.get_qos_minbw(src_ip, dst_ip) for (src_ip, dst_ip) in queues.pair_links if src_ip == host_ip)
+                if ledger.get_host_headroom(topo, host_ip) != capacity - sent:
+                    errors["host headroom differs from the min-rates sent by the host"] += 1
+    print "k=%d fat-tree, %d random operations: %d admitted, %d rejected, %d reservations left, %.1f us per admission check"%(
+        k, ops, admitted, rejected, len(queues.pair_links), check_time/max(checks, 1)*1e6)
+    for name, count in sorted(errors.items()):
+        print "  FAILED: %s (%d times)"%(name, count)
+    return len(errors) == 0
+
+def test_queue_allocator(k=4, ops=2000, max_queues=8, seed=1, cycles=20):
+    # Random workloads (in memory) with a small cap per port: the numbers of each port are unique, within
+    # the cap, the lowest free ones, and all released after removing every reservation. Then delete/re-add
+    # cycles on the mock ODL must leave exactly the queues of the current reservations in OVSDB.
+    import random, sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    hosts = sorted(topo.get_all_hosts_ip())
+    rnd = random.Random(seed)
+    queues = SDCQueues(NETWORK_MAX_BW_RATE, max_queues)
+    errors = defaultdict(int)
+    rejected = 0
+    appended = defaultdict(int)    # Allocations per switch, as the switch-wide append index
+    max_no = 0
+    
+    def port_numbers():
+        numbers = {}
+        for switch in queues.get_switches():
+            for port in queues.get_switch_ports(switch):
+                numbers[(switch, port)] = [cfg["no"] for cfg in queues.get_queue_cfg(switch, port)]
+        return numbers
+    
+    with sdcon_mock.quiet():
+        for i in range(ops):
+            pairs = list(queues.pair_links)
+            before = port_numbers()
+            if pairs and rnd.random() < 0.4:
+                queues.remove_reservation(*rnd.choice(pairs))
+            else:
+                src_ip, dst_ip = rnd.sample(hosts, 2)
+                path = topo.find_all_path(src_ip, dst_ip)[rnd.randint(0, len(topo.find_all_path(src_ip, dst_ip))-1)]
+                links = queues.ledger.get_links(topo, path)
+                full = [link for link in links if len(before.get(link, [])) >= max_queues and link not in queues.pair_links.get( (src_ip, dst_ip), [])]
+                if queues.add_reservation(topo, src_ip, dst_ip, 100000, NETWORK_MAX_BW_RATE, path):
+                    if full:
+                        errors["admitted over the cap"] += 1
+                    for switch, port in links:
+                        appended[switch] += 1
+                else:
+                    rejected += 1
+                    if not full:
+                        errors["rejected below the cap"] += 1
+            after = port_numbers()
+            for link, numbers in after.items():
+                if len(set(numbers)) != len(numbers):
+                    errors["duplicate numbers in a port"] += 1
+                if any(no < QUEUE_NO_FIRST or no >= QUEUE_NO_FIRST + max_queues for no in numbers):
+                    errors["number out of the range"] += 1
+                if queues.allocator.get_count(*link) != len(numbers):
+                    errors["allocator count differs"] += 1
+                new = set(numbers) - set(before.get(link, []))
+                kept = set(numbers) & set(before.get(link, []))
+                lowest = [no for no in range(QUEUE_NO_FIRST, QUEUE_NO_FIRST + max_queues) if no not in kept][:len(new)]
+                if new and sorted(new) != lowest:
+                    errors["not the lowest free numbers"] += 1
+                max_no = max([max_no] + numbers)
+        for pair in list(queues.pair_links):
+            queues.remove_reservation(*pair)
+        if queues.allocator.used or queues.allocator.free or queues.allocator.next_no:
+            errors["numbers left after removing all"] += 1
+        
+        # Delete/re-add cycles on the mock ODL
+        url = sdcon_config.ODL_CONTROLLER_URL
+        server = sdcon_mock.MockODLServer(snapshot, latency=0, oper_delay=0.005)
+        server.start()
+        sdcon_config.ODL_CONTROLLER_URL = server.url
+        try:
+            queues = SDCQueues(NETWORK_MAX_BW_RATE, max_queues)
+            get_path = lambda topo, src_ip, dst_ip: topo.find_all_path(src_ip, dst_ip)[0]
+            pairs = []
+            while len(pairs) < 6:
+                pair = tuple(rnd.sample(hosts, 2))
+                if topo.get_connected_switch(pair[0]) != topo.get_connected_switch(pair[1]) and pair not in pairs:
+                    pairs.append(pair)
+            for i in range(cycles):
+                for pair in rnd.sample(pairs, 3):
+                    if queues.has_reservation(*pair):
+                        queues.remove_reservation(*pair)
+                    else:
+                        queues.add_reservation(topo, pair[0], pair[1], 1000000, NETWORK_MAX_BW_RATE, func_get_path=get_path)
+                queues.apply_changes()
+                time.sleep(0.02)
+                expected = set()
+                for (switch, port), numbers in port_numbers().items():
+                    expected.add( (switch, port_queue_id(port)) )
+                    expected.update( (switch, port_queue_id(port, no)) for no in numbers )
+                live = set()
+                for path, (added, removed, data) in server.oper_ovsdb.items():
+                    if removed == None and "/ovsdb:queues/" in path:
+                        live.add( (path.split("/")[2][len("ovsdb:"):], path.split("/")[-1]) )
+                if server.refused_deletes:
+                    errors["queue deleted while its QoS entry still listed it"] += server.refused_deletes
+                    server.refused_deletes = 0
+                if live != expected:
+                    errors["OVSDB queues differ from the reservations after a cycle"] += 1
+            
+            # A queue removed from a port still having other queues, with a slow operational datastore:
+            # deleted only after the QoS entry no longer lists it
+            src_ip = pairs[0][0]
+            others = [ip for ip in hosts if topo.get_connected_switch(ip) != topo.get_connected_switch(src_ip)][:2]
+            for dst_ip in others:
+                queues.add_reservation(topo, src_ip, dst_ip, 1000000, NETWORK_MAX_BW_RATE, func_get_path=get_path)
+            queues.apply_changes()
+            oper_delay, server.oper_delay = server.oper_delay, 0.3
+            try:
+                time.sleep(0.02)
+                queues.remove_reservation(src_ip, others[0])
+                if not queues.apply_changes().is_ok() or server.refused_deletes:
+                    errors["queue deleted while its QoS entry still listed it"] += 1
+            finally:
+                server.oper_delay = oper_delay
+            
+            # A new process seeds its ledger with the same reservations from the installed queues
+            seeded = SDCQueues(NETWORK_MAX_BW_RATE, max_queues)
+            seeded.seed_ledger(topo)
+            if seeded.ledger.reserved != queues.ledger.reserved or seeded.ledger.ingress != queues.ledger.ingress:
+                errors["ledger seeded from the installed queues differs"] += 1
+            
+            # Clear all, with a queue of the old switch-wide numbering left by an earlier run
+            old_switch = topo.get_connected_switch(pairs[0][0])
+            push_queue_entry(old_switch, "QUEUE-12", NETWORK_MAX_BW_RATE, 1000000)
+            del_all_queues(topo)
+            if any(removed == None and ("/ovsdb:queues/" in path or "qos-entr" in path) for path, (added, removed, data) in server.oper_ovsdb.items()):
+                errors["OVSDB QoS or queues left after clearing all"] += 1
+        finally:
+            sdcon_config.ODL_CONTROLLER_URL = url
+            server.stop()
+    print "k=%d fat-tree, %d random operations with %d queues per port: %d rejected at the cap"%(k, ops, max_queues, rejected)
+    print "  largest queue number: %d (switch-wide append index would reach %d)"%(max_no, max(appended.values() or [0]) + 9)
+    print "  %d delete/re-add cycles on the mock ODL, then a ledger seeded from the installed queues"%(cycles)
+    for name, count in sorted(errors.items()):
+        print "  FAILED: %s (%d times)"%(name, count)
+    return len(errors) == 0
+
+def bench_incremental_qos(k=4, num_pairs=16, latency=0.002, oper_delay=0.05, seed=1):
+    # Adding and removing one reservation in a fabric with 'num_pairs' reservations installed:
+    # rebuilding and pushing all queues vs. pushing only the changes.
+    import random, sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    hosts = sorted(topo.get_all_hosts_ip())
+    rnd = random.Random(seed)
+    pairs = []
+    while len(pairs) < num_pairs + 1:
+        src_ip, dst_ip = rnd.sample(hosts, 2)
+        if topo.get_connected_switch(src_ip) != topo.get_connected_switch(dst_ip) and (src_ip, dst_ip) not in pairs:
+            pairs.append( (src_ip, dst_ip) )
+    new_pair = pairs.pop()
+    get_path = lambda topo, src_ip, dst_ip: topo.find_all_path(src_ip, dst_ip)[0]
+    print "k=%d fat-tree, %d reservations installed, mock ODL latency %.1f ms, operational delay %.0f ms"%(k, len(pairs), latency*1000, oper_delay*1000)
+    
+    url = sdcon_config.ODL_CONTROLLER_URL
+    server = sdcon_mock.MockODLServer(snapshot, latency=latency, oper_delay=oper_delay)
+    server.start()
+    sdcon_config.ODL_CONTROLLER_URL = server.url
+    results = []
+    try:
+        with sdcon_mock.quiet():
+            for name in ("full rebuild", "incremental"):
+                queues = SDCQueues(NETWORK_MAX_BW_RATE)
+                for src_ip, dst_ip in pairs:
+                    queues.add_qos_bw(src_ip, dst_ip, 3000000, NETWORK_MAX_BW_RATE)
+                queues.build_qos_config(topo, get_path)
+                queues.install_all_queue_flow()
+                queue_nos = dict( (sw, dict(queues.switch_qno[sw])) for sw in queues.get_switches() )
+                for step in ("add", "remove"):
+                    count = server.get_request_count()
+                    start = time.time()
+                    if name == "full rebuild":
+                        if step == "add":
+                            queues.add_qos_bw(new_pair[0], new_pair[1], 3000000, NETWORK_MAX_BW_RATE)
+                        else:
+                            queues.del_qos_bw(new_pair[0], new_pair[1])
+                        queues.build_qos_config(topo, get_path)
+                        queues.install_all_queue_flow()
+                    else:
+                        if step == "add":
+                            queues.add_reservation(topo, new_pair[0], new_pair[1], 3000000, NETWORK_MAX_BW_RATE, func_get_path=get_path)
+                        else:
+                            queues.remove_reservation(new_pair[0], new_pair[1])
+                        queues.apply_changes()
+                    elapsed = time.time() - start
+                    renumbered = len([pair for sw in queue_nos for pair, no in queue_nos[sw].items() if queues.switch_qno[sw].get(pair) != no])
+                    results.append( (name, step, elapsed, server.get_request_count() - count, renumbered) )
+                queues.delete_all_queue_flow()
+    finally:
+        sdcon_config.ODL_CONTROLLER_URL = url
+        server.stop()
+    for (name, step, elapsed, requests, renumbered) in results:
+        print "  %-12s %-6s one reservation: %6.3f sec, %4d requests, %d queues of other pairs renumbered"%(name, step, elapsed, requests, renumbered)
+
 # Main
 def _print_usage():
     print("Usage:\t python %s test-set \t- creating a test queue"%(sys.argv[0]))
     print("      \t python %s test-del \t- delete the test queue"%(sys.argv[0]))
     print("      \t python %s clear \t- clears all queue flows from forwarding table and QoS and Queue settings from OVS"%(sys.argv[0]))
+    print("      \t python %s bench [k] \t- benchmark applying QoS on a mock ODL (default: k=4)"%(sys.argv[0]))
+    print("      \t python %s test-ledger [k] [ops] \t- check the bandwidth reservation ledger on random workloads (default: k=4, 2000 operations)"%(sys.argv[0]))
+    print("      \t python %s test-allocator [k] [ops] \t- check the queue numbers of each port on random workloads and on a mock ODL (default: k=4, 2000 operations)"%(sys.argv[0]))
+    print("      \t python %s bench-incremental [k] [num_pairs] \t- benchmark adding/removing one reservation on a mock ODL (default: k=4, 16 pairs)"%(sys.argv[0]))
 
 # Main
 def main():
@@ -436,6 +1268,18 @@ def main():
         test_queue_single(False)
     elif sys.argv[1] == "clear":
         all_clear()        
+    elif sys.argv[1] == "bench":
+        bench_apply_qos(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    elif sys.argv[1] == "test-ledger":
+        ok = test_reservation_ledger(int(sys.argv[2]) if len(sys.argv) > 2 else 4, int(sys.argv[3]) if len(sys.argv) > 3 else 2000)
+        print "\nReservation ledger: %s"%("OK" if ok else "FAILED")
+        sys.exit(0 if ok else 1)
+    elif sys.argv[1] == "test-allocator":
+        ok = test_queue_allocator(int(sys.argv[2]) if len(sys.argv) > 2 else 4, int(sys.argv[3]) if len(sys.argv) > 3 else 2000)
+        print "\nQueue number allocator: %s"%("OK" if ok else "FAILED")
+        sys.exit(0 if ok else 1)
+    elif sys.argv[1] == "bench-incremental":
+        bench_incremental_qos(int(sys.argv[2]) if len(sys.argv) > 2 else 4, int(sys.argv[3]) if len(sys.argv) > 3 else 16)
     else:
         _print_usage()
         return
@@ -5,7 +5,8 @@
 #
 # Copyright (c) 2018, The University of Melbourne, Australia
 #
-import sys
+import sys, time, threading, traceback
+from array import array
 import network_monitor_sflow
 import topo_discovery, sdcon_config
 from sdcon_config import SDCNodeIdType
@@ -15,6 +16,8 @@ from collections import defaultdict
 SFLOW_FLOW_NORMAL = "ip_flows"
 SFLOW_FLOW_TUNNEL = 'tunnel_flows'
 
+LINK_MONITOR_INTERVAL = 2.0 # Seconds between link utilization samples (SDCLinkMonitor)
+
 ## BW usage monitor functions...
 def get_bw_usage_flow(src_ip, dst_ip, switch_dpid = "ALL"):
     # BW is a incoming bandwidth at the port (dataSource-2) of the switch.
@@ -91,7 +94,7 @@ def get_bw_usage_port_incoming(switch_dpid, switch_port, exclude_src_ip=None, ex
     if exclude_src_ip and exclude_dst_ip:
         exclude_key = exclude_src_ip +","+ exclude_dst_ip
     
-    json_object = network_monitor_sflow.get_sflow_dump(sdcon_config.SFLOW_COLLECTOR_URL, SFLOW_FLOW_NORMAL, agent_ip)
+    json_object = get_sflow_dump(SFLOW_FLOW_NORMAL, agent_ip)
     bw = __parse_dump_get_bw_at_port(json_object, data_source, exclude_key)
     return bw
 
@@ -102,7 +105,7 @@ def get_bw_usage_all_incoming(exclude_src_ip=None, exclude_dst_ip=None, flow_nam
     if exclude_src_ip and exclude_dst_ip:
         exclude_key = exclude_src_ip +","+ exclude_dst_ip
     
-    json_object = network_monitor_sflow.get_sflow_dump(sdcon_config.SFLOW_COLLECTOR_URL, flow_name, "ALL")
+    json_object = get_sflow_dump(flow_name)
     switch_port_bw = __parse_dump_get_bw_all(json_object, exclude_key)
     return switch_port_bw
 
@@ -110,7 +113,7 @@ def get_bw_usage_all_incoming(exclude_src_ip=None, exclude_dst_ip=None, flow_nam
 # For example, [ (40960020, 1, "192.168.0.1,192.168.0.9", 134), ...]
 def get_bw_usage_all_link_flows(flow_name = SFLOW_FLOW_NORMAL):
     # Debug: SFLOW_COLLECTOR_URL/dump/ALL/ip_flows/json
-    json_object = network_monitor_sflow.get_sflow_dump(sdcon_config.SFLOW_COLLECTOR_URL, flow_name, "ALL")
+    json_object = get_sflow_dump(flow_name)
     switch_port_flow_bw = __parse_dump_get_bw_pair(json_object)
     return switch_port_flow_bw
 
@@ -135,31 +138,376 @@ def monitor_get_current_path_switches(src_ip, dst_ip):
         ports.append(sdcon_config.data_source_to_port(switch_dpid, data_source))
     return switches, ports
 
-def monitor_get_current_path(topo, src_ip, dst_ip):
-    current_switches, ports = monitor_get_current_path_switches(src_ip, dst_ip)
-    all_paths = topo.find_all_path(src_ip, dst_ip)
-    intersect_num=[]
-    
-    for path in all_paths:
-        intersect_num.append( len(set(path) & set(current_switches)))
+# Infers the current path of host pairs from the (switch, inport) where sFlow sees their flow.
+# Candidate paths are matched by their sets of (switch, inport), then of switches, which are
+# computed once per pair and topology version. The inferred path is kept for the seen locations,
+# so that the same locations are not matched again.
+class SDCPathInference:
+    def __init__(self):
+        self.candidates = {}    # dict[(src_ip, dst_ip)] = (topo version, [(path, links set, switches set), ...])
+        self.paths = {}         # dict[(src_ip, dst_ip)] = (topo version, locations, path)
+        self.hits = 0
+        self.misses = 0
     
-    cur_path_index = intersect_num.index(max(intersect_num))
-    cur_path = all_paths[cur_path_index]
+    def __get_candidates(self, topo, src_ip, dst_ip):
+        cached = self.candidates.get( (src_ip, dst_ip) )
+        if cached == None or cached[0] != topo.version:
+            candidates = []
+            for path in topo.find_all_path(src_ip, dst_ip):
+                port_map = topo.get_switch_port_map(path)
+                candidates.append( (path, frozenset( (switch, str(inport)) for (inport, switch, outport) in port_map ),
+                    frozenset(switch for (inport, switch, outport) in port_map)) )
+            cached = (topo.version, candidates)
+            self.candidates[(src_ip, dst_ip)] = cached
+        return cached[1]
     
-    # Verification
-    if len(cur_path) > intersect_num[cur_path_index]+2: # 2 extra for host endpoint
-        print "=========================="
-        print "Error:monitor_get_current_path() cannot find a path!"
-        print "All paths=",all_paths
-        print "Swithces=",current_switches
-        print "Returning the first path instead..."
-        print "=========================="
-    return cur_path
+    # locations: (switch, inport) of the flow seen by sFlow
+    def get_path(self, topo, src_ip, dst_ip, locations):
+        locations = frozenset( (switch, str(port)) for switch, port in locations )
+        cached = self.paths.get( (src_ip, dst_ip) )
+        if cached != None and cached[0] == topo.version and cached[1] == locations:
+            self.hits += 1
+            return cached[2]
+        self.misses += 1
+        switches = frozenset(switch for switch, port in locations)
+        candidates = self.__get_candidates(topo, src_ip, dst_ip)
+        scores = [(len(links & locations), len(nodes & switches)) for path, links, nodes in candidates]
+        best = scores.index(max(scores))
+        cur_path = candidates[best][0]
+        
+        # Verification
+        if len(cur_path) > scores[best][1]+2: # 2 extra for host endpoint
+            print "=========================="
+            print "Error:monitor_get_current_path() cannot find a path!"
+            print "All paths=",[c[0] for c in candidates]
+            print "Swithces=",sorted(switches)
+            print "Returning the first path instead..."
+            print "=========================="
+        self.paths[(src_ip, dst_ip)] = (topo.version, locations, cur_path)
+        return cur_path
+
+path_inference = SDCPathInference()
+
+def monitor_get_current_path(topo, src_ip, dst_ip):
+    switches, ports = monitor_get_current_path_switches(src_ip, dst_ip)
+    return path_inference.get_path(topo, src_ip, dst_ip, zip(switches, ports))
+
+def monitor_get_current_paths(topo, pairs, flow_name = SFLOW_FLOW_NORMAL):
+    # Current paths of many (src_ip, dst_ip) pairs from one /dump/ALL, instead of a /flowlocations request per pair.
+    # Returns dict[(src_ip, dst_ip)] = path
+    locations = defaultdict(list)   # dict[flow key] = [(switch, inport), ...]
+    for switch_dpid, port_flows in __parse_dump_get_bw_pair(get_sflow_dump(flow_name) or []).items():
+        for port, flow_bw_pairs in port_flows:
+            for key, bw in flow_bw_pairs:
+                locations[key].append( (switch_dpid, port) )
+    paths = {}
+    for src_ip, dst_ip in pairs:
+        paths[(src_ip, dst_ip)] = path_inference.get_path(topo, src_ip, dst_ip, locations.get(src_ip+","+dst_ip, []))
+    return paths
 
 def monitor_get_current_path_port_map(topo, src_ip, dst_ip):
     path = monitor_get_current_path(topo, src_ip, dst_ip)
     return topo.get_switch_port_map(path)
 
+#####################################
+## Link utilization updates
+#####################################
+# Incoming BW of all switch ports at a time, from one /dump/ALL request.
+class SDCLinkSample:
+    def __init__(self, switch_port_flow_bw, timestamp=None):
+        self.time = timestamp if timestamp != None else time.time()
+        self.flow_bw = {}   # dict[(switch, port)] = dict[flow key] = bytes/sec, e.g. flow key "192.168.0.1,192.168.0.9"
+        self.link_bw = {}   # dict[(switch, port)] = bytes/sec
+        for switch, port_flows in switch_port_flow_bw.items():
+            for port, flow_bw_pairs in port_flows:
+                flows = self.flow_bw.setdefault( (switch, port), {} )
+                for key, bw in flow_bw_pairs:
+                    flows[key] = flows.get(key, 0.0) + bw
+                self.link_bw[(switch, port)] = sum(flows.values())
+    
+    def get_bw(self, switch, port, exclude_key=None):
+        bw = self.link_bw.get( (switch, str(port)), 0.0 )
+        if exclude_key:
+            bw -= self.flow_bw.get( (switch, str(port)), {} ).get(exclude_key, 0.0)
+        return bw
+    
+    def get_flow_bw(self, key):
+        # Max BW of a flow on any port
+        return max([flows.get(key, 0.0) for flows in self.flow_bw.values()] or [0.0])
+
+def get_link_sample(flow_name = SFLOW_FLOW_NORMAL):
+    return SDCLinkSample(get_bw_usage_all_link_flows(flow_name))
+
+# Publishes link utilization to subscribers every 'interval' seconds:
+#     monitor = SDCLinkMonitor()
+#     monitor.subscribe(lambda sample: ...)    # sample: SDCLinkSample
+#     monitor.start()
+class SDCLinkMonitor:
+    def __init__(self, interval=None, flow_name=SFLOW_FLOW_NORMAL):
+        self.interval = interval or LINK_MONITOR_INTERVAL
+        self.flow_name = flow_name
+        self.subscribers = []
+        self.thread = None
+        self.running = False
+    
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+    
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+    
+    def poll(self):
+        # Takes one sample and passes it to the subscribers.
+        sample = get_link_sample(self.flow_name)
+        for callback in list(self.subscribers):
+            try:
+                callback(sample)
+            except Exception as e:
+                print "Error: link utilization subscriber failed:", e
+                traceback.print_exc()
+        return sample
+    
+    def __run(self):
+        while self.running:
+            start = time.time()
+            try:
+                self.poll()
+            except Exception as e:
+                print "Error: link utilization sample failed:", e
+            time.sleep(max(0.0, self.interval - (time.time() - start)))
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+
+#####################################
+## Link utilization matrix
+#####################################
+# Incoming BW of all switch ports in one array (topo_discovery.SDCLinkIndex), from one /dump/ALL request.
+# Candidate paths are scored by indexed sums, instead of a /dump request per switch along each path:
+#     matrix = get_utilization_matrix(topo)
+#     bws = matrix.score_paths(topo.find_all_path(src_ip, dst_ip), exclude_key=src_ip+","+dst_ip)
+class SDCUtilizationMatrix:
+    def __init__(self, link_index, json_object=None):
+        self.link_index = link_index
+        self.bw = array('d', [0.0]) * len(link_index)  # bytes/sec at each port
+        self.flow_bw = {}   # dict[flow key] = dict[index] = bytes/sec of the flow, for exclusion
+        for js in json_object or []:
+            switch_dpid = sdcon_config.switch_ip_to_dpid(js['agent'])
+            index = link_index.get(switch_dpid, sdcon_config.data_source_to_port(switch_dpid, int(js['dataSource'])))
+            if index == None:
+                continue    # Port not in the topology
+            for topkey in js.get('topKeys', []):
+                self.bw[index] += topkey['value']
+                flow = self.flow_bw.setdefault(topkey['key'], {})
+                flow[index] = flow.get(index, 0.0) + topkey['value']
+    
+    def get_bw(self, switch, port, exclude_key=None):
+        index = self.link_index.get(switch, port)
+        if index == None:
+            return 0.0
+        return self.bw[index] - self.flow_bw.get(exclude_key, {}).get(index, 0.0)
+    
+    def score_path(self, path, exclude_key=None):
+        # Total incoming BW along the path, as get_bw_usage_along_links()
+        links = self.link_index.get_path_links(path)
+        bw = self.bw
+        total = sum(bw[i] for i in links)
+        exclude = self.flow_bw.get(exclude_key)
+        if exclude:
+            total -= sum(exclude.get(i, 0.0) for i in links)
+        return total
+    
+    def score_paths(self, paths, exclude_key=None):
+        return [self.score_path(path, exclude_key) for path in paths]
+    
+    def get_low_utilization_path(self, paths, exclude_key=None):
+        scores = self.score_paths(paths, exclude_key)
+        return paths[scores.index(min(scores))]
+
+def get_utilization_matrix(topo, flow_name = SFLOW_FLOW_NORMAL):
+    # Debug: SFLOW_COLLECTOR_URL/dump/ALL/ip_flows/json
+    json_object = get_sflow_dump(flow_name)
+    return SDCUtilizationMatrix(topo.get_link_index(), json_object)
+
+#####################################
+## Background sampler
+#####################################
+# Polls /dump/ALL every SFLOW_SAMPLER_INTERVAL sec into a ring buffer of the last SFLOW_SAMPLER_HISTORY
+# samples of each (agent, dataSource, flow key), and of each port total (flow key None).
+# While a sampler of a flow name is running, the functions of this module (and so sdc_viz, path
+# selection, link samples) read the dump from it instead of sFlow-RT, with the SFLOW_SAMPLER_VIEW values:
+#     "last" : the latest sample
+#     "ewma" : exponentially weighted moving average (SFLOW_SAMPLER_EWMA_ALPHA)
+#     "pNN"  : NN-th percentile of the history, e.g. "p95"
+# Memory is bounded: a series without traffic for the whole history is dropped, and no more than
+# SFLOW_SAMPLER_MAX_SERIES series are kept.
+SFLOW_SAMPLER_INTERVAL = 1.0
+SFLOW_SAMPLER_HISTORY = 300
+SFLOW_SAMPLER_EWMA_ALPHA = 0.2
+SFLOW_SAMPLER_MAX_SERIES = 20000
+SFLOW_SAMPLER_VIEW = "last"
+
+class SDCRingSeries:
+    __slots__ = ('values', 'start', 'ewma', 'idle')
+    def __init__(self, size, start):
+        self.values = array('d', [0.0]) * size
+        self.start = start      # First tick of the series
+        self.ewma = None
+        self.idle = 0           # Ticks since the last non-zero value
+
+class SDCSFlowSampler:
+    def __init__(self, flow_name=SFLOW_FLOW_NORMAL, interval=None, history=None, max_series=None):
+        self.flow_name = flow_name
+        self.interval = interval or SFLOW_SAMPLER_INTERVAL
+        self.history = history or SFLOW_SAMPLER_HISTORY
+        self.max_series = max_series or SFLOW_SAMPLER_MAX_SERIES
+        self.times = array('d', [0.0]) * self.history   # Time of each tick
+        self.tick = 0           # Number of samples taken
+        self.series = {}        # dict[(agent, dataSource, flow key or None)] = SDCRingSeries
+        self.dropped = 0        # New series not kept (max_series)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+    
+    def add_sample(self, json_object, timestamp=None):
+        # Adds one /dump/ALL response as the next tick.
+        values = {}
+        for js in json_object:
+            port = (js['agent'], str(js['dataSource']))
+            total = 0.0
+            for topkey in js.get('topKeys', []):
+                values[port + (topkey['key'],)] = values.get(port + (topkey['key'],), 0.0) + topkey['value']
+                total += topkey['value']
+            values[port + (None,)] = values.get(port + (None,), 0.0) + total
+        alpha = SFLOW_SAMPLER_EWMA_ALPHA
+        with self.lock:
+            pos = self.tick % self.history
+            self.times[pos] = timestamp if timestamp != None else time.time()
+            for key, value in values.items():
+                if key not in self.series:
+                    if len(self.series) >= self.max_series:
+                        self.dropped += 1
+                        continue
+                    self.series[key] = SDCRingSeries(self.history, self.tick)
+            for key, series in self.series.items():
+                value = values.get(key, 0.0)
+                series.values[pos] = value
+                series.ewma = value if series.ewma == None else alpha * value + (1 - alpha) * series.ewma
+                series.idle = 0 if value else series.idle + 1
+                if series.idle >= self.history:
+                    del self.series[key]
+            self.tick += 1
+    
+    def poll(self):
+        json_object = network_monitor_sflow.get_sflow_dump(sdcon_config.SFLOW_COLLECTOR_URL, self.flow_name, "ALL")
+        if json_object != None:
+            self.add_sample(json_object)
+    
+    def __get_history(self, series):
+        # Values of the series in the buffer, oldest first
+        count = min(self.tick - series.start, self.history)
+        pos = self.tick % self.history
+        return [series.values[(pos - count + i) % self.history] for i in range(count)]
+    
+    def __get_value(self, series, view):
+        if view == "last":
+            return series.values[(self.tick - 1) % self.history]
+        if view == "ewma":
+            return series.ewma
+        if view.startswith("p"):
+            values = sorted(self.__get_history(series))
+            return values[min(len(values) - 1, int(len(values) * float(view[1:]) / 100))]
+        raise ValueError("Unknown sampler view: %s"%(view))
+    
+    def get_value(self, agent, data_source, key=None, view=None):
+        # BW of a flow (or of all flows with key None) at the port, e.g. get_value("192.168.99.120", "3", view="p95")
+        with self.lock:
+            series = self.series.get( (agent, str(data_source), key) )
+            if series == None or self.tick == 0:
+                return 0.0
+            return self.__get_value(series, view or SFLOW_SAMPLER_VIEW)
+    
+    def get_history(self, agent, data_source, key=None):
+        # [(time, bytes/sec), ...] oldest first
+        with self.lock:
+            series = self.series.get( (agent, str(data_source), key) )
+            if series == None:
+                return []
+            values = self.__get_history(series)
+            pos = self.tick - len(values)
+            return [(self.times[(pos + i) % self.history], v) for i, v in enumerate(values)]
+    
+    def get_dump(self, agent="ALL", view=None):
+        # The sampled BW in the format of /dump/<agent>/<flow name>/json
+        view = view or SFLOW_SAMPLER_VIEW
+        dump = {}
+        with self.lock:
+            if self.tick == 0:
+                return None
+            for (series_agent, data_source, key), series in self.series.items():
+                if key == None or (agent != "ALL" and series_agent != agent):
+                    continue
+                value = self.__get_value(series, view)
+                if value:
+                    js = dump.setdefault( (series_agent, data_source), {'agent': series_agent, 'dataSource': data_source, 'metricName': self.flow_name, 'topKeys': []} )
+                    js['topKeys'].append( {'key': key, 'value': value} )
+        return [dump[k] for k in sorted(dump)]
+    
+    def get_memory_size(self):
+        # Bytes of the sample arrays
+        with self.lock:
+            return (len(self.series) + 1) * self.history * self.times.itemsize
+    
+    def __run(self):
+        while self.running:
+            start = time.time()
+            try:
+                self.poll()
+            except Exception as e:
+                print "Error: sFlow sampler failed:", e
+            time.sleep(max(0.0, self.interval - (time.time() - start)))
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+
+samplers = {}   # dict[flow name] = running SDCSFlowSampler
+
+def start_sampler(flow_name=SFLOW_FLOW_NORMAL, interval=None, history=None):
+    if flow_name not in samplers:
+        sampler = SDCSFlowSampler(flow_name, interval, history)
+        sampler.start()
+        samplers[flow_name] = sampler
+    return samplers[flow_name]
+
+def stop_sampler(flow_name=SFLOW_FLOW_NORMAL):
+    sampler = samplers.pop(flow_name, None)
+    if sampler:
+        sampler.stop()
+
+def get_sampler(flow_name=SFLOW_FLOW_NORMAL):
+    return samplers.get(flow_name)
+
+def get_sflow_dump(flow_name, agent="ALL"):
+    # From the sampler of the flow name if running, otherwise from sFlow-RT.
+    sampler = samplers.get(flow_name)
+    if sampler != None:
+        json_object = sampler.get_dump(agent)
+        if json_object != None:
+            return json_object
+    return network_monitor_sflow.get_sflow_dump(sdcon_config.SFLOW_COLLECTOR_URL, flow_name, agent)
+
 def start_monitor():
     network_monitor_sflow.set_sflow_flow(sdcon_config.SFLOW_COLLECTOR_URL, SFLOW_FLOW_NORMAL, ['ipsource','ipdestination'], 'bytes')
     network_monitor_sflow.set_sflow_flow(sdcon_config.SFLOW_COLLECTOR_URL, SFLOW_FLOW_TUNNEL, ['ipsource.1','ipdestination.1'], 'bytes')
@@ -168,10 +516,181 @@ def start_monitor():
 ## Test
 #####################################
 
+def __bench_flows(k, num_flows, seed):
+    # A mock sFlow-RT with num_flows pairs between pods, each with traffic on a random one of its paths.
+    # Returns (topo, pairs, dict[pair] = path, mock server)
+    import random, sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    rnd = random.Random(seed)
+    hosts = sorted(topo.get_all_hosts_ip())
+    pairs, paths, locations = [], {}, {}
+    while len(pairs) < num_flows:
+        src_ip, dst_ip = rnd.sample(hosts, 2)
+        if (src_ip, dst_ip) in paths or src_ip.split(".")[1] == dst_ip.split(".")[1]:
+            continue    # Same pod
+        pairs.append( (src_ip, dst_ip) )
+        paths[(src_ip, dst_ip)] = rnd.choice(topo.find_all_path(src_ip, dst_ip))
+        locations[(src_ip, dst_ip)] = [(switch, inport) for (inport, switch, outport) in topo.get_switch_port_map(paths[(src_ip, dst_ip)])]
+    server = sdcon_mock.MockSFlowServer(lambda src_ip, dst_ip: locations[(src_ip, dst_ip)])
+    for src_ip, dst_ip in pairs:
+        server.set_rate(src_ip, dst_ip, rnd.randint(1, 100) * 10000)
+    return topo, pairs, paths, server
+
+def __start_bench_sflow(server):
+    # Agent IPs of the testbed (192.168.99.1AB) cover switches 409600AB only: one IP per switch of larger fat-trees.
+    saved = (sdcon_config.SFLOW_COLLECTOR_URL, sdcon_config.switch_dpid_to_ip, sdcon_config.switch_ip_to_dpid)
+    server.start()
+    sdcon_config.SFLOW_COLLECTOR_URL = server.url
+    sdcon_config.switch_dpid_to_ip = lambda dpid: dpid if dpid == "ALL" else "10.99.%d.%d"%(int(dpid[4:6]), int(dpid[6:]))
+    sdcon_config.switch_ip_to_dpid = lambda ip: ip if ip == "ALL" else "4096%02d%02d"%tuple(int(x) for x in ip.split(".")[2:])
+    start_monitor()
+    return saved
+
+def __stop_bench_sflow(server, saved):
+    sdcon_config.SFLOW_COLLECTOR_URL, sdcon_config.switch_dpid_to_ip, sdcon_config.switch_ip_to_dpid = saved
+    server.stop()
+
+def bench_path_scoring(k=8, num_flows=100, seed=1):
+    # Ranks the ECMP paths of num_flows pairs between pods (16 paths each for k=8) on a mock sFlow-RT:
+    # a /dump request per switch of each path vs. one matrix.
+    topo, pairs, paths, server = __bench_flows(k, num_flows, seed)
+    num_paths = sum(len(topo.find_all_path(src_ip, dst_ip)) for src_ip, dst_ip in pairs)
+    print "k=%d fat-tree, %d flows, %d candidate paths"%(k, len(pairs), num_paths)
+    saved = __start_bench_sflow(server)
+    results = []
+    try:
+        for name in ("per-switch dump", "one matrix"):
+            server.reset_counters()
+            start = time.time()
+            if name == "per-switch dump":
+                selected = []
+                for src_ip, dst_ip in pairs:
+                    paths = topo.find_all_path(src_ip, dst_ip)
+                    bws = [get_bw_usage_along_links(topo, path, src_ip, dst_ip) for path in paths]
+                    selected.append(paths[bws.index(min(bws))])
+            else:
+                matrix = get_utilization_matrix(topo)
+                selected = [matrix.get_low_utilization_path(topo.find_all_path(src_ip, dst_ip), src_ip+","+dst_ip) for src_ip, dst_ip in pairs]
+            results.append( (name, time.time() - start, server.get_request_count(), selected) )
+    finally:
+        __stop_bench_sflow(server, saved)
+    for name, elapsed, num_requests, selected in results:
+        print "  %-16s: %8.3f sec, %5d sFlow requests"%(name, elapsed, num_requests)
+    print "  Same paths selected: %s"%("yes" if results[0][3] == results[1][3] else "NO")
+
+def __get_current_path_by_switches(topo, src_ip, dst_ip):
+    # Inference of a path before SDCPathInference: all paths of the pair matched by their switches.
+    current_switches, ports = monitor_get_current_path_switches(src_ip, dst_ip)
+    all_paths = topo.find_all_path(src_ip, dst_ip)
+    intersect_num = [len(set(path) & set(current_switches)) for path in all_paths]
+    return all_paths[intersect_num.index(max(intersect_num))]
+
+def bench_current_paths(k=8, num_flows=100, rounds=3, seed=1):
+    # Current paths of num_flows pairs, 'rounds' times: the scan of all paths per pair, SDCPathInference
+    # per pair (/flowlocations), and for all pairs from one /dump.
+    global path_inference
+    topo, pairs, paths, server = __bench_flows(k, num_flows, seed)
+    print "k=%d fat-tree, %d flows, %d rounds"%(k, len(pairs), rounds)
+    saved = __start_bench_sflow(server)
+    results = []
+    try:
+        for name in ("scan per pair", "cached per pair", "cached bulk"):
+            path_inference = SDCPathInference()
+            server.reset_counters()
+            start = time.time()
+            for i in range(rounds):
+                if name == "scan per pair":
+                    found = dict( (pair, __get_current_path_by_switches(topo, pair[0], pair[1])) for pair in pairs )
+                elif name == "cached per pair":
+                    found = dict( (pair, monitor_get_current_path(topo, pair[0], pair[1])) for pair in pairs )
+                else:
+                    found = monitor_get_current_paths(topo, pairs)
+            results.append( (name, time.time() - start, server.get_request_count(), found, path_inference.hits) )
+    finally:
+        path_inference = SDCPathInference()
+        __stop_bench_sflow(server, saved)
+    for name, elapsed, num_requests, found, hits in results:
+        print "  %-16s: %8.3f sec, %5d sFlow requests, %4d cache hits, %s"%(name, elapsed, num_requests, hits,
+            "all paths correct" if found == paths else "%d wrong paths"%(len([p for p in pairs if found[p] != paths[p]])))
+
+def test_sampler(history=60, ticks=5000):
+    # Checks the views of the sampler, that its memory stays bounded with changing flows, and that
+    # the monitor functions read from it without sFlow-RT requests.
+    import random, sdcon_mock
+    results = []
+    rnd = random.Random(1)
+    sampler = SDCSFlowSampler(history=history, max_series=1000)
+    values = [rnd.randint(0, 1000) for i in range(history * 2)]
+    for i, value in enumerate(values):
+        sampler.add_sample([{'agent': "192.168.99.120", 'dataSource': "3", 'topKeys': [{'key': "10.0.0.2,10.1.0.2", 'value': value}]}], i)
+    ewma = values[0]
+    for value in values[1:]:
+        ewma = SFLOW_SAMPLER_EWMA_ALPHA * value + (1 - SFLOW_SAMPLER_EWMA_ALPHA) * ewma
+    window = sorted(values[-history:])
+    results.append( ("last value", sampler.get_value("192.168.99.120", 3, "10.0.0.2,10.1.0.2", "last") == values[-1]) )
+    results.append( ("EWMA", abs(sampler.get_value("192.168.99.120", 3, "10.0.0.2,10.1.0.2", "ewma") - ewma) < 1e-6) )
+    results.append( ("95th percentile of the history", sampler.get_value("192.168.99.120", 3, "10.0.0.2,10.1.0.2", "p95") == window[int(history * 0.95)]) )
+    results.append( ("history in time order", [v for t, v in sampler.get_history("192.168.99.120", 3, "10.0.0.2,10.1.0.2")] == values[-history:]) )
+
+    # Flows that start and stop: 20 new flows per tick, each active for 10 ticks
+    sampler = SDCSFlowSampler(history=history, max_series=100000)
+    sizes = []
+    start = time.time()
+    for tick in range(ticks):
+        top_keys = [{'key': "10.0.%d.%d,10.1.0.2"%(f // 250, f % 250 + 2), 'value': 1000} for f in range(max(0, tick - 9) * 20, (tick + 1) * 20)]
+        sampler.add_sample([{'agent': "192.168.99.120", 'dataSource': "3", 'topKeys': top_keys}], tick)
+        if tick % 1000 == 999:
+            sizes.append(len(sampler.series))
+    elapsed = time.time() - start
+    print "%d ticks of changing flows: %s series after each 1000 ticks, %d KBytes, %.3f ms per tick"%(
+        ticks, "/".join(str(n) for n in sizes), sampler.get_memory_size() / 1024, elapsed / ticks * 1000)
+    results.append( ("bounded series with changing flows", max(sizes) <= (history + 10) * 20 + 1 and sizes[-1] == sizes[0]) )
+    sampler = SDCSFlowSampler(history=history, max_series=50)
+    for tick in range(10):
+        sampler.add_sample([{'agent': "192.168.99.120", 'dataSource': "3", 'topKeys': [{'key': "10.0.0.%d,10.1.0.2"%(tick * 10 + f), 'value': 1} for f in range(10)]}], tick)
+    results.append( ("max series", len(sampler.series) == 50 and sampler.dropped > 0) )
+
+    # Readers on a mock sFlow-RT
+    snapshot = sdcon_mock.generate_fattree_snapshot(4)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    path = topo.find_all_path("10.0.0.2", "10.3.0.2")[1]
+    server = sdcon_mock.MockSFlowServer(lambda src_ip, dst_ip: [(switch, inport) for (inport, switch, outport) in topo.get_switch_port_map(path)])
+    server.set_rate("10.0.0.2", "10.3.0.2", 1000000)
+    url = sdcon_config.SFLOW_COLLECTOR_URL
+    server.start()
+    sdcon_config.SFLOW_COLLECTOR_URL = server.url
+    try:
+        start_monitor()
+        expected = get_bw_usage_all_incoming()
+        sampler = start_sampler(interval=3600)
+        while sampler.tick == 0:
+            time.sleep(0.01)
+        server.reset_counters()
+        for i in range(100):
+            sampled = get_bw_usage_all_incoming()
+            get_utilization_matrix(topo)
+            get_link_sample()
+            get_bw_usage_port_incoming(path[1], topo.get_switch_port_map(path)[0][0])
+        requests = server.get_request_count()
+    finally:
+        stop_sampler()
+        sdcon_config.SFLOW_COLLECTOR_URL = url
+        server.stop()
+    results.append( ("same BW as sFlow-RT", dict( (sw, sorted(p)) for sw, p in sampled.items() ) == dict( (sw, sorted(p)) for sw, p in expected.items() )) )
+    results.append( ("no sFlow-RT request while sampling (%d)"%(requests), requests == 0) )
+
+    for name, ok in results:
+        print "  %-55s %s"%(name, "OK" if ok else "FAILED")
+    return all(ok for name, ok in results)
+
 # Main
 def _print_usage():
     print("Usage:\t python %s flow <src_IP> <dst_IP> \t - Get BW utilization from <src_IP> to <dst_IP>"%(sys.argv[0]))
     print("      \t python %s port <switch_DPID> <port> \t- Get incoming BW at <port> of <switch>"%(sys.argv[0]))
+    print("      \t python %s test-sampler \t- check the views and the memory bound of the background sampler"%(sys.argv[0]))
+    print("      \t python %s bench-paths [k] [num_flows] \t- infer the current paths of many flows on a mock sFlow-RT (default: k=8, 100 flows)"%(sys.argv[0]))
+    print("      \t python %s bench [k] [num_flows] \t- rank ECMP paths per switch dump vs. one utilization matrix on a mock sFlow-RT (default: k=8, 100 flows)"%(sys.argv[0]))
 
 def print_ip(src_ip, dst_ip):
     print "BW usage %s -> %s = %s "%(src_ip, dst_ip, str(get_bw_usage_flow(src_ip, dst_ip)))
@@ -193,6 +712,17 @@ def test_monitor():
 
 # Main
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "test-sampler":
+        ok = test_sampler()
+        print "\nBackground sampler: %s"%("OK" if ok else "FAILED")
+        sys.exit(0 if ok else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-paths":
+        bench_current_paths(int(sys.argv[2]) if len(sys.argv) > 2 else 8, int(sys.argv[3]) if len(sys.argv) > 3 else 100)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench_path_scoring(int(sys.argv[2]) if len(sys.argv) > 2 else 8, int(sys.argv[3]) if len(sys.argv) > 3 else 100)
+        return
+    
     start_monitor()
     
     if len(sys.argv) < 2:
@@ -0,0 +1,219 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Congestion events pushed by sFlow-RT, instead of polling the link utilization.
+# A threshold on the incoming bytes/sec of switch ports ("ifinoctets") is set at LINK_THRESHOLD_RATIO
+# of the link capacity, and the events feed of sFlow-RT is long-polled: a request returns as soon as
+# a port goes above the threshold, or after EVENTS_POLL_TIMEOUT seconds without events.
+#     events = SDCLinkEvents({("40960020", "1"): 1000000000})  # Capacities other than LINK_CAPACITY
+#     events.subscribe(lambda link_events: ...)                 # list of SDCLinkEvent
+#     events.start()
+#
+# sFlow-RT evaluates a threshold against all ports, so one threshold is set at the ratio of the lowest
+# capacity, and events of ports with a higher capacity are passed only if they are above their own ratio.
+
+import sys, time, threading, traceback
+import network_monitor_sflow, topo_discovery, sdcon_config
+
+LINK_CAPACITY = 100000000           # bits per sec, of links not in the capacities
+LINK_THRESHOLD_RATIO = 0.8
+LINK_THRESHOLD_NAME = "sdc_link_congestion"
+LINK_THRESHOLD_METRIC = "ifinoctets"
+EVENTS_POLL_TIMEOUT = 30            # Seconds that sFlow-RT holds a long-poll without events
+EVENTS_MAX = 100                    # Max events per poll
+
+class SDCLinkEvent:
+    def __init__(self, event_id, switch, port, bw, capacity, timestamp):
+        self.event_id = event_id
+        self.switch = switch
+        self.port = port
+        self.bw = bw                    # bytes/sec
+        self.utilization = bw * 8.0 / capacity
+        self.time = timestamp           # Seconds
+
+    def __repr__(self):
+        return "SDCLinkEvent: %s port %s at %.1f%% (%.1f Mbps)"%(self.switch, self.port, self.utilization*100, self.bw*8/1e6)
+
+class SDCLinkEvents:
+    def __init__(self, capacities=None, ratio=None, poll_timeout=None):
+        self.capacities = dict( ((switch, str(port)), bw) for (switch, port), bw in (capacities or {}).items() )
+        self.ratio = ratio or LINK_THRESHOLD_RATIO
+        self.poll_timeout = poll_timeout if poll_timeout != None else EVENTS_POLL_TIMEOUT
+        self.event_id = -1          # Last event seen
+        self.subscribers = []
+        self.thread = None
+        self.running = False
+        self.polls = 0
+        self.events = 0             # Events passed to the subscribers
+
+    def get_capacity(self, switch, port):
+        return self.capacities.get( (switch, str(port)), LINK_CAPACITY )
+
+    def get_threshold(self):
+        # bytes/sec
+        return min(self.capacities.values() + [LINK_CAPACITY]) * self.ratio / 8
+
+    def register(self):
+        network_monitor_sflow.set_sflow_threshold(sdcon_config.SFLOW_COLLECTOR_URL, LINK_THRESHOLD_NAME, LINK_THRESHOLD_METRIC, self.get_threshold())
+        # Skip the events raised before
+        events = network_monitor_sflow.get_sflow_events(sdcon_config.SFLOW_COLLECTOR_URL, -1, 0, 1)
+        for ev in events or []:
+            self.event_id = max(self.event_id, int(ev['eventID']))
+
+    def unregister(self):
+        network_monitor_sflow.del_sflow_threshold(sdcon_config.SFLOW_COLLECTOR_URL, LINK_THRESHOLD_NAME)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def __parse_event(self, ev):
+        switch = sdcon_config.switch_ip_to_dpid(ev['agent'])
+        port = sdcon_config.data_source_to_port(switch, ev['dataSource'])
+        capacity = self.get_capacity(switch, port)
+        if ev['value'] * 8 < capacity * self.ratio:
+            return None     # Above the threshold of a lower capacity only
+        return SDCLinkEvent(int(ev['eventID']), switch, port, ev['value'], capacity, ev.get('timestamp', 0) / 1000.0)
+
+    def poll(self, timeout=None):
+        # Waits for the next events (at most 'timeout' sec) and passes them to the subscribers.
+        self.polls += 1
+        events = network_monitor_sflow.get_sflow_events(sdcon_config.SFLOW_COLLECTOR_URL, self.event_id,
+            timeout if timeout != None else self.poll_timeout, EVENTS_MAX)
+        if events == None:
+            return None     # Request failed
+        link_events = []
+        for ev in sorted(events, key=lambda e: int(e['eventID'])):
+            self.event_id = max(self.event_id, int(ev['eventID']))
+            if ev.get('thresholdID') == LINK_THRESHOLD_NAME:
+                link_event = self.__parse_event(ev)
+                if link_event != None:
+                    link_events.append(link_event)
+        if link_events:
+            self.events += len(link_events)
+            for callback in list(self.subscribers):
+                try:
+                    callback(link_events)
+                except Exception as e:
+                    print "Error: congestion event subscriber failed:", e
+                    traceback.print_exc()
+        return link_events
+
+    def __run(self):
+        while self.running:
+            try:
+                if self.poll() == None:
+                    time.sleep(1)
+            except Exception as e:
+                print "Error: polling sFlow-RT events failed:", e
+                time.sleep(1)
+
+    def start(self):
+        self.register()
+        self.running = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+#####################################
+## Test
+#####################################
+def test_link_events(k=4):
+    # Against the mock sFlow-RT: events of the right ports, only above their own capacity, once per
+    # crossing, within milliseconds of the change, and one request per poll timeout while idle.
+    import sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    src_ip, dst_ip = sdcon_mock.fattree_host_ip(0, 0, 0), sdcon_mock.fattree_host_ip(k-1, 0, 0)
+    path = topo.find_all_path(src_ip, dst_ip)[0]
+    port_map = topo.get_switch_port_map(path)
+    server = sdcon_mock.MockSFlowServer(lambda s, d: [(switch, inport) for (inport, switch, outport) in port_map] if (s, d) == (src_ip, dst_ip) else [])
+    # The ingress port of the edge switch of the source is a 1 Gbps link.
+    big_link = (port_map[0][1], port_map[0][0])
+    received = []
+    def on_events(link_events):
+        received.append( (time.time(), link_events) )
+    results = []
+    url = sdcon_config.SFLOW_COLLECTOR_URL
+    server.start()
+    sdcon_config.SFLOW_COLLECTOR_URL = server.url
+    events = SDCLinkEvents({big_link: 1000000000}, poll_timeout=0.5)
+    with sdcon_mock.quiet():
+        try:
+            events.subscribe(on_events)
+            events.start()
+            results.append( ("threshold registered at 80% of 100 Mbps", server.thresholds.get(LINK_THRESHOLD_NAME, {}).get("value") == 10000000) )
+
+            def wait_events(count, timeout=2.0):
+                end = time.time() + timeout
+                while len(received) < count and time.time() < end:
+                    time.sleep(0.001)
+            start = time.time()
+            server.set_rate(src_ip, dst_ip, 11000000)    # 88 Mbps
+            wait_events(1)
+            delay = received[0][0] - start if received else None
+            reported = set( (ev.switch, ev.port) for ev in received[0][1] ) if received else set()
+            expected = set( (switch, inport) for (inport, switch, outport) in port_map ) - set([big_link])
+            results.append( ("event of each 100 Mbps link of the path", reported == expected) )
+            results.append( ("no event of the 1 Gbps link", big_link not in reported) )
+            results.append( ("delivered within one sampling interval (%.1f ms)"%((delay or 0)*1000), delay != None and delay < 1.0) )
+
+            server.set_rate(src_ip, dst_ip, 12000000)    # Still above
+            time.sleep(0.2)
+            results.append( ("no repeated event while above", len(received) == 1) )
+            server.set_rate(src_ip, dst_ip, 1000000)     # Below
+            server.set_rate(src_ip, dst_ip, 11000000)    # Above again
+            wait_events(2)
+            results.append( ("new event after going above again", len(received) == 2) )
+
+            polls = events.polls
+            time.sleep(2.0)
+            results.append( ("idle: one request per poll timeout (%d in 2 sec)"%(events.polls - polls), events.polls - polls <= 5) )
+        finally:
+            events.stop()
+            server.stop()
+            sdcon_config.SFLOW_COLLECTOR_URL = url
+    for name, ok in results:
+        print "  %-55s %s"%(name, "OK" if ok else "FAILED")
+    return all(ok for name, ok in results)
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s listen \t- print congestion events of sFlow-RT"%(sys.argv[0]))
+    print("      \t python %s test \t- check the events against a mock sFlow-RT"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "listen":
+        events = SDCLinkEvents()
+        events.register()
+        try:
+            while True:
+                for ev in events.poll() or []:
+                    print ev
+        finally:
+            events.unregister()
+    elif sys.argv[1] == "test":
+        ok = test_link_events()
+        print "\nsFlow-RT congestion events: %s"%("OK" if ok else "FAILED")
+        sys.exit(0 if ok else 1)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
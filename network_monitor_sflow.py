@@ -10,7 +10,7 @@ import requests
 import json
 import sys
 from collections import defaultdict
-import sdcon_config
+import sdcon_config, sdcon_rest
 # sFlow-rt API: http://www.sflow-rt.com/reference.php
 
 def set_sflow_flow (collector_url, name , keys, value):
@@ -21,7 +21,7 @@ def set_sflow_flow (collector_url, name , keys, value):
     flow = {'keys':keylist,'value':value,'log':True}
     url = collector_url+'/flow/'+name+'/json'
     try:
-        response = requests.put(url,data=json.dumps(flow))
+        response = sdcon_rest.put(url,data=json.dumps(flow))
         response.raise_for_status();
     except(requests.exceptions.Timeout,requests.exceptions.RequestException,requests.exceptions.RequestException) as err:
         print(err)
@@ -29,7 +29,7 @@ def set_sflow_flow (collector_url, name , keys, value):
 def del_sflow_flow(collector_url, name):
     try:
         url = collector_url+'/flow/'+name+'/json'
-        response = requests.delete(url)
+        response = sdcon_rest.delete(url)
         response.raise_for_status();
     except(requests.exceptions.Timeout,requests.exceptions.RequestException,requests.exceptions.RequestException) as err:
         print(err)
@@ -37,7 +37,7 @@ def del_sflow_flow(collector_url, name):
 def get_sflow_flow(collector_url, name, switch_ip="ALL"):
     try:
         url = collector_url+'/activeflows/'+switch_ip+'/'+name+'/json?maxFlows=200'
-        response = requests.get(url)
+        response = sdcon_rest.get(url)
         response.raise_for_status()
         return response.json()
     except(requests.exceptions.Timeout,requests.exceptions.RequestException,requests.exceptions.RequestException) as err:
@@ -47,7 +47,7 @@ def get_sflow_dump(collector_url, name, switch_ip="ALL"):
     try:
         #SFLOW_COLLECTOR_URL/dump/192.168.99.100/ip_flows/json
         url = collector_url+'/dump/'+switch_ip+'/'+name+'/json'
-        response = requests.get(url)
+        response = sdcon_rest.get(url)
         response.raise_for_status()
         return response.json()
     except(requests.exceptions.Timeout,requests.exceptions.RequestException,requests.exceptions.RequestException) as err:
@@ -56,7 +56,34 @@ def get_sflow_dump(collector_url, name, switch_ip="ALL"):
 def get_sflow_flowlocations(collector_url, name, key):
     try:
         url = collector_url+'/flowlocations/ALL/'+name+'/json?key='+key
-        response = requests.get(url)
+        response = sdcon_rest.get(url)
+        response.raise_for_status()
+        return response.json()
+    except(requests.exceptions.Timeout,requests.exceptions.RequestException,requests.exceptions.RequestException) as err:
+        print(err)
+
+def set_sflow_threshold(collector_url, name, metric, value, by_flow=False):
+    threshold = {'metric':metric,'value':value,'byFlow':by_flow}
+    url = collector_url+'/threshold/'+name+'/json'
+    try:
+        response = sdcon_rest.put(url,data=json.dumps(threshold))
+        response.raise_for_status();
+    except(requests.exceptions.Timeout,requests.exceptions.RequestException,requests.exceptions.RequestException) as err:
+        print(err)
+
+def del_sflow_threshold(collector_url, name):
+    try:
+        url = collector_url+'/threshold/'+name+'/json'
+        response = sdcon_rest.delete(url)
+        response.raise_for_status();
+    except(requests.exceptions.Timeout,requests.exceptions.RequestException,requests.exceptions.RequestException) as err:
+        print(err)
+
+# Long-poll: sFlow-RT answers when there are events after event_id, or after 'timeout' seconds.
+def get_sflow_events(collector_url, event_id=-1, timeout=0, max_events=100):
+    try:
+        url = collector_url+'/events/json?eventID='+str(event_id)+'&timeout='+str(timeout)+'&maxEvents='+str(max_events)
+        response = sdcon_rest.get(url, timeout=timeout+10)    # Longer than the poll
         response.raise_for_status()
         return response.json()
     except(requests.exceptions.Timeout,requests.exceptions.RequestException,requests.exceptions.RequestException) as err:
@@ -0,0 +1,211 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Assigns the paths of many flows at once.
+# network_manager.get_low_utilization_path() chooses a path for one flow from the monitored BW,
+# so several large flows of one round can be put on the same idle path. Here, all flows are
+# assigned together over their ECMP paths to minimize the max link utilization:
+#   1. Background load of each link (switch, inport) = monitored BW without the flows being assigned.
+#   2. Greedy: the largest demand first, each flow takes the path with the lowest (max, sum) of the
+#      link utilization after adding its demand.
+#   3. Improvement: flows are taken out and assigned again, the flows on the most utilized link first,
+#      until no flow moves (at most PATH_OPT_MAX_PASSES passes).
+#
+# A flow is (src_vm_ip, dst_vm_ip, src_compute, dst_compute, bw), where bw is the demand in bits/sec
+# (e.g. the "bandwidth" of a link in the virtual topology). Without a demand, the monitored BW of the
+# flow is used. Flows are sampled by sFlow with the compute IPs ("src_compute,dst_compute").
+
+import sys, os, time, random
+import network_manager, network_monitor, topo_discovery, sdcon_config
+
+PATH_OPT_LINK_CAPACITY = 100000000  # bits per sec
+PATH_OPT_MAX_PASSES = 10
+
+class SDCPathAssignment:
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.paths = {}         # dict[flow] = path (list of nodes)
+        self.demand = {}        # dict[flow] = bits/sec
+        self.link_load = {}     # dict[(switch, inport)] = bits/sec, background and assigned flows
+        self.passes = 0
+        self.moves = 0          # Flows moved by the improvement passes
+
+    def get_max_utilization(self):
+        return max(self.link_load.values() or [0.0]) / self.capacity
+
+    def get_changed_flows(self, current_paths):
+        # Flows whose path is not the one in current_paths (dict[flow] = path)
+        return [flow for flow, path in self.paths.items() if current_paths.get(flow) != path]
+
+    def print_report(self):
+        print "Assigned %d flows: max link utilization %.1f%%, %d improvement passes, %d flows moved"%(
+            len(self.paths), self.get_max_utilization()*100, self.passes, self.moves)
+        for flow in sorted(self.paths):
+            print "  %s -> %s (%.1f Mbps): %s"%(flow[0], flow[1], self.demand[flow]/1e6, network_manager.path_string_format(self.paths[flow]))
+
+def __get_links(topo, path):
+    return [(switch, inport) for (inport, switch, outport) in topo.get_switch_port_map(path)]
+
+def __path_score(link_load, links, demand):
+    loads = [link_load.get(link, 0.0) + demand for link in links]
+    return (max(loads or [0.0]), sum(loads))
+
+def __add_load(link_load, links, demand):
+    for link in links:
+        link_load[link] = link_load.get(link, 0.0) + demand
+
+def __best_path(link_load, candidates, demand):
+    # candidates: list of (path, links)
+    best, best_score = None, None
+    for path, links in candidates:
+        score = __path_score(link_load, links, demand)
+        if best_score == None or score < best_score:
+            best, best_score = (path, links), score
+    return best
+
+# flows: list of (src_vm_ip, dst_vm_ip, src_compute, dst_compute, bw)
+# sample: network_monitor.SDCLinkSample (None: no background load)
+# Returns SDCPathAssignment.
+def assign_paths(topo, flows, sample=None, capacity=None):
+    result = SDCPathAssignment(capacity or PATH_OPT_LINK_CAPACITY)
+    keys = set(flow[2]+","+flow[3] for flow in flows)
+    if sample != None:
+        for link, flows_bw in sample.flow_bw.items():
+            background = sum(bw for key, bw in flows_bw.items() if key not in keys) * 8
+            if background > 0:
+                result.link_load[link] = background
+    candidates = {}
+    for flow in flows:
+        demand = flow[4] or (sample.get_flow_bw(flow[2]+","+flow[3]) * 8 if sample != None else 0.0)
+        result.demand[flow] = float(demand)
+        candidates[flow] = [(path, __get_links(topo, path)) for path in topo.find_all_path(flow[2], flow[3])]
+    flows = [flow for flow in flows if candidates[flow]]
+    assigned = {}   # dict[flow] = (path, links)
+
+    # Greedy, the largest demand first
+    for flow in sorted(flows, key=lambda f: result.demand[f], reverse=True):
+        assigned[flow] = __best_path(result.link_load, candidates[flow], result.demand[flow])
+        __add_load(result.link_load, assigned[flow][1], result.demand[flow])
+
+    # Improvement passes: re-sorted by the utilization of the most loaded link of the current path
+    for i in range(PATH_OPT_MAX_PASSES):
+        result.passes += 1
+        moved = 0
+        order = sorted(flows, key=lambda f: (max(result.link_load[l] for l in assigned[f][1]), result.demand[f]), reverse=True)
+        for flow in order:
+            demand = result.demand[flow]
+            __add_load(result.link_load, assigned[flow][1], -demand)
+            current_score = __path_score(result.link_load, assigned[flow][1], demand)
+            best = __best_path(result.link_load, candidates[flow], demand)
+            if __path_score(result.link_load, best[1], demand) < current_score:
+                assigned[flow] = best
+                moved += 1
+            __add_load(result.link_load, assigned[flow][1], demand)
+        result.moves += moved
+        if moved == 0:
+            break
+
+    for flow, (path, links) in assigned.items():
+        result.paths[flow] = path
+    return result
+
+# Assigns and installs the paths. Only flows with a path not in current_paths are written.
+# Returns the SDCPathAssignment.
+def set_optimized_paths(flows, current_paths=None, topo=None, sample=None):
+    current_paths = current_paths or {}
+    if topo == None:
+        topo = topo_discovery.get_topo()
+    if sample == None:
+        sample = network_monitor.get_link_sample()
+    result = assign_paths(topo, flows, sample)
+    for flow in result.get_changed_flows(current_paths):
+        print "Debug: optimized path for %s -> %s = %s"%(flow[0], flow[1], network_manager.path_string_format(result.paths[flow]))
+        network_manager.update_path_along_links(topo, result.paths[flow], flow[0], flow[1])
+    return result
+
+#####################################
+## Benchmark
+#####################################
+def __assign_paths_independent(topo, flows, sample, capacity):
+    # As get_low_utilization_path(): each flow takes the path with the least monitored BW,
+    # without knowing the other flows assigned in the same round.
+    assigned = {}
+    for flow in flows:
+        key = flow[2]+","+flow[3]
+        best = None
+        for path in topo.find_all_path(flow[2], flow[3]):
+            bw = sum(sample.get_bw(switch, port, key) for (switch, port) in __get_links(topo, path))
+            if best == None or bw < best[0]:
+                best = (bw, path)
+        assigned[flow] = best[1]
+    # Resulting load: background plus all flows on their new paths
+    keys = set(flow[2]+","+flow[3] for flow in flows)
+    link_load = {}
+    for link, flows_bw in sample.flow_bw.items():
+        link_load[link] = sum(bw for key, bw in flows_bw.items() if key not in keys) * 8
+    for flow, path in assigned.items():
+        __add_load(link_load, __get_links(topo, path), flow[4])
+    return max(link_load.values() or [0.0]) / capacity
+
+def bench_assign_paths(k=4, num_flows=24, runs=20, seed=1):
+    # Random flows between edge switches, all on the first ECMP path in the sample (e.g. after default paths),
+    # with a random background of short flows: independent per-flow choice vs. joint assignment.
+    import sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    hosts = sorted(topo.get_all_hosts_ip())
+    capacity = PATH_OPT_LINK_CAPACITY
+    rnd = random.Random(seed)
+    print "k=%d fat-tree, %d hosts, %d flows of 5-40 Mbps, %d runs"%(k, len(hosts), num_flows, runs)
+    independent, joint, elapsed = [], [], 0.0
+    for run in range(runs):
+        flows, switch_port_flow_bw = [], {}
+        def add_sample(src_ip, dst_ip, path, bytes_per_sec):
+            for (switch, port) in __get_links(topo, path):
+                switch_port_flow_bw.setdefault(switch, []).append( (port, [(src_ip+","+dst_ip, bytes_per_sec)]) )
+        while len(flows) < num_flows:
+            src_ip, dst_ip = rnd.sample(hosts, 2)
+            if topo.get_connected_switch(src_ip) == topo.get_connected_switch(dst_ip):
+                continue
+            if any(f[2] == src_ip and f[3] == dst_ip for f in flows):
+                continue
+            bw = rnd.randint(5, 40) * 1000000
+            flows.append( (src_ip, dst_ip, src_ip, dst_ip, bw) )
+            add_sample(src_ip, dst_ip, topo.find_all_path(src_ip, dst_ip)[0], bw / 8)
+        for i in range(num_flows):
+            src_ip, dst_ip = rnd.sample(hosts, 2)
+            if topo.get_connected_switch(src_ip) != topo.get_connected_switch(dst_ip):
+                add_sample(src_ip, dst_ip, rnd.choice(topo.find_all_path(src_ip, dst_ip)), rnd.randint(1, 5) * 1000000 / 8)
+        sample = network_monitor.SDCLinkSample(switch_port_flow_bw)
+        independent.append(__assign_paths_independent(topo, flows, sample, capacity))
+        start = time.time()
+        joint.append(assign_paths(topo, flows, sample, capacity).get_max_utilization())
+        elapsed += time.time() - start
+    print "  independent per-flow choice: max link utilization avg %5.1f%%, worst %5.1f%%, %d runs over capacity"%(
+        sum(independent)/runs*100, max(independent)*100, len([u for u in independent if u > 1.0]))
+    print "  joint assignment           : max link utilization avg %5.1f%%, worst %5.1f%%, %d runs over capacity, %.2f ms per run"%(
+        sum(joint)/runs*100, max(joint)*100, len([u for u in joint if u > 1.0]), elapsed/runs*1000)
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s bench [k] [num_flows] \t- compare per-flow path choice with the joint assignment on random flows (default: k=4, 24 flows)"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "bench":
+        bench_assign_paths(int(sys.argv[2]) if len(sys.argv) > 2 else 4, int(sys.argv[3]) if len(sys.argv) > 3 else 24)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
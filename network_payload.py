@@ -0,0 +1,368 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Documents pushed to ODL: flows (XML), and QoS entries, queues and port bindings of OVSDB (JSON).
+# A document is built from a compact rule (a tuple of its values) in one pass, by joining its parts,
+# and the serialized fragment of each rule is cached: a flow or queue pushed again without changes
+# (e.g. the same rules to reconcile, or the other queues of a port) is not serialized again.
+#     xml = flow_xml(flow_id, "2", 15, match_src_ip="10.0.0.2", match_dst_ip="10.1.0.2", flowname="sdc-special-path")
+#     jdata = qos_node_json(switch, switch_ip, [(qos_id, [(0, "QUEUE-DEF-1"), (10, "QUEUE-1-10")]), ...], ...)
+#
+# Fragments are kept in two generations of PAYLOAD_CACHE_SIZE: when the newer one is full, the older
+# one is dropped, so the rules pushed in the last rounds stay cached without a per-hit LRU update.
+
+import sys, time, json, random
+
+PAYLOAD_CACHE_SIZE = 100000     # Fragments per generation
+
+class SDCFragmentCache:
+    def __init__(self, size=None):
+        self.size = size or PAYLOAD_CACHE_SIZE
+        self.current = {}       # dict[rule] = serialized fragment
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        # build(key) serializes the rule if it is not cached.
+        fragment = self.current.get(key)
+        if fragment != None:
+            self.hits += 1
+            return fragment
+        fragment = self.previous.get(key)
+        if fragment != None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            fragment = build(key)
+        if len(self.current) >= self.size:
+            self.previous, self.current = self.current, {}
+        self.current[key] = fragment
+        return fragment
+
+    def clear(self):
+        self.current, self.previous = {}, {}
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+flow_cache = SDCFragmentCache()
+ovsdb_cache = SDCFragmentCache()
+
+#####################################
+## Flows (XML)
+#####################################
+__FLOW_HEAD = '''<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"no\"?>
+        <flow xmlns=\"urn:opendaylight:flow:inventory\">
+            <priority>'''
+__FLOW_ACTION = '''
+                    <action><order>'''
+__FLOW_QUEUE = '''</order>
+                        <set-queue-action>
+                        <queue-id>'''
+__FLOW_QUEUE_END = '''</queue-id>
+                        </set-queue-action>
+                    </action>'''
+__FLOW_OUTPUT = '''</order>
+                        <output-action>
+                        <output-node-connector>'''
+__FLOW_OUTPUT_END = '''</output-node-connector>
+                        <max-length>65535</max-length>
+                        </output-action>
+                    </action>'''
+__FLOW_GOTO_TABLE = '''
+                <instruction>
+                    <order>1</order>
+                    <go-to-table>
+                        <table_id>'''
+__FLOW_GOTO_TABLE_END = '''</table_id>
+                    </go-to-table>
+                </instruction>'''
+
+def __build_flow_xml(key):
+    (flow_id, action_outport, priority, action_queue, action_table, match_inport, match_src_ip, match_dst_ip,
+        match_src_mac, match_dst_mac, match_is_arp, table_id, flowname) = key
+    parts = [__FLOW_HEAD, str(priority), '''</priority>
+            <flow-name>''', str(flowname), '''</flow-name>
+            <match>''']
+    is_ip = match_src_ip or match_dst_ip
+    if is_ip or match_src_mac or match_dst_mac or match_is_arp:
+        parts.append('<ethernet-match><ethernet-type><type>2048</type></ethernet-type>' if is_ip else
+            '<ethernet-match><ethernet-type><type>2054</type></ethernet-type>' if match_is_arp else '<ethernet-match>')
+        if match_src_mac:
+            parts += ['<ethernet-source><address>', str(match_src_mac), '</address></ethernet-source>']
+        if match_dst_mac:
+            parts += ['<ethernet-destination><address>', str(match_dst_mac), '</address></ethernet-destination>']
+        parts.append('</ethernet-match>')
+    if match_inport:
+        parts += ['<in-port>', str(match_inport), '</in-port>']
+    if match_src_ip:
+        parts += ['<ipv4-source>', str(match_src_ip), '/32</ipv4-source>']
+    if match_dst_ip:
+        parts += ['<ipv4-destination>', str(match_dst_ip), '/32</ipv4-destination>']
+    parts += ['''
+            </match>
+            <id>''', str(flow_id), '''</id>
+            <table_id>''', str(table_id), '''</table_id>
+            <instructions>''']
+    if action_queue or action_outport:
+        parts.append('''<instruction><order>0</order>
+                <apply-actions>''')
+        order = 0
+        if action_queue:
+            parts += [__FLOW_ACTION, '0', __FLOW_QUEUE, str(action_queue), __FLOW_QUEUE_END]
+            order = 1
+        if action_outport:
+            if type(action_outport) != tuple:
+                action_outport = (action_outport,)
+            for outport in action_outport:
+                parts += [__FLOW_ACTION, str(order), __FLOW_OUTPUT, str(outport), __FLOW_OUTPUT_END]
+                order += 1
+        parts.append('''</apply-actions>
+                </instruction>''')
+    if action_table:
+        parts += [__FLOW_GOTO_TABLE, str(action_table), __FLOW_GOTO_TABLE_END]
+    parts.append('''</instructions>
+        </flow>''')
+    return "".join(parts)
+
+# Same arguments as network_manager.generate_xml_flow_rule().
+def flow_xml(flow_id, action_outport, priority, action_queue=None, action_table=None,
+    match_inport=None, match_src_ip=None, match_dst_ip=None,
+    match_src_mac=None, match_dst_mac=None, match_is_arp=False,
+    table_id=0, flowname='Default'):
+    if type(action_outport) == list:
+        action_outport = tuple(action_outport)
+    return flow_cache.get( (flow_id, action_outport, priority, action_queue, action_table, match_inport,
+        match_src_ip, match_dst_ip, match_src_mac, match_dst_mac, match_is_arp, table_id, flowname), __build_flow_xml )
+
+# yang-patch of a switch table. edits = [(operation, flow_id, flow xml or None), ...]
+def flows_patch_xml(patch_id, edits):
+    parts = ['<yang-patch xmlns="urn:ietf:params:xml:ns:yang:ietf-yang-patch"><patch-id>', patch_id, '</patch-id>']
+    for i, (operation, flow_id, xml) in enumerate(edits):
+        parts += ['<edit><edit-id>', str(i), '</edit-id><operation>', operation, '</operation><target>/flow/', flow_id, '</target>']
+        if xml:
+            parts += ['<value>', xml[xml.index('<flow '):], '</value>']
+        parts.append('</edit>')
+    parts.append('</yang-patch>')
+    return "".join(parts)
+
+#####################################
+## OVSDB QoS and queues (JSON)
+#####################################
+def __queue_ref(switch, queue_id):
+    return "/network-topology:network-topology/network-topology:topology[network-topology:topology-id='ovsdb:1']" \
+        "/network-topology:node[network-topology:node-id='ovsdb:%s']/ovsdb:queues[ovsdb:queue-id='%s']"%(switch, queue_id)
+
+def __qos_ref(switch, qos_id):
+    return "/network-topology:network-topology/network-topology:topology[network-topology:topology-id='ovsdb:1']" \
+        "/network-topology:node[network-topology:node-id='ovsdb:%s']/ovsdb:qos-entries[ovsdb:qos-id='%s']"%(switch, qos_id)
+
+def __build_qos_entry(key):
+    (switch, qos_id, total_rate, queues) = key
+    return json.dumps({
+        "qos-id": qos_id,
+        "qos-other-config": [{"other-config-key": "max-rate", "other-config-value": str(total_rate)}],
+        "qos-type": "ovsdb:qos-type-linux-htb",
+        "queue-list": [{"queue-number": str(no), "queue-ref": __queue_ref(switch, queue_id)} for no, queue_id in queues]
+        }, sort_keys=True)
+
+def __build_queue(key):
+    (queue_id, max_rate, min_rate) = key
+    return json.dumps({
+        "queue-id": queue_id,
+        "queues-other-config": [
+            {"queue-other-config-key": "max-rate", "queue-other-config-value": str(max_rate)},
+            {"queue-other-config-key": "min-rate", "queue-other-config-value": str(min_rate)}]
+        }, sort_keys=True)
+
+# queues: list of (queue number, queue id) in the QoS entry, e.g. [(0, "QUEUE-DEF-1"), (10, "QUEUE-1-10")]
+def qos_entry_fragment(switch, qos_id, total_rate, queues):
+    return ovsdb_cache.get( (str(switch), qos_id, total_rate, tuple(queues)), __build_qos_entry )
+
+def queue_fragment(queue_id, max_rate, min_rate):
+    return ovsdb_cache.get( (queue_id, max_rate, min_rate), __build_queue )
+
+# Whole OVSDB node of a switch: .../topology/ovsdb:1/node/ovsdb:<switch>
+# qos_entries: list of (qos_id, total_rate, queues), queues: list of (queue_id, max_rate, min_rate)
+def qos_node_json(switch, switch_ip, qos_entries, queues):
+    parts = ['{"network-topology:node": [{"node-id": "ovsdb:', str(switch),
+        '", "connection-info": {"ovsdb:remote-port": "6640", "ovsdb:remote-ip": "', switch_ip, '"}, "ovsdb:qos-entries": [',
+        ", ".join([qos_entry_fragment(switch, qos_id, total_rate, entry_queues) for qos_id, total_rate, entry_queues in qos_entries]),
+        '], "ovsdb:queues": [',
+        ", ".join([queue_fragment(queue_id, max_rate, min_rate) for queue_id, max_rate, min_rate in queues]),
+        ']}]}']
+    return "".join(parts)
+
+# One QoS entry: .../node/ovsdb:<switch>/ovsdb:qos-entries/<qos_id>
+def qos_entry_json(switch, qos_id, total_rate, queues):
+    return '{"ovsdb:qos-entries": [' + qos_entry_fragment(switch, qos_id, total_rate, queues) + ']}'
+
+# One queue: .../node/ovsdb:<switch>/ovsdb:queues/<queue_id>
+def queue_json(queue_id, max_rate, min_rate):
+    return '{"ovsdb:queues": [' + queue_fragment(queue_id, max_rate, min_rate) + ']}'
+
+# Port binding: .../node/ovsdb:<switch>%2Fbridge%2Fovsbr0/termination-point/<ifname>
+def bind_port_qos_json(switch, ifname, qos_id):
+    return json.dumps({"network-topology:termination-point": [{
+        "ovsdb:name": str(ifname),
+        "tp-id": str(ifname),
+        "ovsdb:qos-entry": [{"qos-key": 1, "qos-ref": __qos_ref(switch, qos_id)}]
+        }]}, sort_keys=True)
+
+#####################################
+## Benchmark
+#####################################
+def __flow_xml_concat(flow_id, action_outport, priority, action_queue=None, action_table=None,
+    match_inport=None, match_src_ip=None, match_dst_ip=None,
+    match_src_mac=None, match_dst_mac=None, match_is_arp=False,
+    table_id=0, flowname='Default'):
+    # Flow XML by string concatenation as before, to compare with flow_xml().
+    xml = '''<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"no\"?>
+        <flow xmlns=\"urn:opendaylight:flow:inventory\">
+            <priority>'''+str(priority)+'''</priority>
+            <flow-name>'''+str(flowname)+'''</flow-name>
+            <match>'''
+    if match_src_ip or match_dst_ip or match_src_mac or match_dst_mac or match_is_arp:
+        xml +='<ethernet-match>'
+    if match_src_ip or match_dst_ip:
+        xml +='<ethernet-type><type>2048</type></ethernet-type>'
+    elif match_is_arp:
+        xml +='<ethernet-type><type>2054</type></ethernet-type>'
+    if match_src_mac:
+        xml +='<ethernet-source><address>'+ str(match_src_mac)+'</address></ethernet-source>'
+    if match_dst_mac:
+        xml +='<ethernet-destination><address>'+ str(match_dst_mac)+'</address></ethernet-destination>'
+    if match_src_ip or match_dst_ip or match_src_mac or match_dst_mac or match_is_arp:
+        xml +='</ethernet-match>'
+    if match_inport:
+        xml +='<in-port>'+ str(match_inport)+'</in-port>'
+    if match_src_ip:
+        xml +='<ipv4-source>' + str(match_src_ip)+'/32</ipv4-source>'
+    if match_dst_ip:
+        xml +='<ipv4-destination>' + str(match_dst_ip)+'/32</ipv4-destination>'
+    action_order = 0
+    xml += '''
+            </match>
+            <id>'''+str(flow_id)+'''</id>
+            <table_id>'''+str(table_id)+'''</table_id>
+            <instructions>'''
+    if action_queue or action_outport:
+        xml +='''<instruction><order>0</order>
+                <apply-actions>'''
+    if action_queue:
+        xml += '''
+                    <action><order>'''+str(action_order)+'''</order>
+                        <set-queue-action>
+                        <queue-id>''' + str(action_queue) +'''</queue-id>
+                        </set-queue-action>
+                    </action>'''
+        action_order += 1
+    if action_outport:
+        if type(action_outport) != list:
+            action_outport = [action_outport]
+        for outport in action_outport:
+            xml += '''
+                    <action><order>'''+str(action_order)+'''</order>
+                        <output-action>
+                        <output-node-connector>''' + str(outport) +'''</output-node-connector>
+                        <max-length>65535</max-length>
+                        </output-action>
+                    </action>'''
+            action_order += 1
+    if action_queue or action_outport:
+        xml +='''</apply-actions>
+                </instruction>'''
+    if action_table:
+        xml += '''
+                <instruction>
+                    <order>1</order>
+                    <go-to-table>
+                        <table_id>'''+str(action_table)+'''</table_id>
+                    </go-to-table>
+                </instruction>'''
+    xml +='''</instructions>
+        </flow>'''
+    return xml
+
+def __random_flow_rules(num_flows, rnd):
+    # Flows as network_defpath and network_manager write them: default paths by destination MAC,
+    # ARP and broadcast flows, special paths and queue paths by (src_ip, dst_ip).
+    rules = []
+    for i in range(num_flows):
+        outport = str(rnd.randint(1, 8))
+        kind = rnd.random()
+        if kind < 0.5:
+            dst_mac = "fa:16:3e:%02x:%02x:%02x"%(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+            rules.append( dict(flow_id=outport+"-"+dst_mac, action_outport=outport, priority=8, match_dst_mac=dst_mac, flowname="sdc-default-path") )
+        elif kind < 0.6:
+            rules.append( dict(flow_id=outport+"-ARP", action_outport=[str(p) for p in range(1, rnd.randint(2, 8))], priority=8, match_is_arp=True, flowname="sdc-default-path") )
+        else:
+            src_ip = "10.%d.%d.%d"%(rnd.randint(0, 7), rnd.randint(0, 3), rnd.randint(2, 5))
+            dst_ip = "10.%d.%d.%d"%(rnd.randint(0, 7), rnd.randint(0, 3), rnd.randint(2, 5))
+            queue = str(rnd.randint(10, 20)) if kind < 0.8 else None
+            rules.append( dict(flow_id=outport+"-"+src_ip+","+dst_ip, action_outport=outport, priority=16 if queue else 15,
+                action_queue=queue, match_src_ip=src_ip, match_dst_ip=dst_ip, match_inport=str(rnd.randint(1, 8)),
+                flowname="sdc-queue-path" if queue else "sdc-special-path") )
+    return rules
+
+def bench_payloads(num_flows=10000, changed_ratio=0.1, runs=3, seed=1):
+    # Flow payloads of num_flows rules: string concatenation, the builder with an empty cache,
+    # and the builder again after changing changed_ratio of the rules (the others are cached). Best of 'runs'.
+    rnd = random.Random(seed)
+    rules = __random_flow_rules(num_flows, rnd)
+    changed = list(rules)
+    for i in rnd.sample(range(num_flows), int(num_flows*changed_ratio)):
+        changed[i] = dict(changed[i], priority=changed[i]["priority"]+1)
+    print "%d flow payloads (%d%% changed in the second push), best of %d runs"%(num_flows, changed_ratio*100, runs)
+
+    times = dict(concat=[], cold=[], warm=[], patch=[])
+    same = True
+    for run in range(runs):
+        start = time.time()
+        concat = [__flow_xml_concat(**rule) for rule in rules]
+        times["concat"].append(time.time() - start)
+        flow_cache.clear()
+        start = time.time()
+        built = [flow_xml(**rule) for rule in rules]
+        times["cold"].append(time.time() - start)
+        hits, misses = flow_cache.hits, flow_cache.misses
+        start = time.time()
+        built2 = [flow_xml(**rule) for rule in changed]
+        times["warm"].append(time.time() - start)
+        start = time.time()
+        patch = flows_patch_xml("sdc-bench", [("replace", rule["flow_id"], xml) for rule, xml in zip(changed, built2)])
+        times["patch"].append(time.time() - start)
+        same = same and built == concat and built2 == [__flow_xml_concat(**rule) for rule in changed]
+    print "  string concatenation  : %7.1f ms"%(min(times["concat"])*1000)
+    print "  builder, empty cache  : %7.1f ms"%(min(times["cold"])*1000)
+    print "  builder, second push  : %7.1f ms (%d cached, %d serialized)"%(min(times["warm"])*1000, flow_cache.hits - hits, flow_cache.misses - misses)
+    print "  yang-patch of all     : %7.1f ms, %.1f MB"%(min(times["patch"])*1000, len(patch)/1e6)
+    print "  same documents as the string concatenation: %s"%("OK" if same else "FAILED")
+    return same
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s bench [num_flows] \t- benchmark building flow payloads (default: 10000 flows)"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "bench":
+        ok = bench_payloads(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+        sys.exit(0 if ok else 1)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
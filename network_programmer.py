@@ -0,0 +1,149 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Programs many switches in parallel.
+# Rules of different switches do not depend on each other, so each switch is programmed by
+# its own job in a thread pool of at most SWITCH_CONCURRENCY threads. A job pushes the rules
+# of one switch in order. If a job fails, the error is kept in the report and the other
+# switches are programmed as usual.
+#     report = program_switches({"40960020": lambda: ..., "40960021": lambda: ...})
+#     report.print_report()
+
+import sys, time, traceback, functools
+import requests
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+import network_manager, topo_discovery, sdcon_config
+
+SWITCH_CONCURRENCY = 8  # Max number of switches programmed at the same time
+
+class SDCProgramReport:
+    def __init__(self):
+        self.switch_time = {}   # dict[switch] = elapsed seconds of the job
+        self.switch_error = {}  # dict[switch] = error message (only failed switches)
+        self.results = {}       # dict[switch] = return value of the job
+        self.wall_time = 0.0
+
+    def merge(self, other):
+        # Adds a report of the next step programmed for the same switches.
+        for switch, elapsed in other.switch_time.items():
+            self.switch_time[switch] = self.switch_time.get(switch, 0.0) + elapsed
+        self.switch_error.update(other.switch_error)
+        self.results.update(other.results)
+        self.wall_time += other.wall_time
+
+    def get_failed_switches(self):
+        return sorted(self.switch_error.keys())
+
+    def is_ok(self):
+        return len(self.switch_error) == 0
+
+    def raise_for_errors(self, what="Programming"):
+        # Raises HTTPError naming the failed switches, once all switches are done (as response.raise_for_status()).
+        if self.switch_error:
+            raise requests.exceptions.HTTPError("%s failed in %d switches: %s"%(what, len(self.switch_error), ", ".join(self.get_failed_switches())))
+
+    def print_report(self):
+        print "Programmed %d switches in %.3f sec (sum of switch times %.3f sec), %d failed"%(
+            len(self.switch_time), self.wall_time, sum(self.switch_time.values()), len(self.switch_error))
+        for switch in sorted(self.switch_time):
+            status = "FAILED: "+self.switch_error[switch] if switch in self.switch_error else "ok"
+            print "  %s: %.3f sec, %s"%(switch, self.switch_time[switch], status)
+
+def __run_job(args):
+    switch, job = args
+    start = time.time()
+    try:
+        return switch, job(), None, time.time() - start
+    except Exception as e:
+        print "Error: programming switch %s failed: %s"%(switch, str(e))
+        traceback.print_exc()
+        return switch, None, "%s: %s"%(type(e).__name__, str(e)), time.time() - start
+
+# jobs: dict[switch] = function without arguments that programs the switch.
+# Returns SDCProgramReport.
+def program_switches(jobs, concurrency=None):
+    if concurrency == None:
+        concurrency = SWITCH_CONCURRENCY
+    report = SDCProgramReport()
+    start = time.time()
+    items = sorted(jobs.items())
+    if concurrency <= 1 or len(items) <= 1:
+        outputs = map(__run_job, items)
+    else:
+        pool = ThreadPool(min(concurrency, len(items)))
+        try:
+            outputs = pool.map(__run_job, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    for switch, result, error, elapsed in outputs:
+        report.switch_time[switch] = elapsed
+        report.results[switch] = result
+        if error != None:
+            report.switch_error[switch] = error
+    report.wall_time = time.time() - start
+    return report
+
+# Installs flow rules (network_manager.FlowRule, or dicts of add_flow() arguments) switch by switch in parallel.
+# The rules of a switch are pushed in their order with network_manager.add_flows().
+def program_rules(rules, concurrency=None):
+    switch_rules = defaultdict(list)
+    for rule in rules:
+        rule = network_manager.FlowRule.from_dict(rule)
+        switch_rules[rule.switch].append(rule)
+    jobs = dict( (switch, functools.partial(network_manager.add_flows, switch_rules[switch])) for switch in switch_rules )
+    return program_switches(jobs, concurrency)
+
+#####################################
+## Benchmark
+#####################################
+def bench_default_paths(k=4, latency=0.02, concurrency_list=(1, 4, 8, 16)):
+    # Installs the default paths of a k-ary fat-tree to a mock ODL with different concurrency limits.
+    import sdcon_mock, network_defpath
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    rules = network_defpath.set_default_paths(topo, dry_run=True)
+    url = sdcon_config.ODL_CONTROLLER_URL
+    enable_batch = network_manager.ENABLE_FLOW_BATCH
+    print "k=%d fat-tree: %d switches, %d rules, mock ODL latency %.1f ms"%(k, len(topo.get_all_switches()), len(rules), latency*1000)
+    for batch in (False, True):
+        for concurrency in concurrency_list:
+            server = sdcon_mock.MockODLServer(snapshot, latency=latency)
+            server.start()
+            sdcon_config.ODL_CONTROLLER_URL = server.url
+            network_manager.ENABLE_FLOW_BATCH = batch
+            try:
+                with sdcon_mock.quiet():
+                    report = program_rules(rules, concurrency)
+            finally:
+                sdcon_config.ODL_CONTROLLER_URL = url
+                network_manager.ENABLE_FLOW_BATCH = enable_batch
+                server.stop()
+            print "  %-12s concurrency %2d: %6d requests, %7.3f sec wall time, slowest switch %.3f sec, %d rules installed"%(
+                "batch" if batch else "per-flow PUT", concurrency, server.get_request_count(), report.wall_time,
+                max(report.switch_time.values()), server.get_flow_count())
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s bench [k] \t- benchmark parallel default path installation on a mock ODL (default: k=4)"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "bench":
+        bench_default_paths(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
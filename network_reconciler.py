@@ -0,0 +1,192 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Reconciles the flows installed in ODL with a desired rule set, instead of pushing every rule again.
+# For each switch table, the installed flows are read once and compared with the desired rules:
+#     add    : desired flow ID not installed
+#     modify : installed with the same flow ID but a different content (priority, match, actions)
+#     delete : installed flow of the managed flow-name that is not desired any more
+# Only these changes are sent (in batches, see network_manager.add_flows/del_flows), and switches
+# without changes are not written at all. Switches are reconciled in parallel (network_programmer).
+#
+# A desired rule set is dict[switch][table_id] = dict[flow_id] = rule, where a rule is a
+# network_manager.FlowRule (see network_defpath.get_default_rules()), or a dict of add_flow() arguments.
+# A desired rule and the installed flow are compared as FlowRules.
+
+import sys, time, functools
+import network_manager, network_programmer, topo_discovery, sdcon_config
+
+class SDCReconcileReport:
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.changes = {}       # dict[switch][table_id] = (added, modified, deleted) flow ID lists
+        self.unchanged = 0      # number of desired flows already installed
+        self.desired = 0        # number of desired flows
+        self.reads = 0          # GET requests
+        self.writes = 0         # PUT/PATCH/DELETE requests
+        self.program_report = None  # network_programmer.SDCProgramReport
+
+    def add_switch(self, switch, result):
+        changes, unchanged, desired, reads, writes = result
+        if changes:
+            self.changes[switch] = changes
+        self.unchanged += unchanged
+        self.desired += desired
+        self.reads += reads
+        self.writes += writes
+
+    def get_changed_switches(self):
+        return sorted(self.changes.keys())
+
+    def count(self, kind):
+        # kind: 0 = added, 1 = modified, 2 = deleted
+        return sum(len(self.changes[sw][table][kind]) for sw in self.changes for table in self.changes[sw])
+
+    def get_blind_writes(self):
+        # Requests of pushing all desired rules again with one PUT per flow.
+        return self.desired
+
+    def print_report(self, verbose=False):
+        print "Reconciled %d flows: %d added, %d modified, %d deleted, %d unchanged"%(
+            self.desired, self.count(0), self.count(1), self.count(2), self.unchanged)
+        print "Changed switches: %d"%(len(self.changes))
+        print "REST operations: %d reads, %d writes%s (blind re-push: %d per-flow PUTs, saved %d writes)"%(
+            self.reads, self.writes, " (dry-run)" if self.dry_run else "",
+            self.get_blind_writes(), self.get_blind_writes() - self.writes)
+        if verbose:
+            for sw in sorted(self.changes):
+                for table in sorted(self.changes[sw]):
+                    added, modified, deleted = self.changes[sw][table]
+                    print "%s table %s: %d added, %d modified, %d deleted"%(sw, table, len(added), len(modified), len(deleted))
+                    for flow_id in added:
+                        print "  + %s"%(flow_id)
+                    for flow_id in modified:
+                        print "  * %s"%(flow_id)
+                    for flow_id in deleted:
+                        print "  - %s"%(flow_id)
+        if self.program_report and not self.program_report.is_ok():
+            print "Failed switches: %s"%(" ".join(self.program_report.get_failed_switches()))
+
+def diff_table(desired_rules, installed_flows, switch, flowname=None):
+    # Returns (add rules, modify rules, delete flow IDs, number of unchanged flows).
+    installed = {}
+    for fl in installed_flows:
+        if flowname == None or fl.get('flow-name') == flowname:
+            installed[fl['id']] = fl
+    add, modify, unchanged = [], [], 0
+    for flow_id, rule in desired_rules.items():
+        if flow_id not in installed:
+            add.append(rule)
+        elif network_manager.FlowRule.from_dict(rule) != network_manager.parse_flow(switch, installed[flow_id]):
+            modify.append(rule)
+        else:
+            unchanged += 1
+    delete = sorted(set(installed.keys()) - set(desired_rules.keys()))
+    return add, modify, delete, unchanged
+
+def reconcile_switch(switch, table_rules, flowname=None, dry_run=False):
+    # table_rules: dict[table_id] = dict[flow_id] = rule
+    changes = {}
+    unchanged, desired, reads, writes = 0, 0, 0, 0
+    for table_id in sorted(table_rules):
+        rules = table_rules[table_id]
+        installed_flows = network_manager.get_flows(switch, table_id)
+        reads += 1
+        add, modify, delete, num_unchanged = diff_table(rules, installed_flows, switch, flowname)
+        unchanged += num_unchanged
+        desired += len(rules)
+        if not (add or modify or delete):
+            continue
+        changes[table_id] = ([network_manager.FlowRule.from_dict(r).flow_id for r in add],
+            [network_manager.FlowRule.from_dict(r).flow_id for r in modify], delete)
+        if dry_run:
+            continue
+        if add or modify:
+            num_batches, num_single = network_manager.add_flows(add + modify)
+            writes += num_batches + num_single
+        if delete:
+            num_batches, num_single = network_manager.del_flows(switch, table_id, delete)
+            writes += num_batches + num_single
+    return changes, unchanged, desired, reads, writes
+
+# Reconciles the desired rule set. Tables in 'tables' are also checked on every switch, so
+# that the flows of 'flowname' are deleted from switches or tables without desired rules.
+# Only flows of 'flowname' are modified or deleted (None: all flows in the tables).
+# Returns SDCReconcileReport.
+def reconcile(rule_set, flowname=None, tables=(), switches=(), dry_run=False, concurrency=None):
+    tables = [str(t) for t in tables]
+    jobs = {}
+    for switch in set(rule_set.keys()) | set(switches):
+        table_rules = dict( (str(t), rules) for t, rules in rule_set.get(switch, {}).items() )
+        for table_id in tables:
+            table_rules.setdefault(table_id, {})
+        jobs[switch] = functools.partial(reconcile_switch, switch, table_rules, flowname, dry_run)
+    report = SDCReconcileReport(dry_run)
+    report.program_report = network_programmer.program_switches(jobs, concurrency)
+    for switch, result in report.program_report.results.items():
+        if result != None:
+            report.add_switch(switch, result)
+    return report
+
+#####################################
+## Benchmark
+#####################################
+def bench_reconcile(k=4, latency=0.002):
+    # Redeploying default paths after one new host: blind re-push vs. reconciliation.
+    import copy, sdcon_mock, network_defpath
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    rule_set = network_defpath.get_default_rules(topo)
+    # The same fabric with one host less on the first edge switch
+    small = copy.deepcopy(snapshot)
+    gone = "host:"+sdcon_mock.fattree_host_mac(0)
+    topology = small["topology"]["topology"][0]
+    topology["node"] = [n for n in topology["node"] if n["node-id"] != gone]
+    topology["link"] = [l for l in topology["link"] if gone not in (l["source"]["source-node"], l["destination"]["dest-node"])]
+    old_rule_set = network_defpath.get_default_rules(topo_discovery.SDCTopo(None, None, None, snapshot=small))
+    print "k=%d fat-tree: %d switches, %d rules, mock ODL latency %.1f ms"%(
+        k, len(rule_set), network_defpath.count_rules(rule_set), latency*1000)
+
+    url = sdcon_config.ODL_CONTROLLER_URL
+    server = sdcon_mock.MockODLServer(snapshot, latency=latency)
+    server.start()
+    sdcon_config.ODL_CONTROLLER_URL = server.url
+    results = []
+    try:
+        with sdcon_mock.quiet():
+            network_manager.add_flows([rule for sw in old_rule_set for t in old_rule_set[sw] for rule in old_rule_set[sw][t].values()])
+            for name in ("one new host", "no change"):
+                server.reset_counters()
+                start = time.time()
+                report = reconcile(rule_set, network_manager.FLOWNAME_DEFAULT, tables=(0, 1))
+                results.append( (name, report, time.time() - start, server.get_request_count()) )
+    finally:
+        sdcon_config.ODL_CONTROLLER_URL = url
+        server.stop()
+    for name, report, elapsed, num_requests in results:
+        print "\n%s: %.3f sec, %d requests"%(name, elapsed, num_requests)
+        report.print_report()
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s bench [k] \t- reconcile default paths after adding a host, and again without change, on a mock ODL (default: k=4)"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "bench":
+        bench_reconcile(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
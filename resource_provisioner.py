@@ -6,11 +6,11 @@
 # Copyright (c) 2018, The University of Melbourne, Australia
 #
 import sys
-import json, enum
+import json, enum, requests
 from collections import defaultdict
 import copy, time
 
-import cloud_manager, topo_discovery, network_manager, network_defpath, network_manager_qos
+import cloud_manager, topo_discovery, network_manager, network_defpath, network_manager_qos, network_flow_controller, network_flow_registry, network_path_optimizer, sdcon_config
 
 #TEST_IMAGE_NAME = "jay-pisdc-experiment"
 #TEST_NETWORK_NAME = "jay-flat"
@@ -22,6 +22,7 @@ class VmSpec:
         self.cores = 0
         self.memory = 0
         self.bandwidth = 0
+        self.links = {} # dict[destination VM name] = bandwidth
         self.storage_size = 0
         self.flavor_name = ""
         self.image_name=""
@@ -50,6 +51,12 @@ class VmSpec:
     def set_bandwidth(self, bandwidth):
         self.bandwidth = bandwidth
     
+    def add_link(self, vm_name_dst, bandwidth):
+        # The bandwidth of the VM is its largest link: each link is a reservation of its own, and one
+        # reservation must fit in the link of the host (the sum of all links may not).
+        self.links[vm_name_dst] = self.links.get(vm_name_dst, 0) + bandwidth
+        self.bandwidth = max(self.links.values())
+    
     def sync_flavor(self, conn_os):
         if self.flavor_name == "":
             flv = cloud_manager.get_flavor(conn_os, self.cores, self.memory)
@@ -103,7 +110,7 @@ class VirtualTopology:
             vm_name_dst = link["destination"]
             self.links.append( (vm_name_src, vm_name_dst, bandwidth) )
             if vm_name_src in self.vms:
-                self.vms[vm_name_src].set_bandwidth(bandwidth)
+                self.vms[vm_name_src].add_link(vm_name_dst, bandwidth)
     
     def get_vms(self):
         return self.vms.values()
@@ -131,6 +138,7 @@ class TopologyInfoNode:
         self.memory_free=0
         self.memory_used=0
         self.running_vms=0
+        self.vms={} # dict[VM name] = VmSpec assigned in this round, in the subtree
         self.parent = parent
         self.subtree= []
     
@@ -139,6 +147,7 @@ class TopologyInfoNode:
         self.memory_used += vm_spec.memory
         self.memory_free -= vm_spec.memory
         self.running_vms += 1
+        self.vms[vm_spec.name] = vm_spec
         if self.parent:
             self.parent.assign_vm(vm_spec)
     
@@ -153,6 +162,18 @@ class TopologyInfoNode:
                 self.memory_free += sub.memory_free
                 self.running_vms += sub.running_vms
     
+    def get_bw_demand(self, vm_spec):
+        # Largest link of the VM out of this node: traffic to VMs in the same node does not cross its links.
+        if not vm_spec.links:
+            return vm_spec.bandwidth
+        return max([bw for vm_name_dst, bw in vm_spec.links.items() if vm_name_dst not in self.vms] or [0])
+    
+    def get_bandwidth_used(self):
+        # Demand of the VMs assigned in this round to VMs of other hosts (or not placed yet)
+        if self.type == TopologyInfoNode.Type.Host:
+            return sum(self.get_bw_demand(vm) for vm in self.vms.values())
+        return sum(sub.get_bandwidth_used() for sub in self.subtree)
+    
     def get_sub_hosts(self):
         if self.type== TopologyInfoNode.Type.Host:
             return [self]
@@ -257,14 +278,19 @@ def _get_topo_info(conn_os):
     return __saved_topo_info
 
 def aggregate_vms(vms):
+    # Links between the VMs are not counted in the bandwidth, as they are placed together.
     aggregated= VmSpec("__aggr")
+    names = set(vm.name for vm in vms)
     for vm in vms:
         aggregated.cores += vm.cores
         aggregated.memory += vm.memory
-        aggregated.bandwidth += vm.bandwidth
+        for vm_name_dst, bw in vm.links.items():
+            if vm_name_dst not in names:
+                aggregated.links[vm_name_dst] = aggregated.links.get(vm_name_dst, 0) + bw
+    aggregated.bandwidth = max(aggregated.links.values() + [vm.bandwidth for vm in vms if not vm.links] or [0])
     return aggregated
 
-def get_free_bw(host):
+def get_offline_free_bw(host):
     TOTAL_BW = 100000000 # 100 Mbits/s
     BW_OVERSUBSCRIPTION = 4 # 
     each_bw = TOTAL_BW * BW_OVERSUBSCRIPTION // (host.running_vms+1)  # Assumming all VMs share at same time.
@@ -272,12 +298,43 @@ def get_free_bw(host):
     #return max(TOTAL_BW, each_bw)
     return 10000000000
 
+__qos_ledger_seeded = False
+def _get_qos_topo():
+    # Topology for the free bandwidth, or None if ODL cannot be reached.
+    # The reservations installed by earlier runs are added to the ledger once, before the first placement.
+    global __qos_ledger_seeded
+    try:
+        topo = topo_discovery.get_topo()
+        if not __qos_ledger_seeded:
+            network_manager_qos.seed_ledger(topo)
+            __qos_ledger_seeded = True
+    except requests.exceptions.RequestException as e:
+        print "Debug: no topology for the free bandwidth, using the offline estimate:", e
+        return None
+    return topo
+
+def get_free_bw(host):
+    # Min-rate still reservable from the hosts to their edge switches (the sum for an edge or pod) in
+    # the QoS reservation ledger, less the demand of the VMs assigned in this round to other hosts.
+    # The offline estimate is used without the topology (e.g. simulation without ODL), or for a host
+    # not discovered in it.
+    topo = _get_qos_topo()
+    if topo == None:
+        return get_offline_free_bw(host)
+    free_bw = 0
+    for sub_host in host.get_sub_hosts():
+        try:
+            free_bw += network_manager_qos.get_host_free_bw(sdcon_config.hostname_to_ip(sub_host.name), topo)
+        except KeyError:
+            free_bw += get_offline_free_bw(sub_host)
+    return free_bw - host.get_bandwidth_used()
+
 def is_host_available(vm_spec, host_inst):
     free_cpu = host_inst.vcpus - host_inst.vcpus_used
     free_memory = host_inst.memory_free 
-    free_bw = get_free_bw(host_inst)  #### ToDo. How to make sure free BW?
+    free_bw = get_free_bw(host_inst)
     
-    if free_cpu >= vm_spec.cores and free_memory >= vm_spec.memory and free_bw >= vm_spec.bandwidth:
+    if free_cpu >= vm_spec.cores and free_memory >= vm_spec.memory and free_bw >= host_inst.get_bw_demand(vm_spec):
         return True
     return False
 
@@ -491,7 +548,7 @@ def set_dynamic_flow_vm(src_vm_ip, dst_vm_ip, src_compute, dst_compute):
 
 DYNAMIC_FLOW_INTERVAL = 60
 
-def set_dynamic_flows(conn_os, links, **kwargs):
+def get_dynamic_flow_pairs(conn_os, links):
     src_dst_pairs = []
     for link in links:
         (src_vm_name, dst_vm_name, bw) = link
@@ -502,6 +559,20 @@ def set_dynamic_flows(conn_os, links, **kwargs):
         dst_compute = cloud_manager.get_host_ip_of_vm_ip(conn_os, dst_vm_ip)
         
         src_dst_pairs.append((src_vm_ip, dst_vm_ip, src_compute, dst_compute))
+    return src_dst_pairs
+
+def set_dynamic_flows(conn_os, links, **kwargs):
+    # Sets a path of each flow once, and then reroutes only flows on congested links.
+    src_dst_pairs = get_dynamic_flow_pairs(conn_os, links)
+    for src_vm_ip, dst_vm_ip, src_compute, dst_compute in src_dst_pairs:
+        set_dynamic_flow_vm(src_vm_ip, dst_vm_ip, src_compute, dst_compute)
+    
+    flows = [pair for pair in src_dst_pairs if pair[2] != pair[3]]
+    network_flow_controller.SDCDynamicFlowController(flows).run()
+
+def set_dynamic_flows_loop(conn_os, links, **kwargs):
+    # Reroutes every flow in turn, DYNAMIC_FLOW_INTERVAL seconds for all flows.
+    src_dst_pairs = get_dynamic_flow_pairs(conn_os, links)
         
     interval = DYNAMIC_FLOW_INTERVAL / len(links)
     
@@ -510,6 +581,18 @@ def set_dynamic_flows(conn_os, links, **kwargs):
             set_dynamic_flow_vm(src_vm_ip, dst_vm_ip, src_compute, dst_compute)
             time.sleep(interval)
 
+def set_optimized_flows(conn_os, links, **kwargs):
+    # Assigns the paths of all flows together with their bandwidth demands, again every DYNAMIC_FLOW_INTERVAL.
+    src_dst_pairs = get_dynamic_flow_pairs(conn_os, links)
+    flows = [pair + (link[2],) for pair, link in zip(src_dst_pairs, links) if pair[2] != pair[3]]
+    current_paths = {}
+    
+    while True:
+        result = network_path_optimizer.set_optimized_paths(flows, current_paths)
+        result.print_report()
+        current_paths = result.paths
+        time.sleep(DYNAMIC_FLOW_INTERVAL)
+
 def set_bandwidth_flows(conn_os, links, **kwargs):
     for link in links:
         (src_vm_name, dst_vm_name, bw) = link
@@ -525,7 +608,8 @@ def set_bandwidth_flows(conn_os, links, **kwargs):
             continue
         network_manager_qos.add_entry(src_vm_ip, dst_vm_ip, bw)
     
-    network_manager_qos.apply_qos()
+    for (src_vm_ip, dst_vm_ip) in network_manager_qos.apply_qos():
+        print "Warning: bandwidth from %s to %s is not allocated: not enough bandwidth left in the links"%(src_vm_ip, dst_vm_ip)
 
 def get_vms_placed(conn_os, vms):
     placed_vms = []
@@ -576,7 +660,8 @@ def virtual_deploy_vm(conn_os, virt_files, vm_alg, simulate = False):
             
             last_vm = new_vms[-1]
             last_vm_ip = cloud_manager.get_vm_ip(conn_os, last_vm.name)
-            network_defpath.set_default_paths()
+            topo_discovery.invalidate_topo() # New VMs may have changed the discovered hosts.
+            network_defpath.reconcile_default_paths() # Push only the rules that have changed.
     
     print "========== Physical topo after deployement... =========="
     print str(_get_topo_info(conn_os))
@@ -602,6 +687,8 @@ def virtual_deploy_network(conn_os, virt_files, net_arg):
     print "Net-policy= %s, links= %s"%(str(net_arg), str(links))
     
     #"df" : set_dynamic_flows
+    #"df-loop" : set_dynamic_flows_loop
+    #"df-opt" : set_optimized_flows
     #"bw" : set_bandwidth_flows
     fun_net = NETWORK_MANAGEMENT_ALGORITHMS[net_arg]
     fun_net(conn_os, links) # for dynamic flow rules
@@ -622,6 +709,8 @@ VM_PLACEMENT_ALGORITHMS= {
 
 NETWORK_MANAGEMENT_ALGORITHMS= {
     "df" : set_dynamic_flows
+    ,"df-loop" : set_dynamic_flows_loop
+    ,"df-opt" : set_optimized_flows
     ,"bw" : set_bandwidth_flows
     #,"df_bw" : set_dynamic_bandwidth_flows
 }
@@ -670,7 +759,7 @@ def _print_usage():
     print("      \t python %s deploy-sim <vm_policy> <virtual.json> ... : simulate VM deployment"%(sys.argv[0]))
     print("      \t python %s deploy-net <net_policy> <virtual.json> ... : deploy only networks from <virtual.json> file "%(sys.argv[0]))
     print("      \t\t\t <vm_policy> : mff (Most full first) or topo (Topology-aware)")
-    print("      \t\t\t <net_policy>: none (No policy) df (Dynamic flow re-routing) or bw (Bandwidth allocation)")
+    print("      \t\t\t <net_policy>: none (No policy) df (Dynamic flow re-routing of congested links), df-loop (Dynamic flow re-routing in turn), df-opt (Joint path assignment of all flows) or bw (Bandwidth allocation)")
     print("      \t python %s delete <virtual.json> : delete deployed VMs and networks with <virtual.json> file "%(sys.argv[0]))
 
 # Main
@@ -687,6 +776,7 @@ def main():
         vm_policy = sys.argv[2]
         net_policy = sys.argv[3]
         virt_jsons = sys.argv[4:]
+        network_flow_registry.start_registry() # Trust the registry only once verified against the switches
         virtual_deploy(virt_jsons, vm_policy, net_policy)
     elif sys.argv[1] == "deploy-sim":
         vm_policy = sys.argv[2]
@@ -697,6 +787,7 @@ def main():
         vm_policy = None
         net_policy = sys.argv[2]
         virt_jsons = sys.argv[3:]
+        network_flow_registry.start_registry()
         virtual_deploy(virt_jsons, vm_policy, net_policy, net_only=True)
     elif sys.argv[1] == "delete":
         virtual_delete(sys.argv[2])
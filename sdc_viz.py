@@ -11,7 +11,7 @@ import flask
 import sys
 from networkx.readwrite import json_graph
 
-import topo_discovery, network_monitor, cloud_monitor
+import topo_discovery, network_monitor, cloud_monitor, sdcon_config
 from sdcon_config import SDCNodeIdType
 
 MAX_BYTES_PER_SEC = 95000000 / 8 # 95Mbits/sec = 11.875 MBytes/sec
@@ -146,7 +146,7 @@ def get_data_extra(topo, flow_name):
     return extra_path
 
 def __get_data(flow_name = network_monitor.SFLOW_FLOW_NORMAL):
-    topo = topo_discovery.SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    topo = topo_discovery.get_topo()
     
     basic = get_data_base(topo, flow_name)
     extra = get_data_extra(topo, flow_name)
@@ -220,6 +220,9 @@ def main():
         portNum = int(sys.argv[1])
     
     network_monitor.start_monitor()
+    # The page is updated from the samplers, without sFlow-RT requests.
+    network_monitor.start_sampler(network_monitor.SFLOW_FLOW_NORMAL)
+    network_monitor.start_sampler(network_monitor.SFLOW_FLOW_TUNNEL)
     print get_data()
     print get_data_vm()
     app.run( port=portNum, host="0.0.0.0" )
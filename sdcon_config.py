@@ -6,6 +6,7 @@
 # Copyright (c) 2018, The University of Melbourne, Australia
 #
 import requests, json
+import sdcon_rest
 from requests.auth import HTTPBasicAuth
 
 ############################################################
@@ -29,8 +30,12 @@ class SDCNodeIdType():
     Mac =513 #ab:cd:ef:11:22:33
     Ip  =512 #ab:cd:ef:11:22:33
     
+    type_cache = {}  # dict[id] = type, as the same IDs are parsed over and over.
+    
     @staticmethod
     def get_type(id):
+        if id in SDCNodeIdType.type_cache:
+            return SDCNodeIdType.type_cache[id]
         type=None
         if len(id.split(":")) == 6:
             type= SDCNodeIdType.Mac
@@ -43,6 +48,7 @@ class SDCNodeIdType():
                 type= SDCNodeIdType.Aggr
             elif id[-2] == '2':
                 type= SDCNodeIdType.Edge
+        SDCNodeIdType.type_cache[id] = type
         return type
     
     @staticmethod
@@ -111,7 +117,7 @@ def port_to_data_source(switch_dpid, port):
 def __get_all_port_info_raw(base_url, id, pw, switch):
     #Debug: ODL_CONTROLLER_URL/restconf/operational/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:40960000%2Fbridge%2Fovsbr0/
     url = base_url + '/restconf/operational/network-topology:network-topology/topology/ovsdb:1/node/ovsdb:'+str(switch)+'%2Fbridge%2Fovsbr0'
-    response = requests.get(url, auth=HTTPBasicAuth(id, pw), \
+    response = sdcon_rest.get(url, auth=HTTPBasicAuth(id, pw), \
         headers={"Accept": "application/json"})
     if response.status_code != 200:
         print "!!!WARNING!!! verify_oper_bind_port_qos_raw: %s, %s, retry:%d",(switch, ifname,i)
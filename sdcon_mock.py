@@ -0,0 +1,732 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Local mock of the ODL RESTCONF API, serving a recorded (or generated) topology.
+# It is used to benchmark and test SDCon modules without a live controller:
+#     server = MockODLServer(generate_fattree_snapshot(4))
+#     server.start()
+#     topo = topo_discovery.SDCTopo(server.url, "admin", "admin")
+#     print server.get_request_count()
+#     server.stop()
+#
+# It also keeps a config datastore of flows, so that flows pushed by network_manager
+# (PUT of one flow in XML, or yang-patch of many flows) can be read back in JSON and deleted.
+# Set 'latency' to emulate the processing time of a controller for each request.
+#
+# QoS and queues (OVSDB plugin) written in the config datastore appear in the operational
+# datastore 'oper_delay' seconds later, and deleted ones disappear after the same delay,
+# as ODL applies them to the switches asynchronously.
+#
+# A snapshot is a dict of the two ODL documents SDCon reads to build a topology:
+#     {"topology": <GET /restconf/operational/network-topology:network-topology/topology/flow:1/>,
+#      "inventory": <GET /restconf/operational/opendaylight-inventory:nodes>}
+#
+# MockSFlowServer is a mock of the sFlow-RT REST API, serving the samples of given flows
+# (see network_monitor_sflow). Thresholds on the incoming bytes/sec of ports ("ifinoctets")
+# raise events when a port goes above them, which can be long-polled from /events/json.
+
+import os, sys, json, time, threading, urllib, urlparse, socket, contextlib
+import BaseHTTPServer, SocketServer
+import xml.etree.ElementTree as ET
+from collections import defaultdict, OrderedDict
+import sdcon_config
+
+TOPOLOGY_PATH = "/restconf/operational/network-topology:network-topology/topology/flow:1"
+INVENTORY_PATH = "/restconf/operational/opendaylight-inventory:nodes"
+CONFIG_NODES_PATH = "/restconf/config/opendaylight-inventory:nodes"
+OVSDB_CONFIG_PATH = "/restconf/config/network-topology:network-topology/topology/ovsdb:1"
+OVSDB_OPER_PATH = "/restconf/operational/network-topology:network-topology/topology/ovsdb:1"
+
+# Hides the debug messages of the modules under test in benchmarks and self-tests:
+#     with quiet():
+#         network_manager.add_flows(rules)
+# It swaps the process-wide sys.stdout, thus it is not for the control path of SDCon.
+@contextlib.contextmanager
+def quiet():
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+#####################################################
+# Fat-tree snapshot generator
+#####################################################
+TIER_CORE, TIER_AGGR, TIER_EDGE = 0, 1, 2
+
+def fattree_switch_dpid(tier, index):
+    # Second last digit is the tier (see SDCNodeIdType), e.g. 40960020 = first edge switch.
+    # Indexes over 9 are carried into the upper digits: 40960127 = 13th edge switch.
+    return "4096%02d%d%d"%(index // 10, tier, index % 10)
+
+def fattree_host_mac(index):
+    return "00:00:00:%02x:%02x:%02x"%((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+
+def fattree_host_ip(pod, edge, host):
+    return "10.%d.%d.%d"%(pod, edge, host+2)
+
+def __tp(dpid, port):
+    return "openflow:%s:%s"%(dpid, str(port))
+
+def __link(src_node, src_tp, dst_node, dst_tp):
+    return {"link-id": src_tp,
+        "source": {"source-node": src_node, "source-tp": src_tp},
+        "destination": {"dest-node": dst_node, "dest-tp": dst_tp}}
+
+def generate_fattree_snapshot(k):
+    # k-ary fat-tree: (k/2)^2 core, k pods of k/2 aggr + k/2 edge switches, k^3/4 hosts.
+    half = k // 2
+    switch_ports = defaultdict(list)    # dict[dpid] = [port, ...]
+    host_nodes = []
+    links = []
+
+    def connect(src_dpid, src_port, dst_dpid, dst_port):
+        switch_ports[src_dpid].append(src_port)
+        switch_ports[dst_dpid].append(dst_port)
+        src_tp, dst_tp = __tp(src_dpid, src_port), __tp(dst_dpid, dst_port)
+        links.append(__link("openflow:"+src_dpid, src_tp, "openflow:"+dst_dpid, dst_tp))
+        links.append(__link("openflow:"+dst_dpid, dst_tp, "openflow:"+src_dpid, src_tp))
+
+    host_index = 0
+    for pod in range(k):
+        for e in range(half):
+            edge = fattree_switch_dpid(TIER_EDGE, pod*half + e)
+            # Edge: down ports 1..k/2 to hosts, up ports k/2+1..k to aggr switches
+            for h in range(half):
+                mac = fattree_host_mac(host_index)
+                host_index += 1
+                host_tp = "host:"+mac
+                edge_tp = __tp(edge, h+1)
+                switch_ports[edge].append(h+1)
+                host_nodes.append({"node-id": host_tp,
+                    "termination-point": [{"tp-id": host_tp}],
+                    "host-tracker-service:addresses": [{"id": host_index, "mac": mac, "ip": fattree_host_ip(pod, e, h)}]})
+                links.append(__link(host_tp, host_tp, "openflow:"+edge, edge_tp))
+                links.append(__link("openflow:"+edge, edge_tp, host_tp, host_tp))
+            for a in range(half):
+                aggr = fattree_switch_dpid(TIER_AGGR, pod*half + a)
+                connect(edge, half+a+1, aggr, e+1)
+        for a in range(half):
+            aggr = fattree_switch_dpid(TIER_AGGR, pod*half + a)
+            # Aggr: up ports k/2+1..k to core switches
+            for c in range(half):
+                core = fattree_switch_dpid(TIER_CORE, a*half + c)
+                connect(aggr, half+c+1, core, pod+1)
+
+    switch_nodes = []
+    inventory_nodes = []
+    for dpid in sorted(switch_ports.keys()):
+        ports = sorted(switch_ports[dpid]) + ["LOCAL"]
+        switch_nodes.append({"node-id": "openflow:"+dpid,
+            "termination-point": [{"tp-id": __tp(dpid, p)} for p in ports]})
+        inventory_nodes.append({"id": "openflow:"+dpid,
+            "node-connector": [{"id": __tp(dpid, p),
+                "flow-node-inventory:port-number": str(p),
+                "flow-node-inventory:name": "eth"+str(p) if p != "LOCAL" else "ovsbr0",
+                "flow-node-inventory:state": {"link-down": False, "blocked": False, "live": False}}
+                for p in ports]})
+
+    topology = {"topology": [{"topology-id": "flow:1", "node": switch_nodes + host_nodes, "link": links}]}
+    inventory = {"nodes": {"node": inventory_nodes}}
+    return {"topology": topology, "inventory": inventory}
+
+def load_snapshot(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+def save_snapshot(snapshot, file_name):
+    with open(file_name, "w") as f:
+        json.dump(snapshot, f)
+
+#####################################################
+# Flow XML -> ODL JSON
+#####################################################
+# List nodes and numeric leaves of the flow model, to convert XML flows as ODL returns them in JSON.
+FLOW_LIST_TAGS = set(["flow", "instruction", "action", "edit"])
+FLOW_NUMBER_TAGS = set(["priority", "table_id", "order", "type", "max-length", "queue-id",
+    "idle-timeout", "hard-timeout"])
+
+def __strip_ns(tag):
+    return tag.split("}")[-1]
+
+def xml_to_json(elem):
+    # Converts an XML element of the flow model into the JSON data of ODL.
+    children = list(elem)
+    if len(children) == 0:
+        text = (elem.text or "").strip()
+        if __strip_ns(elem.tag) in FLOW_NUMBER_TAGS and text.isdigit():
+            return int(text)
+        return text
+    data = OrderedDict()
+    for child in children:
+        tag = __strip_ns(child.tag)
+        value = xml_to_json(child)
+        if tag in FLOW_LIST_TAGS:
+            data.setdefault(tag, []).append(value)
+        else:
+            data[tag] = value
+    return data
+
+def parse_xml_flow(xml):
+    return xml_to_json(ET.fromstring(xml.strip()))
+
+#####################################################
+# Mock REST server
+#####################################################
+# Subclasses answer requests in handle_get(path, query), handle_put(path, content_type, body),
+# handle_patch(path, content_type, body) and handle_delete(path), with (status, json data).
+class _MockRESTServer:
+    def __init__(self, port=0, latency=0.0):
+        self.port = port
+        self.latency = latency    # Seconds to wait before answering each request
+        self.lock = threading.Lock()
+        self.request_log = []    # list of (method, path)
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        self.httpd = _MockHTTPServer(("127.0.0.1", self.port), _MockRESTHandler)
+        self.httpd.mock = self
+        self.port = self.httpd.server_address[1]
+        self.url = "http://127.0.0.1:%d"%(self.port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.close_connections()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def reset_counters(self):
+        with self.lock:
+            self.request_log = []
+
+    def get_request_count(self, method=None):
+        with self.lock:
+            if method == None:
+                return len(self.request_log)
+            return len([r for r in self.request_log if r[0] == method])
+
+    def log_request(self, method, path):
+        with self.lock:
+            self.request_log.append( (method, path) )
+
+    def __not_found(self):
+        return 404, {"errors": {"error": [{"error-tag": "data-missing"}]}}
+
+    def handle_get(self, path, query):
+        return self.__not_found()
+
+    def handle_put(self, path, content_type, body):
+        return self.__not_found()
+
+    def handle_patch(self, path, content_type, body):
+        return self.__not_found()
+
+    def handle_delete(self, path):
+        return self.__not_found()
+
+#####################################################
+# Mock ODL RESTCONF server
+#####################################################
+class MockODLServer(_MockRESTServer):
+    def __init__(self, snapshot, port=0, latency=0.0, oper_delay=0.0):
+        _MockRESTServer.__init__(self, port, latency)
+        self.snapshot = snapshot
+        self.oper_delay = oper_delay    # Seconds until OVSDB config changes are seen in the operational datastore
+        self.config_flows = defaultdict(OrderedDict)    # dict[(node, table_id)] = dict[flow_id] = flow
+        self.oper_ovsdb = {}    # dict[path under OVSDB_OPER_PATH] = (time added, time removed or None, data)
+        self.oper_updates = {}  # dict[path] = (time updated, data): a present entry rewritten, seen after oper_delay
+        self.refused_deletes = 0    # Queues deleted while a QoS entry still listed them
+        self.__index_inventory()
+
+    def __index_inventory(self):
+        self.node_connectors = {}    # dict[node-connector id] = node-connector data
+        self.bridge_ports = {}    # dict[dpid] = OVSDB termination points of the bridge
+        for node in self.snapshot["inventory"]["nodes"]["node"]:
+            dpid = node["id"].split(":")[1]
+            self.bridge_ports[dpid] = []
+            for nc in node.get("node-connector", []):
+                self.node_connectors[nc["id"]] = nc
+                port = nc["flow-node-inventory:port-number"]
+                if port.isdigit():
+                    self.bridge_ports[dpid].append({"tp-id": nc["flow-node-inventory:name"],
+                        "ovsdb:name": nc["flow-node-inventory:name"], "ovsdb:ofport": int(port), "ovsdb:ifindex": 100+int(port)})
+
+    def get_flows(self, node, table_id):
+        # Flows in the config datastore, e.g. get_flows("openflow:40960020", "0")
+        with self.lock:
+            return list(self.config_flows[(node, str(table_id))].values())
+
+    def get_flow_count(self):
+        with self.lock:
+            return sum(len(flows) for flows in self.config_flows.values())
+
+    # Splits .../nodes/node/<node>/table/<table_id>[/flow/<flow_id>] into (node, table_id, flow_id).
+    def __parse_config_path(self, path):
+        items = [urllib.unquote(p) for p in path[len(CONFIG_NODES_PATH):].split("/")]
+        if len(items) == 5 and items[1] == "node" and items[3] == "table":
+            return items[2], items[4], None
+        if len(items) == 7 and items[1] == "node" and items[3] == "table" and items[5] == "flow":
+            return items[2], items[4], items[6]
+        return None, None, None
+
+    def __not_found(self):
+        return 404, {"errors": {"error": [{"error-tag": "data-missing"}]}}
+
+    def __bad_request(self, message):
+        return 400, {"errors": {"error": [{"error-tag": "malformed-message", "error-message": message}]}}
+
+    #####################################
+    ## OVSDB: config -> operational
+    #####################################
+    def __oper_add(self, path, data):
+        item = self.oper_ovsdb.get(path)
+        if item != None and item[1] == None:
+            self.oper_updates[path] = (time.time() + self.oper_delay, data)   # Updated, still present
+        else:
+            self.oper_updates.pop(path, None)
+            self.oper_ovsdb[path] = (time.time() + self.oper_delay, None, data)
+
+    def __oper_apply_updates(self):
+        now = time.time()
+        for path, (updated, data) in self.oper_updates.items():
+            if now >= updated:
+                del self.oper_updates[path]
+                if path in self.oper_ovsdb:
+                    added, removed, old_data = self.oper_ovsdb[path]
+                    self.oper_ovsdb[path] = (added, removed, data)
+
+    def __is_queue_listed(self, path):
+        # A queue (.../node/ovsdb:<dpid>/ovsdb:queues/<queue-id>) in the queue-list of a present QoS entry
+        node_path, queue_id = path.split("/ovsdb:queues/")
+        ref = "[ovsdb:queue-id='%s']"%(queue_id)
+        for p, (added, removed, data) in self.oper_ovsdb.items():
+            if removed == None and p.startswith(node_path+"/ovsdb:qos-entries/"):
+                for qos in data.get("ovsdb:qos-entries", []):
+                    if any(q.get("queue-ref", "").endswith(ref) for q in qos.get("queue-list", [])):
+                        return True
+        return False
+
+    def __oper_remove(self, path):
+        # Removes the path and its children.
+        removed = time.time() + self.oper_delay
+        for p, (added, old_removed, data) in self.oper_ovsdb.items():
+            if (p == path or p.startswith(path+"/")) and old_removed == None:
+                self.oper_ovsdb[p] = (added, removed, data)
+
+    def __config_node(self, rel_path):
+        # qos-entries and queues of an OVSDB node written in the config datastore and not deleted yet.
+        node = {"node-id": rel_path.split("/")[-1], "ovsdb:qos-entries": [], "ovsdb:queues": []}
+        with self.lock:
+            for p, (added, removed, data) in self.oper_ovsdb.items():
+                if removed == None and p.startswith(rel_path+"/ovsdb:"):
+                    data = self.oper_updates.get(p, (None, data))[1]  # The config is written at once
+                    for key in ("ovsdb:qos-entries", "ovsdb:queues"):
+                        node[key].extend(data.get(key, []))
+        return 200, {"node": [node]}
+
+    def __oper_get(self, path):
+        now = time.time()
+        with self.lock:
+            self.__oper_apply_updates()
+            item = self.oper_ovsdb.get(path)
+        if item == None or now < item[0] or (item[1] != None and now >= item[1]):
+            return self.__not_found()
+        return 200, item[2]
+
+    def __handle_ovsdb_put(self, path, data):
+        # .../node/ovsdb:<dpid>                                              : qos-entries and queues
+        # .../node/ovsdb:<dpid>%2Fbridge%2Fovsbr0/termination-point/<ifname> : qos of a port
+        # .../node/ovsdb:<dpid>/ovsdb:qos-entries/<qos-id>                    : one qos-entry
+        # .../node/ovsdb:<dpid>/ovsdb:queues/<queue-id>                       : one queue
+        rel_path = path[len(OVSDB_CONFIG_PATH):]
+        with self.lock:
+            if "/ovsdb:qos-entries/" in rel_path:
+                self.__oper_add(rel_path, {"ovsdb:qos-entries": data["ovsdb:qos-entries"]})
+            elif "/ovsdb:queues/" in rel_path:
+                self.__oper_add(rel_path, {"ovsdb:queues": data["ovsdb:queues"]})
+            elif "/termination-point/" in rel_path:
+                for tp in data["network-topology:termination-point"]:
+                    self.__oper_add(rel_path, {"network-topology:termination-point": [tp]})
+                    for entry in tp.get("ovsdb:qos-entry", []):
+                        self.__oper_add(rel_path+"/qos-entry/"+str(entry["qos-key"]), {"ovsdb:qos-entry": [entry]})
+            else:
+                for node in data["network-topology:node"]:
+                    for qos in node.get("ovsdb:qos-entries", []):
+                        self.__oper_add(rel_path+"/ovsdb:qos-entries/"+qos["qos-id"], {"ovsdb:qos-entries": [qos]})
+                    for queue in node.get("ovsdb:queues", []):
+                        self.__oper_add(rel_path+"/ovsdb:queues/"+queue["queue-id"], {"ovsdb:queues": [queue]})
+        return 200, None
+
+    # Returns (status, json data) for a GET request.
+    def handle_get(self, path, query=None):
+        if path == TOPOLOGY_PATH:
+            return 200, self.snapshot["topology"]
+        if path == INVENTORY_PATH:
+            return 200, self.snapshot["inventory"]
+        if path.startswith(OVSDB_OPER_PATH+"/node/ovsdb:"):
+            rel_path = path[len(OVSDB_OPER_PATH):]
+            dpid = rel_path.split(":")[1].split("%2F")[0].split("/")[0]
+            if rel_path.endswith("%2Fbridge%2Fovsbr0") and dpid in self.bridge_ports:
+                return 200, {"node": [{"node-id": "ovsdb:"+dpid+"/bridge/ovsbr0", "termination-point": self.bridge_ports[dpid]}]}
+            return self.__oper_get(rel_path)
+        if path.startswith(OVSDB_CONFIG_PATH+"/node/ovsdb:") and "/" not in path[len(OVSDB_CONFIG_PATH+"/node/"):]:
+            return self.__config_node(path[len(OVSDB_CONFIG_PATH):])
+        if path.startswith(CONFIG_NODES_PATH+"/"):
+            node, table_id, flow_id = self.__parse_config_path(path)
+            with self.lock:
+                flows = self.config_flows.get((node, table_id))
+                if flows and flow_id == None:
+                    return 200, {"flow-node-inventory:table": [{"id": int(table_id), "flow": list(flows.values())}]}
+                if flows and flow_id in flows:
+                    return 200, {"flow-node-inventory:flow": [flows[flow_id]]}
+            return self.__not_found()
+        if path.startswith(INVENTORY_PATH+"/node/"):
+            # .../node/openflow:40960010/node-connector/openflow:40960010:4
+            nc_id = path.split("/")[-1]
+            if nc_id in self.node_connectors:
+                return 200, {"node-connector": [self.node_connectors[nc_id]]}
+        return self.__not_found()
+
+    # PUT of a flow, in XML (as network_manager.push_flow_raw) or JSON, or of OVSDB QoS/queues in JSON.
+    def handle_put(self, path, content_type, body):
+        if path.startswith(OVSDB_CONFIG_PATH+"/"):
+            try:
+                return self.__handle_ovsdb_put(path, json.loads(body))
+            except (ValueError, KeyError, TypeError) as e:
+                return self.__bad_request(str(e))
+        node, table_id, flow_id = self.__parse_config_path(path)
+        if flow_id == None:
+            return self.__not_found()
+        try:
+            if "xml" in content_type:
+                flow = parse_xml_flow(body)
+            else:
+                flow = json.loads(body, object_pairs_hook=OrderedDict)["flow"][0]
+        except (ValueError, KeyError, IndexError, ET.ParseError) as e:
+            return self.__bad_request(str(e))
+        if str(flow.get("id")) != flow_id:
+            return self.__bad_request("flow id does not match the URL")
+        with self.lock:
+            created = flow_id not in self.config_flows[(node, table_id)]
+            self.config_flows[(node, table_id)][flow_id] = flow
+        return (201 if created else 200), None
+
+    def handle_delete(self, path):
+        if path.startswith(OVSDB_CONFIG_PATH+"/"):
+            rel_path = path[len(OVSDB_CONFIG_PATH):]
+            with self.lock:
+                self.__oper_apply_updates()
+                if "/ovsdb:queues/" in rel_path and self.__is_queue_listed(rel_path):
+                    # OVSDB does not delete a queue still referred to by a QoS entry
+                    self.refused_deletes += 1
+                    return 409, {"errors": {"error": [{"error-tag": "in-use", "error-message": "queue is referred to by a QoS entry"}]}}
+                self.__oper_remove(rel_path)
+            return 200, None
+        node, table_id, flow_id = self.__parse_config_path(path)
+        with self.lock:
+            flows = self.config_flows.get((node, table_id))
+            if flows == None or (flow_id != None and flow_id not in flows):
+                return self.__not_found()
+            if flow_id == None:
+                del self.config_flows[(node, table_id)]
+            else:
+                del flows[flow_id]
+        return 200, None
+
+    # yang-patch (XML) of the flows in a table. All edits are applied, or none of them.
+    def handle_patch(self, path, content_type, body):
+        node, table_id, flow_id = self.__parse_config_path(path)
+        if node == None or flow_id != None:
+            return self.__not_found()
+        if "yang.patch+xml" not in content_type:
+            return 415, None
+        try:
+            patch = xml_to_json(ET.fromstring(body))
+            edits = []
+            for edit in patch.get("edit", []):
+                target_id = edit["target"].split("/")[-1]
+                if edit["operation"] in ("delete", "remove"):
+                    edits.append( (edit["operation"], target_id, None) )
+                    continue
+                flow = edit["value"]["flow"][0]
+                if edit["operation"] not in ("create", "replace", "merge") or str(flow.get("id")) != target_id:
+                    return self.__bad_request("unsupported edit %s"%(edit["edit-id"]))
+                edits.append( (edit["operation"], target_id, flow) )
+        except (KeyError, IndexError, TypeError, ET.ParseError) as e:
+            return self.__bad_request(str(e))
+        with self.lock:
+            flows = self.config_flows[(node, table_id)]
+            for operation, target_id, flow in edits:
+                if operation == "delete" and target_id not in flows:
+                    return 409, {"errors": {"error": [{"error-tag": "data-missing", "error-path": target_id}]}}
+            for operation, target_id, flow in edits:
+                if flow == None:
+                    flows.pop(target_id, None)
+                else:
+                    flows[target_id] = flow
+        return 200, {"ietf-yang-patch:yang-patch-status": {"patch-id": patch.get("patch-id"), "ok": [None]}}
+
+#####################################################
+# Mock sFlow-RT REST server
+#####################################################
+# Flows of IP pairs are sampled at a given rate (bytes/sec) on the switch ports returned by
+# locate(src_ip, dst_ip) = [(switch dpid, inport), ...]. The ports are looked up on each request,
+# so that a flow moved by network_manager (e.g. in a MockODLServer) is seen on its new path.
+#     server = MockSFlowServer(locate)
+#     server.set_rate("10.0.0.2", "10.3.0.2", 1250000)
+#     server.start()
+class MockSFlowServer(_MockRESTServer):
+    def __init__(self, locate, port=0, latency=0.0):
+        _MockRESTServer.__init__(self, port, latency)
+        self.locate = locate
+        self.rates = OrderedDict()  # dict["src_ip,dst_ip"] = bytes/sec
+        self.flow_defs = {}         # dict[flow name] = flow definition (PUT /flow/<name>/json)
+        self.thresholds = {}        # dict[threshold name] = threshold definition (PUT /threshold/<name>/json)
+        self.events = []            # Events in the order of eventID
+        self.exceeded = set()       # (threshold name, agent, data source) above the threshold
+        self.events_cond = threading.Condition(threading.Lock())
+        self.stopping = False
+
+    def start(self):
+        self.stopping = False
+        _MockRESTServer.start(self)
+
+    def stop(self):
+        # Returns waiting long-polls first.
+        with self.events_cond:
+            self.stopping = True
+            self.events_cond.notify_all()
+        _MockRESTServer.stop(self)
+
+    def set_rate(self, src_ip, dst_ip, rate):
+        with self.lock:
+            if rate:
+                self.rates[src_ip+","+dst_ip] = rate
+            else:
+                self.rates.pop(src_ip+","+dst_ip, None)
+        self.check_thresholds()
+
+    def check_thresholds(self):
+        # Adds an event for each port that went above a threshold since the last check.
+        totals = dict( (port, sum(rate for key, rate in flows)) for port, flows in self.get_samples().items() )
+        with self.lock:
+            thresholds = sorted(self.thresholds.items())
+        with self.events_cond:
+            num_events = len(self.events)
+            for name, threshold in thresholds:
+                for (agent_ip, data_source) in sorted(totals):
+                    value = totals[(agent_ip, data_source)]
+                    state = (name, agent_ip, data_source)
+                    if value <= threshold["value"]:
+                        self.exceeded.discard(state)
+                    elif state not in self.exceeded:
+                        self.exceeded.add(state)
+                        self.events.append( {"eventID": len(self.events) + 1, "thresholdID": name, "metric": threshold["metric"],
+                            "agent": agent_ip, "dataSource": data_source, "value": value, "threshold": threshold["value"],
+                            "timestamp": int(time.time() * 1000)} )
+            for state in list(self.exceeded):
+                if state[0] not in dict(thresholds) or state[1:] not in totals:
+                    self.exceeded.discard(state)
+            if len(self.events) > num_events:
+                self.events_cond.notify_all()
+
+    # /events/json?eventID=<last seen ID>&timeout=<sec>&maxEvents=<n>: waits up to timeout for newer events.
+    def __get_events(self, query):
+        query = query or {}
+        event_id = int(query.get("eventID", ["-1"])[0])
+        max_events = int(query.get("maxEvents", ["100"])[0])
+        end = time.time() + float(query.get("timeout", ["0"])[0])
+        with self.events_cond:
+            while True:
+                events = [e for e in self.events if e["eventID"] > event_id]
+                if events or self.stopping or time.time() >= end:
+                    break
+                self.events_cond.wait(end - time.time())
+        return 200, list(reversed(events))[:max_events]    # The latest first
+
+    def get_samples(self):
+        # Returns dict[(agent ip, data source)] = list of (flow key, bytes/sec)
+        with self.lock:
+            rates = self.rates.items()
+        samples = defaultdict(list)
+        for key, rate in rates:
+            src_ip, dst_ip = key.split(",")
+            for switch, inport in self.locate(src_ip, dst_ip):
+                samples[(sdcon_config.switch_dpid_to_ip(switch), sdcon_config.port_to_data_source(switch, inport))].append( (key, rate) )
+        return samples
+
+    def __not_found(self):
+        return 404, None
+
+    # /dump/<agent>/<name>/json, /activeflows/<agent>/<name>/json, /flowlocations/ALL/<name>/json?key=<key>
+    def handle_get(self, path, query=None):
+        if path == "/events/json":
+            return self.__get_events(query)
+        items = path.split("/")
+        if len(items) != 5 or items[4] != "json":
+            return self.__not_found()
+        agent, name = items[2], items[3]
+        if name not in self.flow_defs:
+            return self.__not_found()
+        samples = sorted(self.get_samples().items())
+        if agent != "ALL":
+            samples = [s for s in samples if s[0][0] == agent]
+        if items[1] == "dump":
+            return 200, [{"agent": agent_ip, "dataSource": data_source, "metricName": name,
+                "topKeys": [{"key": key, "value": rate, "lastUpdate": 0} for key, rate in sorted(flows, key=lambda x: -x[1])]}
+                for (agent_ip, data_source), flows in samples]
+        if items[1] == "activeflows":
+            return 200, [{"key": key, "value": rate, "agent": agent_ip, "dataSource": data_source}
+                for (agent_ip, data_source), flows in samples for key, rate in flows]
+        if items[1] == "flowlocations":
+            key = (query or {}).get("key", [None])[0]
+            return 200, [{"agent": agent_ip, "dataSource": data_source, "value": rate}
+                for (agent_ip, data_source), flows in samples for flow_key, rate in flows if flow_key == key]
+        return self.__not_found()
+
+    def handle_put(self, path, content_type, body):
+        items = path.split("/")
+        if len(items) != 4 or items[1] not in ("flow", "threshold"):
+            return self.__not_found()
+        with self.lock:
+            if items[1] == "flow":
+                self.flow_defs[items[2]] = json.loads(body)
+            else:
+                self.thresholds[items[2]] = json.loads(body)
+        self.check_thresholds()
+        return 204, None
+
+    def handle_delete(self, path):
+        items = path.split("/")
+        if len(items) != 4 or items[1] not in ("flow", "threshold"):
+            return self.__not_found()
+        with self.lock:
+            if items[1] == "flow":
+                self.flow_defs.pop(items[2], None)
+            else:
+                self.thresholds.pop(items[2], None)
+        self.check_thresholds()
+        return 204, None
+
+class _MockHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_class)
+        self.connections = set()    # Kept-alive client sockets
+        self.connections_lock = threading.Lock()
+
+    def process_request_thread(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections.discard(request)
+
+    def close_connections(self, timeout=1.0):
+        with self.connections_lock:
+            for request in self.connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        # Let the handler threads finish before the interpreter exits.
+        end = time.time() + timeout
+        while self.connections and time.time() < end:
+            time.sleep(0.01)
+
+    def handle_error(self, request, client_address):
+        return    # Connections closed by clients or by stop()
+
+class _MockRESTHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1   # Send each response at once (flushed after every request)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        return    # Be quiet
+
+    def __path(self):
+        return self.path.split("?")[0].rstrip("/")
+
+    def __reply(self, status, data=None):
+        body = json.dumps(data) if data != None else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __body(self):
+        return self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+
+    def __handle(self, method):
+        path = self.__path()
+        mock = self.server.mock
+        mock.log_request(method, path)
+        if mock.latency:
+            time.sleep(mock.latency)
+        content_type = self.headers.getheader("Content-Type", "")
+        if method == "GET":
+            status, data = mock.handle_get(path, urlparse.parse_qs(urlparse.urlsplit(self.path).query))
+        elif method == "PUT":
+            status, data = mock.handle_put(path, content_type, self.__body())
+        elif method == "PATCH":
+            status, data = mock.handle_patch(path, content_type, self.__body())
+        else:
+            status, data = mock.handle_delete(path)
+        self.__reply(status, data)
+
+    def do_GET(self):
+        self.__handle("GET")
+
+    def do_PUT(self):
+        self.__handle("PUT")
+
+    def do_PATCH(self):
+        self.__handle("PATCH")
+
+    def do_DELETE(self):
+        self.__handle("DELETE")
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s fattree <k> <snapshot.json> \t- write a generated k-ary fat-tree snapshot"%(sys.argv[0]))
+    print("      \t python %s serve <snapshot.json> [port] \t- serve a snapshot as a mock ODL"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 3:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "fattree":
+        save_snapshot(generate_fattree_snapshot(int(sys.argv[2])), sys.argv[3])
+    elif sys.argv[1] == "serve":
+        port = 8181
+        if len(sys.argv) > 3:
+            port = int(sys.argv[3])
+        server = MockODLServer(load_snapshot(sys.argv[2]), port)
+        server.start()
+        print "Mock ODL is running at %s"%(server.url)
+        server.thread.join()
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
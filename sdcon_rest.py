@@ -0,0 +1,186 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Shared HTTP client for all REST calls to ODL and sFlow-RT.
+# One requests.Session keeps connections alive in a pool per host, applies default timeouts,
+# and retries failed connections and 502/503/504 responses with exponential backoff.
+# Responses are retried only for idempotent methods (GET/PUT/DELETE/...): a PATCH or POST
+# may have been applied before the error, e.g. a yang-patch delete fails when sent again.
+# Use it as the requests module:
+#     response = sdcon_rest.get(url, auth=HTTPBasicAuth(id, pw), headers={"Accept": "application/json"})
+#
+# Latency of each call is counted per endpoint, i.e. method and URL path with the
+# variable parts (switch IDs, flow IDs, IPs, ...) replaced by '*':
+#     PUT 127.0.0.1:8181/restconf/config/opendaylight-inventory:nodes/node/*/table/*/flow/*
+# Use print_stats() / get_stats() / reset_stats() to read them.
+
+import sys, time, threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from urlparse import urlsplit
+
+HTTP_POOL_SIZE = 32             # Connections kept alive per host
+HTTP_TIMEOUT = (3.05, 60)       # Seconds (connect, read)
+HTTP_RETRIES = 3                # Retries of a request after a connection error, or of an idempotent request after HTTP_RETRY_STATUS
+HTTP_RETRY_BACKOFF = 0.2        # Sleep between retries: backoff * (2 ^ (retry - 1)) seconds
+HTTP_RETRY_STATUS = (502, 503, 504)
+
+__session = None
+__session_lock = threading.Lock()
+__stats = {}    # dict[(method, endpoint)] = [calls, errors, total sec, max sec]
+__stats_lock = threading.Lock()
+
+def __make_retry():
+    # The default methods of urllib3 are the idempotent ones, without PATCH and POST.
+    # Requests that never reached the server (connection errors) are retried for any method.
+    return Retry(total=HTTP_RETRIES, backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=HTTP_RETRY_STATUS, raise_on_status=False)
+
+def __make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=__make_retry())
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session():
+    global __session
+    if __session == None:
+        with __session_lock:
+            if __session == None:
+                __session = __make_session()
+    return __session
+
+def configure(pool_size=None, timeout=None, retries=None, backoff=None):
+    # Changes the client settings. The pooled connections are closed and opened again on demand.
+    global HTTP_POOL_SIZE, HTTP_TIMEOUT, HTTP_RETRIES, HTTP_RETRY_BACKOFF, __session
+    if pool_size != None:
+        HTTP_POOL_SIZE = pool_size
+    if timeout != None:
+        HTTP_TIMEOUT = timeout
+    if retries != None:
+        HTTP_RETRIES = retries
+    if backoff != None:
+        HTTP_RETRY_BACKOFF = backoff
+    with __session_lock:
+        if __session != None:
+            __session.close()
+        __session = None
+
+#####################################
+## Requests
+#####################################
+def __is_variable(item):
+    return any(c.isdigit() for c in item)
+
+def get_endpoint(url):
+    # e.g. http://127.0.0.1:8181/restconf/config/.../node/openflow:40960020/table/0
+    #      -> 127.0.0.1:8181/restconf/config/.../node/*/table/*
+    url = urlsplit(url)
+    path = "/".join(["*" if __is_variable(item) else item for item in url.path.split("/")])
+    return url.netloc + path
+
+def __count(method, url, elapsed, error):
+    key = (method, get_endpoint(url))
+    with __stats_lock:
+        stat = __stats.get(key)
+        if stat == None:
+            stat = __stats[key] = [0, 0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += error
+        stat[2] += elapsed
+        stat[3] = max(stat[3], elapsed)
+
+def request(method, url, **kwargs):
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    start = time.time()
+    error = 1
+    try:
+        response = get_session().request(method, url, **kwargs)
+        error = 0 if response.status_code < 400 else 1
+        return response
+    finally:
+        __count(method, url, time.time() - start, error)
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def put(url, data=None, **kwargs):
+    return request("PUT", url, data=data, **kwargs)
+
+def post(url, data=None, **kwargs):
+    return request("POST", url, data=data, **kwargs)
+
+def patch(url, data=None, **kwargs):
+    return request("PATCH", url, data=data, **kwargs)
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
+
+#####################################
+## Latency counters
+#####################################
+def get_stats():
+    # Returns dict[(method, endpoint)] = (calls, errors, average sec, max sec)
+    with __stats_lock:
+        return dict( (key, (s[0], s[1], s[2]/s[0], s[3])) for key, s in __stats.items() )
+
+def reset_stats():
+    with __stats_lock:
+        __stats.clear()
+
+def print_stats():
+    stats = get_stats()
+    print "%6s %6s %9s %9s  %s"%("calls", "errors", "avg(ms)", "max(ms)", "endpoint")
+    for (method, endpoint), (calls, errors, avg, max_sec) in sorted(stats.items(), key=lambda x: -x[1][0]*x[1][2]):
+        print "%6d %6d %9.2f %9.2f  %s %s"%(calls, errors, avg*1000, max_sec*1000, method, endpoint)
+
+#####################################
+## Benchmark
+#####################################
+def bench_keepalive(num_requests=500):
+    # Sequential GETs to a mock ODL, with a new connection per request vs. the pooled session.
+    import sdcon_mock
+    server = sdcon_mock.MockODLServer(sdcon_mock.generate_fattree_snapshot(4))
+    server.start()
+    url = server.url + sdcon_mock.INVENTORY_PATH + "/node/openflow:40960020/node-connector/openflow:40960020:1"
+    try:
+        start = time.time()
+        for i in xrange(num_requests):
+            requests.get(url, headers={"Accept": "application/json"})
+        single = time.time() - start
+        get(url)    # Connect
+        start = time.time()
+        for i in xrange(num_requests):
+            get(url, headers={"Accept": "application/json"})
+        pooled = time.time() - start
+    finally:
+        server.stop()
+    print "%d GETs: new connection %.2f ms/request, keep-alive %.2f ms/request"%(
+        num_requests, single*1000/num_requests, pooled*1000/num_requests)
+    print_stats()
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s bench [num_requests] \t- compare per-request connections with the pooled session on a mock ODL"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "bench":
+        bench_keepalive(int(sys.argv[2]) if len(sys.argv) > 2 else 500)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#
+# Title:        SDCon
+# Description:  Integrated Control Platform for Software-Defined Clouds
+# Licence:      GPL - http://www.gnu.org/copyleft/gpl.html
+#
+# Copyright (c) 2018, The University of Melbourne, Australia
+#
+#!/usr/bin/env python
+#
+# Compact topology backend for large fabrics.
+# SDCCompactTopo provides the same query API as topo_discovery.SDCTopo, but after building
+# the topology it interns node and port IDs to integers and keeps the adjacency in
+# array-backed tables instead of two dicts per node:
+#     node i has the ports adj_port[adj_start[i]:adj_start[i+1]],
+#     which are connected to the nodes adj_node[adj_start[i]:adj_start[i+1]] (-1: not connected).
+# Port IDs are interned in the order of the port names, so that each row is sorted by port, and
+# nbr_node[adj_start[i]:adj_start[i+1]] has the connected nodes sorted, with their slots in nbr_slot.
+# A port or a neighbour is found by bisection in its row, without slicing it.
+# The tier type of each node is parsed once and kept in node_types[i].
+# The networkx graph (topo_graph) is only built if someone accesses it.
+#
+# This is a memory-only trade-off: the tables take about 1/16 of the memory of the dicts, but a lookup
+# is slower (index and bisection calls in Python instead of one dict access; see the bench), so the
+# backend is off by default. Enable it for the shared topology with topo_discovery.TOPO_COMPACT_BACKEND = True.
+
+import sys, time, random, array
+from bisect import bisect_left
+from collections import deque
+import networkx
+import topo_discovery, sdcon_config
+from sdcon_config import SDCNodeIdType
+
+NO_NODE = -1
+
+class SDCCompactTopo(topo_discovery.SDCTopo):
+    def __init__(self, base_url, id, pw, batch_port_state=True, snapshot=None):
+        topo_discovery.SDCTopo.__init__(self, base_url, id, pw, batch_port_state, snapshot)
+        self.compact()
+
+    def __getattr__(self, name):
+        # topo_graph is dropped after compact(), and rebuilt only when used.
+        if name == "topo_graph":
+            self.topo_graph = self.build_graph()
+            return self.topo_graph
+        raise AttributeError(name)
+
+    def compact(self):
+        # Converts the dict-based nodes into the integer tables, and drops the dicts.
+        self.node_ids = sorted(self.nodes.keys())    # list[i] = node id
+        self.node_index = dict( (node_id, i) for i, node_id in enumerate(self.node_ids) )
+        self.node_types = array.array('h', [SDCNodeIdType.get_type(node_id) or 0 for node_id in self.node_ids])
+        self.port_names = sorted(set(port for node in self.nodes.values() for port in node.get_all_ports()))    # list[j] = port
+        self.port_index = dict( (port, j) for j, port in enumerate(self.port_names) )   # dict[port] = j
+        self.adj_start = array.array('i', [0])
+        self.adj_port = array.array('i')
+        self.adj_node = array.array('i')
+        self.nbr_node = array.array('i')
+        self.nbr_slot = array.array('i')
+        for node_id in self.node_ids:
+            node = self.nodes[node_id]
+            start = len(self.adj_port)
+            for port in sorted(node.get_all_ports()):
+                other_id = node.map_port_node[port]
+                self.adj_port.append(self.port_index[port])
+                self.adj_node.append(self.node_index[other_id] if other_id != None else NO_NODE)
+            for other, k in sorted( (self.adj_node[k], k) for k in xrange(start, len(self.adj_port)) ):
+                self.nbr_node.append(other)
+                self.nbr_slot.append(k)
+            self.adj_start.append(len(self.adj_port))
+        del self.nodes
+        del self.topo_graph
+
+    def build_graph(self):
+        graph = networkx.Graph()
+        for i, node_id in enumerate(self.node_ids):
+            for k in range(self.adj_start[i], self.adj_start[i+1]):
+                if self.adj_node[k] != NO_NODE:
+                    graph.add_edge(node_id, self.node_ids[self.adj_node[k]])
+        return graph
+
+    def refresh(self, data=None, inventory=None):
+        # The tables are immutable: build a new compact topology if anything has changed,
+        # including the state of the ports.
+        if data == None:
+            data = self.get_topology_data()
+        if inventory == None and self.batch_port_state:
+            inventory = self.get_inventory_data()
+        if not self.is_changed(data, inventory):
+            return self
+        if self.snapshot != None:
+            topo = SDCCompactTopo(None, None, None, self.batch_port_state,
+                {"topology": data, "inventory": inventory or self.snapshot["inventory"]})
+        else:
+            topo = SDCCompactTopo(self.base_url, self.id, self.pw, self.batch_port_state)
+        topo.version = self.version + 1
+        return topo
+
+    #####################################
+    ## Query API of SDCTopo
+    #####################################
+    def __row(self, node_id):
+        i = self.node_index[node_id]
+        return self.adj_start[i], self.adj_start[i+1]
+
+    def get_node_type(self, node_id):
+        i = self.node_index.get(node_id)
+        if i != None:
+            return self.node_types[i]
+        return SDCNodeIdType.get_type(node_id)
+
+    def has_node(self, node_id):
+        return node_id in self.node_index
+
+    def get_all_nodes(self):
+        return list(self.node_ids)
+
+    def get_all_switches(self):
+        switch_types = (SDCNodeIdType.Core, SDCNodeIdType.Aggr, SDCNodeIdType.Edge)
+        return [node_id for i, node_id in enumerate(self.node_ids) if self.node_types[i] in switch_types]
+
+    def get_all_ports(self, id):
+        start, end = self.__row(id)
+        return map(self.port_names.__getitem__, self.adj_port[start:end])
+
+    def get_all_connected(self, id):
+        start, end = self.__row(id)
+        return [self.node_ids[j] for j in self.adj_node[start:end] if j != NO_NODE]
+
+    def get_switch_port_to_dst(self, src_id, dst_id):
+        i = self.node_index[src_id]
+        j = self.node_index[dst_id]
+        nbr_node = self.nbr_node
+        end = self.adj_start[i+1]
+        k = bisect_left(nbr_node, j, self.adj_start[i], end)
+        if k == end or nbr_node[k] != j:
+            raise KeyError(dst_id)
+        return self.port_names[self.adj_port[self.nbr_slot[k]]]
+
+    def get_connected_node_via_port(self, switch_id, port_num):
+        i = self.node_index.get(switch_id)
+        if i == None:
+            return None
+        start, end = self.adj_start[i], self.adj_start[i+1]
+        if self.node_types[i] in (SDCNodeIdType.Mac, SDCNodeIdType.Ip) and int(port_num) < 5:
+            return self.get_all_connected(switch_id)[0] # Host node
+        p = self.port_index.get(port_num)
+        k = bisect_left(self.adj_port, p, start, end) if p != None else end
+        if k == end or self.adj_port[k] != p:
+            print "No port in this node..", port_num, switch_id
+            return None
+        j = self.adj_node[k]
+        if j == NO_NODE:
+            return None
+        return self.node_ids[j]
+
+    def get_connected_switch(self, host_ip):
+        host_mac = self.host_ip_to_mac[host_ip]
+        return self.get_all_connected(host_mac)[0]
+
+    def get_predecessors(self, node_id):
+        # BFS on the tables, as networkx.predecessor()
+        if node_id not in self.node_index:
+            raise networkx.NetworkXError("Node %s is not in the topology."%(node_id))
+        source = self.node_index[node_id]
+        level = {source: 0}
+        pred = {source: []}
+        queue = deque([source])
+        while queue:
+            i = queue.popleft()
+            for k in xrange(self.adj_start[i], self.adj_start[i+1]):
+                j = self.adj_node[k]
+                if j == NO_NODE:
+                    continue
+                if j not in level:
+                    level[j] = level[i] + 1
+                    pred[j] = [i]
+                    queue.append(j)
+                elif level[j] == level[i] + 1:
+                    pred[j].append(i)
+        node_ids = self.node_ids
+        return dict( (node_ids[j], [node_ids[i] for i in pred[j]]) for j in pred )
+
+    def print_all_links(self):
+        print "all links... [node:port] -- [other node]"
+        for i, node_id in enumerate(self.node_ids):
+            for k in xrange(self.adj_start[i], self.adj_start[i+1]):
+                if self.adj_node[k] != NO_NODE:
+                    print "%s:%s -- %s"%(node_id, self.port_names[self.adj_port[k]], self.node_ids[self.adj_node[k]])
+
+#####################################
+## Benchmark
+#####################################
+def _deep_sizeof(obj, seen=None):
+    # Approximate memory of an object graph in bytes.
+    if seen == None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += _deep_sizeof(k, seen) + _deep_sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for v in obj:
+            size += _deep_sizeof(v, seen)
+    elif hasattr(obj, '__dict__'):
+        size += _deep_sizeof(obj.__dict__, seen)
+    return size
+
+def __topo_table_size(topo):
+    if isinstance(topo, SDCCompactTopo):
+        tables = [topo.node_ids, topo.node_index, topo.node_types, topo.port_names, topo.port_index,
+            topo.adj_start, topo.adj_port, topo.adj_node, topo.nbr_node, topo.nbr_slot]
+    else:
+        tables = [topo.nodes, topo.topo_graph]
+    return _deep_sizeof(tables)
+
+def __bench_lookup(topo, switches, hosts, num_lookups):
+    start = time.time()
+    for i in xrange(num_lookups):
+        switch = switches[i % len(switches)]
+        for port in topo.get_all_ports(switch):
+            other_id = topo.get_connected_node_via_port(switch, port)
+            if other_id != None:
+                topo.get_switch_port_to_dst(other_id, switch)
+                topo.get_node_type(other_id)
+        topo.get_connected_switch(hosts[i % len(hosts)])
+    return (time.time() - start) * 1e6 / num_lookups
+
+def bench_compact(k, num_lookups=20000):
+    import sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    topo = topo_discovery.SDCTopo(None, None, None, snapshot=snapshot)
+    compact = SDCCompactTopo(None, None, None, snapshot=snapshot)
+    switches = topo.get_all_switches()
+    random.seed(0)
+    random.shuffle(switches)
+    hosts = topo.get_all_hosts_ip()
+    print "k=%d fat-tree: %d hosts, %d switches"%(k, len(hosts), len(switches))
+    results = []
+    for name, t in (("dict", topo), ("compact", compact)):
+        size = __topo_table_size(t)
+        lookup_us = __bench_lookup(t, switches, hosts, num_lookups)
+        results.append( (size, lookup_us) )
+        print "  %-8s node/port tables: %8.2f MB, switch neighbourhood lookup: %6.1f us"%(name, size/1048576.0, lookup_us)
+    print "  compact / dict: %.2fx memory, %.2fx lookup time"%(float(results[1][0]) / results[0][0], results[1][1] / results[0][1])
+
+# Main
+def _print_usage():
+    print("Usage:\t python %s bench [k ...] \t- memory and lookup benchmark (default: k=16 and k=34, ~1k and ~10k hosts)"%(sys.argv[0]))
+
+def main():
+    if len(sys.argv) < 2:
+        _print_usage()
+        return
+
+    if sys.argv[1] == "bench":
+        ks = [int(k) for k in sys.argv[2:]]
+        if len(ks) == 0:
+            ks = [16, 34]
+        for k in ks:
+            bench_compact(k)
+    else:
+        _print_usage()
+        return
+
+if __name__ == '__main__':
+    main()
@@ -8,14 +8,23 @@
 import networkx
 import requests
 import json
+import sys, time, copy, threading
 from requests.auth import HTTPBasicAuth
 from collections import defaultdict
 
-import network_defpath
+import network_defpath, sdcon_config, sdcon_rest
 from sdcon_config import SDCNodeIdType
 
 #For debugging: <ODL_CONTROLLER_URL>/restconf/operational/network-topology:network-topology/topology/flow:1/
 
+# A cached topology younger than this (seconds) is returned by get_topo() without any REST call.
+TOPO_CACHE_TTL = 5.0
+
+# Use the integer-ID, array-backed topology (topo_compact.SDCCompactTopo) for get_topo().
+# It only saves memory: its lookups are slower than the dicts of SDCTopo (see topo_compact bench),
+# so it is off unless the topology does not fit in memory otherwise.
+TOPO_COMPACT_BACKEND = False
+
 class SDCNode:
     def __init__(self, id):
         self.id=id
@@ -32,6 +41,28 @@ class SDCNode:
             self.map_node_port[other_id] = port
         self.map_port_node[port] = other_id
     
+    def unlink_port(self, port, other_id):
+        # Remove the connection to other_id, but keep the switch port (as a rebuild does if it is up).
+        if self.is_host():
+            port = other_id
+        if self.map_node_port.get(other_id) == port:
+            del self.map_node_port[other_id]
+        if self.is_host():
+            self.map_port_node.pop(port, None)
+        elif port in self.map_port_node:
+            self.map_port_node[port] = None
+    
+    def remove_port(self, port):
+        other_id = self.map_port_node.pop(port, None)
+        if other_id != None and self.map_node_port.get(other_id) == port:
+            del self.map_node_port[other_id]
+    
+    def clone(self):
+        node = SDCNode(self.id)
+        node.map_node_port = dict(self.map_node_port)
+        node.map_port_node = dict(self.map_port_node)
+        return node
+    
     def get_port(self, other_id):
         return self.map_node_port[other_id]
     
@@ -55,14 +86,27 @@ class SDCNode:
         return self.map_port_node[port_num]
 
 class SDCTopo:
-    def __init__(self, base_url, id, pw):
+    def __init__(self, base_url, id, pw, batch_port_state=True, snapshot=None):
         self.host_mac_to_ip={}                  # dict[mac] = ip
         self.host_ip_to_mac={}
         self.nodes = {}        # dict[id] = SDCNodeLink
         self.base_url = base_url
         self.id, self.pw = id, pw
+        # If set, the state of all ports is read from a single inventory document,
+        # instead of one GET per termination point.
+        self.batch_port_state = batch_port_state
+        self.port_data = None  # dict[(dpid, port)] = node-connector data
+        # Recorded ODL documents {"topology":..., "inventory":...} to build the topology offline
+        self.snapshot = snapshot
+        # Raw ODL documents of this topology, to find what changed on refresh()
+        self.doc_nodes = {}    # dict[node-id] = node document
+        self.doc_links = {}    # dict[link-id] = link document
+        self.version = 0       # increased whenever refresh() changes the topology
         self.build_topo()
         self.default_port_match = None
+        self.path_index = None # SDCPathIndex of this topology, built on demand
+        self.link_index = None # SDCLinkIndex of this topology, built on demand
+        self.hierarchy_index = None # network_defpath.SDCHostHierarchy, built on demand
         
     
     def tp_is_switch(self, tp):
@@ -81,16 +125,52 @@ class SDCTopo:
             return tp.split(":")[2]
         return None
     
-    def build_topo(self):
-        topo_url = self.base_url+"/restconf/operational/network-topology:network-topology/topology/flow:1/"
-        self.topo_graph = networkx.Graph()
-        
-        response = requests.get(topo_url, auth=HTTPBasicAuth(self.id, self.pw))
-        
+    def __get_json(self, url):
+        response = sdcon_rest.get(url, auth=HTTPBasicAuth(self.id, self.pw))
         if(response.ok):
             data = json.loads(response.content)
         else:
             response.raise_for_status()
+        return data
+    
+    def get_topology_data(self):
+        if self.snapshot != None:
+            return self.snapshot["topology"]
+        topo_url = self.base_url+"/restconf/operational/network-topology:network-topology/topology/flow:1/"
+        return self.__get_json(topo_url)
+    
+    def get_inventory_data(self):
+        if self.snapshot != None:
+            return self.snapshot["inventory"]
+        # Debug: ODL_CONTROLLER_URL/restconf/operational/opendaylight-inventory:nodes
+        inventory_url = self.base_url+"/restconf/operational/opendaylight-inventory:nodes"
+        return self.__get_json(inventory_url)
+    
+    def load_port_data(self, inventory=None):
+        if inventory == None:
+            inventory = self.get_inventory_data()
+        self.port_data = self.index_port_data(inventory)
+    
+    def index_port_data(self, inventory):
+        # Index all node-connectors of the inventory by (dpid, port).
+        port_data = {}
+        for inv_node in inventory["nodes"]["node"]:
+            for nc in inv_node.get("node-connector", []):
+                tp = nc["id"].encode('ascii')  # "openflow:40960010:4"
+                port_data[(self.tp_to_id(tp), self.tp_to_port(tp))] = nc
+        return port_data
+    
+    def get_down_ports(self, port_data):
+        # set of (dpid, port) whose link is down. Other fields (statistics) change all the time.
+        return set(key for key, nc in port_data.items() if nc["flow-node-inventory:state"]["link-down"])
+    
+    def build_topo(self):
+        self.topo_graph = networkx.Graph()
+        data = self.get_topology_data()
+        if self.batch_port_state:
+            self.load_port_data()
+        
+        self.doc_nodes, self.doc_links = self.__index_topology_data(data)
         
         # Build topology from the ODL info.
         for topo in data["topology"]:
@@ -121,35 +201,36 @@ class SDCTopo:
         # <termination-point>
         #  <tp-id>openflow:40960020:2</tp-id>
         for ter_po in node["termination-point"]:
-            tp = ter_po["tp-id"].encode('ascii')
-            if self.tp_is_switch(tp):
-                tpid = self.tp_to_id(tp)
-                port = self.tp_to_port(tp)
-                
-                if port == "LOCAL":
-                    continue
-                
-                if self.is_port_down(tpid, port):
-                    continue
-                
-                if tpid in self.nodes:
-                    node = self.nodes[tpid]
-                else:
-                    node = SDCNode(tpid)
-                    self.nodes[tpid]=node
-                    
+            self.parse_switch_port(ter_po["tp-id"].encode('ascii'))
+    
+    def parse_switch_port(self, tp):
+        if self.tp_is_switch(tp):
+            tpid = self.tp_to_id(tp)
+            port = self.tp_to_port(tp)
+            
+            if port == "LOCAL":
+                return
+            
+            if self.is_port_down(tpid, port):
+                return
+            
+            if tpid in self.nodes:
+                node = self.nodes[tpid]
+            else:
+                node = SDCNode(tpid)
+                self.nodes[tpid]=node
+            
+            if port not in node.map_port_node:  # On refresh, a link may already use the port.
                 node.add_port(port, None)
     
     def __get_port_data(self, dpid, port):
+        if self.port_data != None and (dpid, port) in self.port_data:
+            return self.port_data[(dpid, port)]
         # /restconf/operational/opendaylight-inventory:nodes/node/openflow:40960010/node-connector/openflow:40960010:4
         url = self.base_url +\
             "/restconf/operational/opendaylight-inventory:nodes/node/openflow:" +\
             str(dpid) + "/node-connector/openflow:"+ str(dpid)+":"+str(port)
-        response = requests.get(url, auth=HTTPBasicAuth(self.id, self.pw))
-        if(response.ok):
-            data = json.loads(response.content)
-        else:
-            response.raise_for_status()
+        data = self.__get_json(url)
         return data["node-connector"][0]
     
     def is_port_down(self, dpid, port):
@@ -190,6 +271,203 @@ class SDCTopo:
         #if self.tp_is_switch(src_tp) and self.tp_is_switch(dst_tp):
         self.topo_graph.add_edge(src_id, dst_id)    
     
+    #####################################
+    ## Incremental refresh
+    #####################################
+    def __index_topology_data(self, data):
+        doc_nodes, doc_links = {}, {}
+        for topo in data["topology"]:
+            for node in topo.get("node", []):
+                doc_nodes[node["node-id"]] = node
+            for link in topo.get("link", []):
+                doc_links[link["link-id"]] = link
+        return doc_nodes, doc_links
+    
+    def clone(self):
+        # Copy of this topology that can be modified without affecting this snapshot.
+        topo = copy.copy(self)
+        topo.host_mac_to_ip = dict(self.host_mac_to_ip)
+        topo.host_ip_to_mac = dict(self.host_ip_to_mac)
+        topo.nodes = dict( (id, node.clone()) for id, node in self.nodes.items() )
+        topo.topo_graph = self.topo_graph.copy()
+        topo.default_port_match = None
+        topo.path_index = None
+        topo.link_index = None
+        topo.hierarchy_index = None
+        return topo
+    
+    def __is_doc_changed(self, new_nodes, new_links, port_data):
+        if new_nodes != self.doc_nodes or new_links != self.doc_links:
+            return True
+        return port_data != None and self.get_down_ports(port_data) != self.get_down_ports(self.port_data)
+    
+    def is_changed(self, data, inventory=None):
+        # The state of the ports is compared only if the inventory is given.
+        port_data = None
+        if inventory != None and self.port_data != None:
+            port_data = self.index_port_data(inventory)
+        new_nodes, new_links = self.__index_topology_data(data)
+        return self.__is_doc_changed(new_nodes, new_links, port_data)
+    
+    def refresh(self, data=None, inventory=None):
+        # Returns the topology updated with the current ODL topology document and port states.
+        # Only added, removed, or changed nodes and links, and ports whose link went up or down,
+        # are parsed again, so that the result is the same as building the topology again.
+        # This snapshot is never modified, so that a caller holding it keeps a consistent view.
+        # Without batch_port_state, only the state of added ports is read.
+        if data == None:
+            data = self.get_topology_data()
+        port_data = None
+        if self.batch_port_state:
+            if inventory == None:
+                inventory = self.get_inventory_data()
+            port_data = self.index_port_data(inventory)
+        new_nodes, new_links = self.__index_topology_data(data)
+        if not self.__is_doc_changed(new_nodes, new_links, port_data):
+            return self
+        topo = self.clone()
+        topo.apply_topology_diff(new_nodes, new_links, port_data)
+        return topo
+    
+    def apply_topology_diff(self, new_nodes, new_links, port_data=None):
+        old_nodes, old_links = self.doc_nodes, self.doc_links
+        removed_links = [old_links[l] for l in old_links if new_links.get(l) != old_links[l]]
+        added_links = [new_links[l] for l in new_links if old_links.get(l) != new_links[l]]
+        
+        # Switch ports to check against the new documents at the end: (dpid, port)
+        dirty_ports = set()
+        if port_data != None:
+            dirty_ports.update(self.get_down_ports(port_data) ^ self.get_down_ports(self.port_data))
+            self.port_data = port_data
+        for link in removed_links + added_links:
+            for tp in (link["source"]["source-tp"], link["destination"]["dest-tp"]):
+                if self.tp_is_switch(tp):
+                    dirty_ports.add( (self.tp_to_id(tp.encode('ascii')), self.tp_to_port(tp.encode('ascii'))) )
+        
+        # Removal first: links, then termination points and nodes
+        for link in removed_links:
+            self.unparse_link(link)
+        
+        added_tps = []
+        for node_id in old_nodes:
+            old_node = old_nodes[node_id]
+            new_node = new_nodes.get(node_id)
+            if new_node == old_node:
+                continue
+            old_tps = set(tp["tp-id"] for tp in old_node.get("termination-point", []))
+            new_tps = set()
+            if new_node != None:
+                new_tps = set(tp["tp-id"] for tp in new_node.get("termination-point", []))
+            for tp in old_tps - new_tps:
+                self.unparse_switch_port(tp.encode('ascii'))
+                if self.tp_is_switch(tp):
+                    dirty_ports.add( (self.tp_to_id(tp.encode('ascii')), self.tp_to_port(tp.encode('ascii'))) )
+            added_tps += list(new_tps - old_tps)
+            if new_node == None or new_node.get("host-tracker-service:addresses") != old_node.get("host-tracker-service:addresses"):
+                self.unparse_node_addr(old_node)
+                if new_node != None:
+                    self.parse_node_addr(new_node)
+            if new_node == None:
+                self.remove_node(self.tp_to_id(node_id.encode('ascii')))
+        
+        for node_id in new_nodes:
+            if node_id not in old_nodes:
+                self.parse_node_addr(new_nodes[node_id])
+                added_tps += [tp["tp-id"] for tp in new_nodes[node_id].get("termination-point", [])]
+        
+        # Additions: termination points, then links
+        added_tps = [tp.encode('ascii') for tp in added_tps]
+        if self.batch_port_state and port_data == None:
+            for tp in added_tps:
+                if self.tp_is_switch(tp) and (self.tp_to_id(tp), self.tp_to_port(tp)) not in self.port_data:
+                    self.load_port_data() # New ports: read the inventory once again.
+                    break
+        for tp in added_tps:
+            self.parse_switch_port(tp)
+        for link in added_links:
+            self.parse_link(link)
+        
+        self.doc_nodes, self.doc_links = new_nodes, new_links
+        self.reparse_switch_ports(dirty_ports)
+        self.version += 1
+        print "Topology refreshed (version %d): %d/%d links removed/added, %d ports added, %d ports checked"%(
+            self.version, len(removed_links), len(added_links), len(added_tps), len(dirty_ports))
+    
+    def reparse_switch_ports(self, switch_ports):
+        # Sets the given (dpid, port) as build_topo() would from the current documents:
+        # connected if a link uses the port, else kept unconnected only if the port is up.
+        linked = {} # dict[(dpid, port)] = link document
+        for link in self.doc_links.values():
+            for tp in (link["source"]["source-tp"], link["destination"]["dest-tp"]):
+                if self.tp_is_switch(tp):
+                    linked[(self.tp_to_id(tp.encode('ascii')), self.tp_to_port(tp.encode('ascii')))] = link
+        for (dpid, port) in switch_ports:
+            node = self.nodes.get(dpid)
+            if (dpid, port) in linked:
+                if node == None or node.map_port_node.get(port) == None:
+                    self.parse_link(linked[(dpid, port)])   # e.g. the link of the other direction was removed
+                continue
+            doc_node = self.doc_nodes.get("openflow:"+dpid, {})
+            tps = set(tp["tp-id"] for tp in doc_node.get("termination-point", []))
+            if port != "LOCAL" and "openflow:%s:%s"%(dpid, port) in tps and not self.is_port_down(dpid, port):
+                if node == None:
+                    node = self.nodes[dpid] = SDCNode(dpid)
+                if port not in node.map_port_node:
+                    node.add_port(port, None)
+            elif node != None:
+                node.remove_port(port)
+                if len(node.get_all_ports()) == 0:
+                    self.remove_node(dpid)
+    
+    def unparse_node_addr(self, node_str):
+        for addr in node_str.get("host-tracker-service:addresses", []):
+            host_ip = addr["ip"].encode('ascii')
+            host_mac = addr["mac"].encode('ascii')
+            if self.host_mac_to_ip.get(host_mac) == host_ip:
+                del self.host_mac_to_ip[host_mac]
+            if self.host_ip_to_mac.get(host_ip) == host_mac:
+                del self.host_ip_to_mac[host_ip]
+    
+    def unparse_switch_port(self, tp):
+        if self.tp_is_switch(tp):
+            tpid = self.tp_to_id(tp)
+            if tpid in self.nodes:
+                self.nodes[tpid].remove_port(self.tp_to_port(tp))
+    
+    def unparse_link(self, link):
+        src_tp = link["source"]["source-tp"].encode('ascii')
+        dst_tp = link["destination"]["dest-tp"].encode('ascii')
+        src_id, dst_id = self.tp_to_id(src_tp), self.tp_to_id(dst_tp)
+        if src_id in self.nodes:
+            self.nodes[src_id].unlink_port(self.tp_to_port(src_tp), dst_id)
+        if dst_id in self.nodes:
+            self.nodes[dst_id].unlink_port(self.tp_to_port(dst_tp), src_id)
+        if self.topo_graph.has_edge(src_id, dst_id):
+            self.topo_graph.remove_edge(src_id, dst_id)
+        # The graph has only nodes with links, as built by parse_link().
+        for node_id in (src_id, dst_id):
+            if self.topo_graph.has_node(node_id) and self.topo_graph.degree(node_id) == 0:
+                self.topo_graph.remove_node(node_id)
+        # Hosts exist only through their links.
+        for node_id in (src_id, dst_id):
+            if node_id in self.nodes and self.nodes[node_id].is_host() and len(self.nodes[node_id].get_all_ports()) == 0:
+                self.remove_node(node_id)
+    
+    def remove_node(self, node_id):
+        if node_id in self.nodes:
+            del self.nodes[node_id]
+        if self.topo_graph.has_node(node_id):
+            self.topo_graph.remove_node(node_id)
+    
+    def get_node_type(self, node_id):
+        return SDCNodeIdType.get_type(node_id)
+    
+    def get_predecessors(self, node_id):
+        # dict[node] = [previous nodes on the shortest paths from node_id]
+        if node_id not in self.topo_graph:
+            raise networkx.NetworkXError("Node %s is not in the topology."%(node_id))
+        return networkx.predecessor(self.topo_graph, node_id)
+    
     def get_connected_switch(self, host_ip):
         host_mac = self.host_ip_to_mac[host_ip]
         node = self.nodes[host_mac]
@@ -201,6 +479,9 @@ class SDCTopo:
     def get_all_nodes(self):
         return self.nodes.keys()
     
+    def has_node(self, node_id):
+        return node_id in self.nodes
+    
     def get_all_switches(self):
         all_nodes = self.nodes.keys()
         all_switches = []
@@ -271,7 +552,7 @@ class SDCTopo:
         self.default_port_match = defaultdict(dict)
         for switch in self.get_all_nodes():
             if SDCNodeIdType.get_type(switch) == SDCNodeIdType.Aggr or SDCNodeIdType.get_type(switch) == SDCNodeIdType.Edge:
-                upports, downports = network_defpath.get_up_down_ports(self, switch)
+                upports, downports = network_defpath.get_hierarchy(self).get_up_down_ports(switch)
                 for i in range(max(len(upports), len(downports))):
                     inport = downports[i%len(downports)]
                     outport = upports[i%len(upports)]
@@ -284,20 +565,37 @@ class SDCTopo:
             return self.default_port_match[switch][inport]
         return None
     
+    def get_path_index(self):
+        if self.path_index == None or self.path_index.version != self.version:
+            self.path_index = SDCPathIndex(self)
+        return self.path_index
+    
+    def get_link_index(self):
+        if self.link_index == None or self.link_index.version != self.version:
+            self.link_index = SDCLinkIndex(self)
+        return self.link_index
+    
     def find_all_path(self, src_ip, dst_ip):
         src_mac = self.get_host_mac(src_ip)
         dst_mac = self.get_host_mac(dst_ip)
         
-        paths= networkx.all_shortest_paths(self.topo_graph, source=src_mac, target=dst_mac)
-        return list(paths)
+        paths = self.get_path_index().get_paths(src_mac, dst_mac)
+        return [list(path) for path in paths]
     
     def find_all_path_port_map(self, src_ip, dst_ip):
-        port_map=[]
-        for path in self.find_all_path(src_ip, dst_ip):
-            port_map.append( self.get_switch_port_map(path) )
-        return port_map
+        src_mac = self.get_host_mac(src_ip)
+        dst_mac = self.get_host_mac(dst_ip)
+        
+        port_maps = self.get_path_index().get_port_maps(src_mac, dst_mac)
+        return [list(port_map) for port_map in port_maps]
     
     def get_switch_port_map(self, path):
+        port_map = self.get_path_index().get_port_map(path)
+        if port_map != None:
+            return list(port_map)
+        return self.build_switch_port_map(path)
+    
+    def build_switch_port_map(self, path):
         switch_port_map = []    # [ (inport, switch, outport), ...]
         for i in range(1, len(path)-1):
             prev_node = path[i-1]
@@ -308,6 +606,143 @@ class SDCTopo:
             switch_port_map.append( (inport, this_node, outport) )
         return switch_port_map
 
+#####################################
+## Shared topology cache
+#####################################
+class SDCTopoCache:
+    # Set TOPO_COMPACT_BACKEND to keep the shared topology in topo_compact.SDCCompactTopo.
+    def __init__(self, base_url, id, pw, ttl=TOPO_CACHE_TTL):
+        self.base_url = base_url
+        self.id, self.pw = id, pw
+        self.ttl = ttl
+        self.topo = None
+        self.last_updated = 0
+        self.lock = threading.Lock()
+    
+    def get(self):
+        with self.lock:
+            current_time = time.time()
+            if self.topo == None:
+                if TOPO_COMPACT_BACKEND:
+                    import topo_compact
+                    self.topo = topo_compact.SDCCompactTopo(self.base_url, self.id, self.pw)
+                else:
+                    self.topo = SDCTopo(self.base_url, self.id, self.pw)
+                self.last_updated = current_time
+            elif current_time - self.last_updated > self.ttl:
+                self.topo = self.topo.refresh()
+                self.last_updated = current_time
+            return self.topo
+    
+    def invalidate(self, rebuild=False):
+        # Next get() refreshes the topology. If rebuild is set, it is built from scratch.
+        with self.lock:
+            self.last_updated = 0
+            if rebuild:
+                self.topo = None
+
+__topo_cache = None
+__topo_cache_lock = threading.Lock()
+
+def __get_topo_cache():
+    global __topo_cache
+    with __topo_cache_lock:
+        if __topo_cache == None:
+            __topo_cache = SDCTopoCache(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+        return __topo_cache
+
+# Returns the process-wide topology snapshot. A returned snapshot is never modified afterwards.
+def get_topo():
+    return __get_topo_cache().get()
+
+def invalidate_topo(rebuild=False):
+    __get_topo_cache().invalidate(rebuild)
+
+def set_topo_cache_ttl(ttl):
+    __get_topo_cache().ttl = ttl
+
+#####################################
+## Equal-cost path index
+#####################################
+class SDCPathIndex:
+    # All shortest (ECMP) paths between hosts of a topology, with their port maps.
+    # Paths from a source host are computed together on the first query of the source,
+    # with one BFS, and kept as long as the topology version does not change.
+    def __init__(self, topo):
+        self.topo = topo
+        self.version = topo.version
+        self.paths = {}      # dict[src_mac][dst_mac] = ((src_mac, switch, ..., dst_mac), ...)
+        self.port_maps = {}  # dict[path] = ((inport, switch, outport), ...)
+    
+    def __build_source(self, src_mac):
+        pred = self.topo.get_predecessors(src_mac)
+        paths_to = {src_mac: [(src_mac,)]}  # partial paths through switches
+        
+        def get_paths_to(node):
+            # Same order as networkx.all_shortest_paths()
+            if node not in paths_to:
+                paths = []
+                for prev_node in pred[node]:
+                    for path in get_paths_to(prev_node):
+                        paths.append( path + (node,) )
+                paths_to[node] = paths
+            return paths_to[node]
+        
+        src_paths = {}
+        for dst_mac in pred:
+            if dst_mac == src_mac or not SDCNodeIdType.is_host(dst_mac):
+                continue
+            paths = tuple(get_paths_to(dst_mac))
+            for path in paths:
+                self.port_maps[path] = tuple(self.topo.build_switch_port_map(path))
+            src_paths[dst_mac] = paths
+        self.paths[src_mac] = src_paths
+    
+    def build(self):
+        # Builds the paths between all host pairs at once.
+        for host_ip in self.topo.get_all_hosts_ip():
+            src_mac = self.topo.get_host_mac(host_ip)
+            if src_mac not in self.paths and self.topo.has_node(src_mac):
+                self.__build_source(src_mac)
+    
+    def get_paths(self, src_mac, dst_mac):
+        if src_mac not in self.paths:
+            self.__build_source(src_mac)
+        src_paths = self.paths[src_mac]
+        if dst_mac not in src_paths:
+            raise networkx.NetworkXNoPath("No path from %s to %s"%(src_mac, dst_mac))
+        return src_paths[dst_mac]
+    
+    def get_port_maps(self, src_mac, dst_mac):
+        return [self.port_maps[path] for path in self.get_paths(src_mac, dst_mac)]
+    
+    def get_port_map(self, path):
+        return self.port_maps.get(tuple(path))
+
+class SDCLinkIndex:
+    # Array index of every switch port of a topology, and the indexes of the incoming ports along paths,
+    # e.g. to keep the BW of all ports in one array (network_monitor.SDCUtilizationMatrix).
+    def __init__(self, topo):
+        self.topo = topo
+        self.version = topo.version
+        self.index = {}      # dict[(switch, port)] = index
+        self.path_links = {} # dict[path] = (index of the incoming port at each switch, ...)
+        for switch in sorted(topo.get_all_switches()):
+            for port in sorted(str(p) for p in topo.get_all_ports(switch)):
+                self.index[(switch, port)] = len(self.index)
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def get(self, switch, port):
+        return self.index.get( (switch, str(port)) )
+    
+    def get_path_links(self, path):
+        path = tuple(path)
+        if path not in self.path_links:
+            self.path_links[path] = tuple(self.index[(switch, str(inport))] for (inport, switch, outport) in self.topo.get_switch_port_map(path))
+        return self.path_links[path]
+
 def get_topology_info():
     # returns edges / pod info:
     # (  ( (pod0_edge0_hosts...), (pod0_edge1_hosts..), ..),
@@ -317,7 +752,7 @@ def get_topology_info():
     for n in range(2,10):
         compute_nodes.append("192.168.0."+str(n))
         
-    topo = SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    topo = get_topo()
     
     edge_hosts = {}
     # Find all edge nodes and their hosts
@@ -353,6 +788,20 @@ def get_topology_info():
         pod_edge_hosts.append(hosts_in_edge)
     return pod_edge_hosts
 
+def load_topo_snapshot(file_name):
+    # Builds a topology from a file recorded with record_topology(), without ODL.
+    with open(file_name) as f:
+        snapshot = json.load(f)
+    return SDCTopo(None, None, None, snapshot=snapshot)
+
+def record_topology(file_name):
+    # Record the ODL documents used to build a topology, for offline use (see sdcon_mock).
+    topo = SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
+    snapshot = {"topology": topo.get_topology_data(), "inventory": topo.get_inventory_data()}
+    with open(file_name, "w") as f:
+        json.dump(snapshot, f)
+    print "Topology recorded in %s: %d nodes"%(file_name, len(topo.get_all_nodes()))
+
 def test():
     print "\nTesting SDCTopo..."
     topo = SDCTopo(sdcon_config.ODL_CONTROLLER_URL, sdcon_config.ODL_CONTROLLER_ID, sdcon_config.ODL_CONTROLLER_PW)
@@ -363,9 +812,166 @@ def test():
     
     print get_topology_info()
 
+#####################################
+## Benchmark
+#####################################
+def bench_build_topo(snapshot, repeat=3):
+    # Compares HTTP calls and wall time of building a topology from a recorded ODL response,
+    # with per-port state GETs and with a single inventory GET.
+    import sdcon_mock
+    server = sdcon_mock.MockODLServer(snapshot)
+    server.start()
+    try:
+        for batch in (False, True):
+            elapsed = []
+            for i in range(repeat):
+                server.reset_counters()
+                start = time.time()
+                topo = SDCTopo(server.url, "admin", "admin", batch_port_state=batch)
+                elapsed.append(time.time() - start)
+            print "%-22s nodes=%d, HTTP calls=%d, wall time=%.3f sec (best of %d)"%(
+                "batched port state:" if batch else "per-port state:",
+                len(topo.get_all_nodes()), server.get_request_count(), min(elapsed), repeat)
+    finally:
+        server.stop()
+
+def bench_find_path(snapshot, num_pairs=1000):
+    # Compares path lookup latency of networkx.all_shortest_paths() and the path index.
+    import sdcon_mock, random
+    server = sdcon_mock.MockODLServer(snapshot)
+    server.start()
+    try:
+        topo = SDCTopo(server.url, "admin", "admin")
+    finally:
+        server.stop()
+    hosts = topo.get_all_hosts_ip()
+    random.seed(0)
+    pairs = []
+    while len(pairs) < num_pairs:
+        src_ip, dst_ip = random.sample(hosts, 2)
+        pairs.append( (src_ip, dst_ip) )
+    print "%d hosts, %d lookups"%(len(hosts), len(pairs))
+    
+    start = time.time()
+    for src_ip, dst_ip in pairs:
+        paths = list(networkx.all_shortest_paths(topo.topo_graph, source=topo.get_host_mac(src_ip), target=topo.get_host_mac(dst_ip)))
+        port_maps = [topo.build_switch_port_map(path) for path in paths]
+    elapsed = time.time() - start
+    print "networkx + port maps:   %8.1f us/lookup"%(elapsed*1e6/len(pairs))
+    
+    start = time.time()
+    topo.get_path_index().build()
+    elapsed = time.time() - start
+    print "path index build:       %8.3f sec (all pairs)"%(elapsed)
+    
+    start = time.time()
+    for src_ip, dst_ip in pairs:
+        paths = topo.find_all_path(src_ip, dst_ip)
+        port_maps = topo.find_all_path_port_map(src_ip, dst_ip)
+    elapsed = time.time() - start
+    print "path index + port maps: %8.1f us/lookup"%(elapsed*1e6/len(pairs))
+
+def __get_topo_state(topo):
+    ports = dict( (node_id, (dict(node.map_port_node), dict(node.map_node_port))) for node_id, node in topo.nodes.items() )
+    edges = set( frozenset(edge) for edge in topo.topo_graph.edges() )
+    return ports, edges, set(topo.topo_graph.nodes()), dict(topo.host_ip_to_mac)
+
+def test_refresh(k=4, steps=300, seed=1):
+    # Random link removals, ports going down (with or without their links) and termination points
+    # removed, and back: each refresh() must give the same topology as building it again from the
+    # same documents, and leave the previous snapshot as it was.
+    import random, sdcon_mock
+    snapshot = sdcon_mock.generate_fattree_snapshot(k)
+    rnd = random.Random(seed)
+    all_links = snapshot["topology"]["topology"][0]["link"]
+    switch_tps = [tp["tp-id"] for node in snapshot["topology"]["topology"][0]["node"]
+        for tp in node["termination-point"] if node["node-id"].startswith("openflow:") and not tp["tp-id"].endswith(":LOCAL")]
+    down_tps, removed_links, removed_tps = set(), set(), set()
+    
+    def make_docs():
+        data = copy.deepcopy(snapshot["topology"])
+        for node in data["topology"][0]["node"]:
+            node["termination-point"] = [tp for tp in node["termination-point"] if tp["tp-id"] not in removed_tps]
+        data["topology"][0]["link"] = [link for link in data["topology"][0]["link"] if link["link-id"] not in removed_links]
+        inventory = copy.deepcopy(snapshot["inventory"])
+        for inv_node in inventory["nodes"]["node"]:
+            for nc in inv_node["node-connector"]:
+                nc["flow-node-inventory:state"]["link-down"] = nc["id"] in down_tps
+        return data, inventory
+    
+    errors = defaultdict(int)
+    topo = SDCTopo(None, None, None, snapshot=snapshot)
+    start = time.time()
+    with sdcon_mock.quiet():
+        for i in range(steps):
+            change = rnd.choice(("port", "port", "link", "tp"))
+            if change == "port":
+                tp = rnd.choice(switch_tps)
+                tp_links = [link["link-id"] for link in all_links if tp in (link["source"]["source-tp"], link["destination"]["dest-tp"])]
+                if tp in down_tps:
+                    down_tps.remove(tp)
+                    removed_links.difference_update(tp_links)
+                else:
+                    down_tps.add(tp)
+                    if rnd.random() < 0.7:  # ODL usually removes the links of a port that went down
+                        removed_links.update(tp_links)
+            elif change == "link":
+                removed_links.symmetric_difference_update([rnd.choice(all_links)["link-id"]])
+            else:
+                removed_tps.symmetric_difference_update([rnd.choice(switch_tps)])
+            data, inventory = make_docs()
+            before = __get_topo_state(topo)
+            refreshed = topo.refresh(data, inventory)
+            rebuilt = SDCTopo(None, None, None, snapshot={"topology": data, "inventory": inventory})
+            if __get_topo_state(refreshed) != __get_topo_state(rebuilt):
+                errors["refreshed topology differs from the rebuilt one"] += 1
+            if __get_topo_state(topo) != before:
+                errors["previous snapshot modified"] += 1
+            if refreshed.refresh(data, inventory) is not refreshed:
+                errors["refresh without changes gave a new topology"] += 1
+            topo = refreshed
+    print "k=%d fat-tree, %d random changes: %d ports down, %d links and %d termination points removed at the end, %.2f ms per refresh and rebuild"%(
+        k, steps, len(down_tps), len(removed_links), len(removed_tps), (time.time() - start)*1000/steps)
+    for name, count in sorted(errors.items()):
+        print "  FAILED: %s (%d times)"%(name, count)
+    return len(errors) == 0
+
+def __get_bench_snapshot(default_k):
+    import sdcon_mock
+    arg = default_k
+    if len(sys.argv) > 2:
+        arg = sys.argv[2]
+    if arg.isdigit():
+        return sdcon_mock.generate_fattree_snapshot(int(arg))
+    return sdcon_mock.load_snapshot(arg)
+
 # Main
+def _print_usage():
+    print("Usage:\t python %s \t- print the network topology"%(sys.argv[0]))
+    print("      \t python %s record <snapshot.json> \t- record the ODL topology and inventory to a file"%(sys.argv[0]))
+    print("      \t python %s bench [k | snapshot.json] \t- benchmark topology building from a recorded response (default: k=4 fat-tree)"%(sys.argv[0]))
+    print("      \t python %s bench-path [k | snapshot.json] \t- benchmark ECMP path lookup (default: k=8, 128 hosts)"%(sys.argv[0]))
+    print("      \t python %s test-refresh [k] \t- test that refreshing the topology gives the same as building it again (default: k=4)"%(sys.argv[0]))
+
 def main():
-    test()
+    if len(sys.argv) < 2:
+        test()
+        return
+    
+    if sys.argv[1] == "record":
+        record_topology(sys.argv[2])
+    elif sys.argv[1] == "bench":
+        bench_build_topo(__get_bench_snapshot("4"))
+    elif sys.argv[1] == "bench-path":
+        bench_find_path(__get_bench_snapshot("8"))
+    elif sys.argv[1] == "test-refresh":
+        ok = test_refresh(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+        print "\nTopology refresh: %s"%("OK" if ok else "FAILED")
+        if not ok:
+            sys.exit(1)
+    else:
+        _print_usage()
+        return
 
 if __name__ == '__main__':
     main()
\ No newline at end of file